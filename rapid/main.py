@@ -2,28 +2,45 @@
 # Copyright (C) 2010 Tobi Vollebregt
 
 from contextlib import closing
+from Queue import Empty, Queue
+from threading import Thread
 from .ui.text.progressbar import ProgressBar
+from rapid import REFRESH_THREADS, PoolReferencesException, ProgressGroup, StreamerFormatException, StreamerWriter, compression_ratio, plan_downloads, pool_md5, pool_snapshot
+from server import MIRROR_PORT, MirrorServer
+from util.async_downloader import AsyncDownloader
+from util.workers import parallel_map
 import rapid
-import gzip, os
-import logging
+import gzip, os, sys
+import logging, urllib2
 
 
 log = logging.getLogger('root')
 
+PIPELINE_DEPTH = 2   # number of packages downloaded concurrently
 
-def init(data_dir, _ui):
+event_loop = False   # use install_many_event_loop instead of install_many
+dry_run = False      # only show what install_many would download
+
+
+def init(data_dir, _ui, shared_dir = None):
 	"""  Create rapid module."""
-	global spring_dir, pool_dir, rapid, ui
+	global spring_dir, pool_dir, content_dir, rapid, ui
 	ui = _ui
 
 	log.info('Using data directory: %s', data_dir)
-	rapid.set_spring_dir(data_dir)
+	if shared_dir:
+		log.info('Using shared pool directory: %s', shared_dir)
+	rapid.set_spring_dir(data_dir, shared_dir)
 
 	# Global constants/rapid instance.
 	spring_dir = rapid.spring_dir
 	pool_dir = rapid.pool_dir
+	content_dir = rapid.content_dir
 	rapid = rapid.Rapid()
 
+	# Search names and tags using the search index of the packages.
+	ui.candidates = rapid.packages.candidates
+
 
 def pin_single(tag):
 	""" Pin a tag. This means any package having this tag will automatically be
@@ -37,9 +54,17 @@ def pin_single(tag):
 
 def pin(searchterm):
 	""" Pin all tags matching searchterm and install the corresponding packages."""
-	for t in ui.select('tag', searchterm, rapid.tags):
-		pin_single(t)
-		install_single(rapid.packages[t])
+	# Select an exact tag without loading all tags if packages are lazy.
+	p = rapid.packages.lazy and rapid.packages.lookup(searchterm)
+	if p and searchterm in p.tags:
+		tags, packages = [searchterm], [p]
+	else:
+		tags = ui.select('tag', searchterm, rapid.tags)
+		packages = [rapid.packages[t] for t in tags]
+	if not dry_run:
+		for t in tags:
+			pin_single(t)
+	install_many(packages)
 
 
 def unpin_single(tag):
@@ -58,22 +83,294 @@ def unpin(searchterm):
 		unpin_single(t)
 
 
-def install_single(p, dep = False):
-	""" Install a single package and its dependencies."""
-	if p:
-		for d in p.dependencies:
-			install_single(d, True)
-		if not p.installed:
-			log.info('Installing%s: %s', ' dependency' if dep else '', p.name)
-			p.install(ProgressBar())
-		elif not dep:
+def install_order(packages):
+	""" Return the packages and their dependencies which are not installed
+	    yet, with dependencies preceding the packages depending on them."""
+	order = []
+	visited = set()
+	def visit(p):
+		if p and p not in visited:
+			visited.add(p)
+			for d in p.dependencies:
+				visit(d)
+			if not p.installed:
+				order.append(p)
+	for p in packages:
+		visit(p)
+	return order
+
+
+def waiting_for(order, plan):
+	""" For each package in order, return the indices of the planned
+	    downloads which it has to wait for."""
+	result = {}
+	for p in order:
+		pool_paths = set(f.pool_path for f in p.missing_files)
+		result[p] = set(i for i, (q, files) in enumerate(plan)
+		                if pool_paths.intersection(f.pool_path for f in files))
+	return result
+
+
+def install_ready(order, packages, waits, done, failed, skipped):
+	""" Install the packages at the start of order (which is in dependency
+	    order) whose planned downloads are done. Packages which can not be
+	    installed, because they are in skipped already or planned downloads
+	    they (or their dependencies) wait for failed, are moved from order
+	    to skipped."""
+	while order:
+		p = order[0]
+		if p in skipped or waits[p] & failed or skipped.intersection(p.dependencies):
+			log.error('Not installing%s %s, because downloading its files failed.', '' if p in packages else ' dependency', p.name)
+			skipped.add(p)
+		elif waits[p] <= done:
+			log.info('Installing%s: %s', '' if p in packages else ' dependency', p.name)
+			p.install()
+		else:
+			return
+		order.pop(0)
+
+
+def install_many(packages):
+	""" Install packages and their dependencies using a pipeline:
+
+	    1. the .sdp files of all packages are fetched concurrently,
+	    2. the missing pool files of all packages are downloaded using as few
+	       requests as possible, PIPELINE_DEPTH packages at a time, so that
+	       network transfers overlap verification and pool writes,
+	    3. meanwhile, packages are installed in dependency order as soon as
+	       all their pool files are available.
+
+	    Packages whose files (or whose dependencies' files) failed to
+	    download are not installed, and the first download error is raised
+	    once all downloads have finished."""
+	if dry_run:
+		return show_plan(packages)
+	if event_loop:
+		return install_many_event_loop(packages)
+
+	for p in packages:
+		if p and p.installed:
 			log.info('Already installed: %s', p.name)
 
+	order = install_order(packages)
+	if not order:
+		return
+	parallel_map(lambda p: p.files, order, REFRESH_THREADS)
+	plan = plan_downloads(order)
+	waits = waiting_for(order, plan)
+
+	progress = ProgressGroup(ProgressBar())
+	finished = Queue()   # (plan index, succeeded) and finally None
+	errors = []
+
+	def download(i):
+		p, files = plan[i]
+		try:
+			log.info('Downloading %d files for: %s', len(files), p.name)
+			p.download_files(files, progress.part())
+		except Exception:
+			errors.append(sys.exc_info())
+			finished.put((i, False))
+		else:
+			finished.put((i, True))
+
+	def download_all():
+		try:
+			parallel_map(download, range(len(plan)), PIPELINE_DEPTH)
+		finally:
+			finished.put(None)
+
+	thread = Thread(target = download_all)
+	thread.daemon = True
+	thread.start()
+
+	done = set()
+	failed = set()
+	skipped = set()
+	result = True
+	try:
+		install_ready(order, packages, waits, done, failed, skipped)
+		while result is not None:
+			try:
+				result = finished.get(True, 1)   # with timeout, so Ctrl+C works
+			except Empty:
+				continue
+			if result is not None:
+				i, succeeded = result
+				(done if succeeded else failed).add(i)
+				install_ready(order, packages, waits, done, failed, skipped)
+	finally:
+		# Let the downloads finish, also if installing a package failed.
+		while result is not None:
+			try:
+				result = finished.get(True, 1)
+			except Empty:
+				pass
+		thread.join()
+	if errors:
+		raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def show_plan(packages):
+	""" Show what install_many would download for packages, without
+	    downloading anything but the .sdp files of the packages.
+
+	    The compressed size of the pool files is only known once they are
+	    downloaded, so it is estimated from the compression ratio of the
+	    pool files which are available locally."""
+	order = install_order(packages)
+	if not order:
+		log.info('Nothing to do.')
+		return
+	parallel_map(lambda p: p.files, order, REFRESH_THREADS)
+	plan = dict((p, files) for p, files in plan_downloads(order, seed = False))
+	ratio = compression_ratio(order)
+
+	def megabytes(size):
+		return '%.2f MB' % (size / (1024.*1024.))
+
+	def estimate(size):
+		if ratio is None:
+			return '?'
+		return megabytes(size * ratio)
+
+	ui.output_header('%-40s %8s %14s %14s' % ('Packages to install:', 'files', 'uncompressed', 'download (est)'))
+	total_files = 0
+	total_size = 0
+	for p in order:
+		# Pool files shared by multiple packages are counted once.
+		files = dict((f.pool_path, f) for f in plan.get(p, [])).values()
+		size = sum(f.size for f in files)
+		total_files += len(files)
+		total_size += size
+		name = p.name + ('' if p in packages else ' (dependency)')
+		ui.output_detail('  %-38s %8d %14s %14s' % (name, len(files), megabytes(size), estimate(size)))
+	ui.output_detail('  %-38s %8d %14s %14s' % ('Total', total_files, megabytes(total_size), estimate(total_size)))
+
+
+def install_many_event_loop(packages, downloader = None):
+	""" Install packages and their dependencies like install_many, but
+	    perform all requests concurrently from a single thread, using an
+	    event loop instead of a pool of threads:
+
+	    1. the .sdp files of all packages are fetched concurrently,
+	    2. all planned streamer.cgi requests are made concurrently, and each
+	       response is written into the pool while it arrives,
+	    3. packages are installed in dependency order as soon as all their
+	       pool files are available.
+
+	    Requests which fail are retried by Package.download_files once the
+	    event loop is done, so the other requests are not held up. Failures
+	    are handled like in install_many: errors are collected per package,
+	    and the first one is raised at the end."""
+	for p in packages:
+		if p and p.installed:
+			log.info('Already installed: %s', p.name)
+
+	order = install_order(packages)
+	if not order:
+		return
+	loop = downloader or AsyncDownloader(os.path.join(content_dir, 'downloader.cfg'))
+	try:
+		install_with_event_loop(order, packages, loop)
+	finally:
+		# Do not leave connections behind if anything went wrong.
+		loop.close()
+
+
+def install_with_event_loop(order, packages, loop):
+	""" Install the packages in order (see install_order) using loop."""
+	done = set()
+	failed = set()
+	skipped = set()   # packages which can not be installed
+	errors = []
+
+	# Packages whose .sdp can not be downloaded are not installed.
+	sdp_requests = {}
+	for p in order:
+		try:
+			if not p.available:
+				sdp_requests[loop.onetime_get_request(p.sdp_url, p.cache_file)] = p
+		except Exception:
+			errors.append(sys.exc_info())
+			skipped.add(p)
+	for future in loop.as_completed(sdp_requests):
+		try:
+			future.result()
+		except Exception:
+			errors.append(sys.exc_info())
+			skipped.add(sdp_requests[future])
+	planned = [p for p in order if p not in skipped]
+	plan = plan_downloads(planned)
+	waits = waiting_for(planned, plan)
+	progress = ProgressGroup(ProgressBar())
+
+	def streamer_sink(files, part):
+		def open_sink(headers):
+			if not headers.has_key('Content-Length'):
+				raise StreamerFormatException('Content-Length')
+			part.setMaximum(int(headers['Content-Length']))
+			return StreamerWriter(files, part)
+		return open_sink
+
+	requests = {}
+	for i, (p, files) in enumerate(plan):
+		try:
+			# Files of packages in offline repositories can not be requested;
+			# let download_files raise the appropriate exception.
+			if not hasattr(p.repository, 'url'):
+				p.download_files(files)
+				done.add(i)
+				continue
+			# Each pool file is requested once, even if the .sdp contains it
+			# multiple times. (under different names)
+			unique = {}
+			for f in files:
+				unique.setdefault(f.pool_path, f)
+			files = [f for f in files if unique[f.pool_path] is f]
+			log.info('Downloading %d files for: %s', len(files), p.name)
+			part = progress.part()
+			url, data = p.streamer_request(files)
+			requests[loop.post(url, data, streamer_sink(files, part))] = (i, files, part)
+		except Exception:
+			errors.append(sys.exc_info())
+			failed.add(i)
+
+	retries = []
+	install_ready(order, packages, waits, done, failed, skipped)
+	for future in loop.as_completed(requests):
+		i, files, part = requests[future]
+		try:
+			future.result().finish()
+		except (StreamerFormatException, urllib2.URLError) as e:
+			log.warning('Download of %s failed (%s), retrying.', plan[i][0].name, e)
+			retries.append(requests[future])
+			continue
+		done.add(i)
+		install_ready(order, packages, waits, done, failed, skipped)
+	loop.commit()
+
+	for i, files, part in retries:
+		try:
+			plan[i][0].download_files([f for f in files if not f.available], part)
+		except Exception:
+			errors.append(sys.exc_info())
+			failed.add(i)
+		else:
+			done.add(i)
+		install_ready(order, packages, waits, done, failed, skipped)
+	if errors:
+		raise errors[0][0], errors[0][1], errors[0][2]
+
 
 def install(searchterm):
 	""" Install all packages matching searchterm."""
-	for name in ui.select('name', searchterm, [p.name for p in rapid.packages]):
-		install_single(rapid.packages[name])
+	# Select an exact name without loading all names if packages are lazy.
+	p = rapid.packages.lazy and rapid.packages.lookup(searchterm)
+	if p and p.name == searchterm:
+		return install_many([p])
+	names = ui.select('name', searchterm, [p.name for p in rapid.packages])
+	install_many([rapid.packages[name] for name in names])
 
 
 def uninstall_single(p):
@@ -140,14 +437,26 @@ def list_tags(searchterm, available):
 
 def upgrade():
 	""" Upgrade pinned tags."""
-	for tag in rapid.pinned_tags:
-		install_single(rapid.packages[tag])
+	# Fast path: nothing changed since the last upgrade.
+	if rapid.upgrade_is_noop():
+		log.info('All pinned tags are up to date.')
+		return
+	# Look up the pinned tags lazily if packages are lazy. (lookup returns
+	# None for tags which are not offered, indexing raises KeyError)
+	packages = [rapid.packages.lookup(tag) or rapid.packages[tag] for tag in rapid.pinned_tags]
+	install_many(packages)
+	if not dry_run:
+		rapid.save_upgrade_state(packages)
 
 
 def clean_upgrade():
 	""" Upgrade pinned tags and uninstall unpinned packages."""
+	if rapid.upgrade_is_noop(exact = True):
+		log.info('All pinned tags are up to date.')
+		return
 	upgrade()
-	uninstall_unpinned()
+	if not dry_run:
+		uninstall_unpinned()
 
 
 def uninstall_unpinned():
@@ -179,22 +488,27 @@ def uninstall_unpinned():
 
 
 def collect_pool():
-	""" Simple mark and sweep garbage collector. The root set consists of the
-	    installed packages. This touches only pool files."""
-	# Build set marked_files that should be kept.
-	installed_packages = [p for p in rapid.packages if p.installed]
-	marked_files = reduce(lambda x, y: x + y.files, installed_packages, [])
-	marked_files = set(f.pool_path for f in marked_files)
+	""" Simple reference counting garbage collector. The references are
+	    those of the packages installed in all data directories sharing the
+	    pool. This touches only pool files."""
+	# Set of md5s of the pool files that should be kept. If it is not known
+	# for any installed package, collecting anything could delete its files.
+	try:
+		live = rapid.live_md5s()
+	except PoolReferencesException as e:
+		log.error('Can not collect the pool, could not read %s', e)
+		return
 
 	def gc(really_remove):
-		# Remove all files not in marked_files.
+		# Remove all files which are not referenced. (including files whose
+		# name is not an md5, e.g. left over temporary files)
 		count = 0
 		size = 0
 		for i in range(0, 256):
 			d = os.path.join(pool_dir, '%02x' % i)
 			for f in os.listdir(d):
 				f = os.path.join(d, f)
-				if not f in marked_files:
+				if not pool_md5(f) in live:
 					count += 1
 					size += os.path.getsize(f)
 					if really_remove: os.unlink(f)
@@ -215,9 +529,38 @@ def collect_pool():
 		return
 
 	count, size = gc(True)
+	pool_snapshot.invalidate()
 	log.info('%.2f megabytes / %d files deleted from the pool.', size / (1024.*1024.), count)
 
 
+def why(poolfile):
+	""" Show which installed packages reference a pool file, given as its
+	    path or md5."""
+	md5 = pool_md5(poolfile.strip())
+	if md5 is None:
+		log.error('Not a pool file: %s', poolfile)
+		return
+	references = rapid.why(md5)
+	if not references:
+		ui.output_header('No installed package uses %s.' % poolfile)
+		return
+	ui.output_header('Installed packages using %s:' % poolfile)
+	for data_dir, hex, name in sorted(references):
+		ui.output_detail('  %-40s (%s)' % (name, data_dir))
+
+
+def serve(port):
+	""" Serve the repositories, packages and pool files of this data
+	    directory over HTTP, for use as mirror by other rapid clients."""
+	server = MirrorServer(rapid, ('', int(port or MIRROR_PORT)))
+	# Load the repository list before any requests come in.
+	log.info('Mirroring %d repositories on port %d.', len(rapid.repositories), server.server_address[1])
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+
+
 def make_sdd(package, path):
 	""" Extract all files for a single package from the pool and put them in
 	    a newly created .sdd package."""
@@ -1,35 +1,93 @@
 #!/usr/bin/env python
 # Copyright (C) 2010 Tobi Vollebregt
 
+from array import array
 from bitarray import bitarray
 from contextlib import closing
 from hashlib import md5
 from urlparse import urlparse
 from StringIO import StringIO
-import binascii, gzip, os, shutil, struct, weakref
-import ConfigParser
+import binascii, errno, gzip, heapq, marshal, os, shutil, socket, struct, threading, time, zlib
+import ConfigParser, httplib, logging, urllib2
 
-from util.downloader import Downloader, atomic_write
+from util.atomic import atomic_rename, atomic_write, temp_name
+from util.downloader import Downloader, atomic_writer
+from util.index import PackageIndex
+from util.trigram import TrigramIndex
+from util.metadata import FileLock
+from util.workers import parallel_map
+
+log = logging.getLogger('root')
 
 # rapid hits the servers at worst once every..
 MASTER_RATE_LIMIT = 60 * 60     # ..one hour
 REPOSITORY_RATE_LIMIT = 5 * 60  # ..five minutes  
 
+# repositories are refreshed concurrently using at most..
+REFRESH_THREADS = 8             # ..this many threads in total and..
+REFRESH_THREADS_PER_HOST = 2    # ..this many threads per host
+
+# streamer.cgi responses are processed in chunks of this many bytes
+STREAMER_CHUNK_SIZE = 64 * 1024
+
+# streamer.cgi requests are not split into shards smaller than this
+STREAMER_MIN_SHARD_SIZE = 16 * 1024 * 1024
+
+# the compression ratio of pool files is estimated from at most this many files
+COMPRESSION_SAMPLE_SIZE = 256
+
+# the installed packages (pool files) are listed again if package_dir (the
+# pool directory) was modified, which is checked at most once every this many
+# seconds
+SNAPSHOT_TTL = 1
+
+# version of the format of the parsed versions.gz cache (versions.cache)
+VERSIONS_CACHE_VERSION = 1
+
+# version of the format of the decoded .sdp cache (<hex>.sdp.manifest)
+MANIFEST_VERSION = 2
+
+# interrupted downloads are retried this many times, first after
+# STREAMER_RETRY_DELAY seconds, and doubling the delay each retry
+STREAMER_RETRIES = 3
+STREAMER_RETRY_DELAY = 1
+
 ################################################################################
 
 # content_dir : Storage for temporary files (repos.gz, versions.gz)
+# state_dir   : Storage for the state of a data directory (pinned tags)
 # spring_dir  : Spring data directory
 # pool_dir    : Where pool files are stored (visible to Spring)
 # package_dir : Where package files are stored (visible to Spring)
 
 master_url = 'http://repos.springrts.com/repos.gz'
 
-def set_spring_dir(path):
-	global spring_dir, pool_dir, package_dir, content_dir
+# URL of a mirror (see `rapid serve') which is preferred over master_url and
+# the upstream repositories, e.g. 'http://mirror:8080'.
+mirror_url = None
+
+# Number of concurrent streamer.cgi requests used to download a package.
+streamer_shards = 1
+
+# Pool directories (e.g. of other Spring installations) which are searched
+# for missing pool files before downloading them.
+seed_pools = []
+
+# Look up packages by exact name or tag in the repositories which offered
+# them when all packages were last loaded, instead of loading all packages.
+lazy_packages = False
+
+def set_spring_dir(path, shared_dir = None):
+	""" Set the Spring data directory. If shared_dir is given, the pool and
+	    the temporary files are stored there instead, so they can be shared
+	    by many data directories."""
+	global spring_dir, pool_dir, package_dir, content_dir, state_dir
 	spring_dir = path
-	pool_dir = os.path.join(spring_dir, 'pool')
 	package_dir = os.path.join(spring_dir, 'packages')
-	content_dir = os.path.join(spring_dir, 'rapid')
+	state_dir = os.path.join(spring_dir, 'rapid')
+	shared_dir = shared_dir or spring_dir
+	pool_dir = os.path.join(shared_dir, 'pool')
+	content_dir = os.path.join(shared_dir, 'rapid')
 
 ################################################################################
 
@@ -41,7 +99,11 @@ def mkdir(path):
 def mkdir_p(path):
 	""" Create directories if they do not exist yet. """
 	if not os.path.exists(path):
-		os.makedirs(path)
+		try:
+			os.makedirs(path)
+		except OSError:
+			if not os.path.isdir(path):   # else it was created concurrently
+				raise
 
 def psv(s):
 	""" Split pipe separated value string into list of non-empty components."""
@@ -54,6 +116,190 @@ def gzip_string(s):
 		f.write(s)
 	return fileobj.getvalue()
 
+
+class GzipMd5(object):
+	""" Incrementally calculates the md5 digest of the decompressed contents
+	    of gzipped data, which may be fed in chunks of any size. Memory usage
+	    is bounded by STREAMER_CHUNK_SIZE, regardless of the compression ratio."""
+	def __init__(self):
+		self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		self.__md5 = md5()
+
+	def update(self, data):
+		while data:
+			self.__md5.update(self.__decompressor.decompress(data, STREAMER_CHUNK_SIZE))
+			data = self.__decompressor.unconsumed_tail
+			if self.__decompressor.unused_data:
+				# Like gzip.GzipFile, continue with the next gzip member.
+				data = self.__decompressor.unused_data
+				self.__decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+	def digest(self):
+		self.__md5.update(self.__decompressor.flush())
+		return self.__md5.digest()
+
+
+class StreamerWriter(object):
+	""" File-like object into which a streamer.cgi response containing files
+	    (in the order in which they occur in the .sdp) is written in chunks of
+	    any size, e.g. by an event loop. Like Package.receive_files, it writes
+	    each pool file into the pool while it arrives, checking the md5 hash
+	    on the fly, and commits it as soon as it is complete.
+
+	    close() discards a partially received pool file. finish() raises
+	    StreamerFormatException unless all files have been received."""
+	def __init__(self, files, progress = None):
+		self.__files = list(files)
+		self.__progress = progress
+		self.__size = ''         # big endian int32 preceding each file
+		self.__remaining = 0     # bytes of the current file not received yet
+		self.__target = None     # temporary file of the current file
+		self.__checksum = None
+
+	def write(self, data):
+		while data:
+			if not self.__target:
+				if not self.__files:
+					raise StreamerFormatException('data')
+				n = 4 - len(self.__size)
+				self.__size += data[:n]
+				self.__report(len(data[:n]))
+				data = data[n:]
+				if len(self.__size) < 4:
+					return
+				self.__remaining = struct.unpack('>L', self.__size)[0]
+				self.__size = ''
+				self.__open()
+				if self.__remaining == 0:
+					self.__commit()
+				continue
+
+			chunk = data[:self.__remaining]
+			data = data[len(chunk):]
+			self.__target.write(chunk)
+			try:
+				self.__checksum.update(chunk)
+			except zlib.error:
+				raise StreamerFormatException('md5')
+			self.__remaining -= len(chunk)
+			self.__report(len(chunk))
+			if self.__remaining == 0:
+				self.__commit()
+
+	def __report(self, value):
+		if self.__progress and value:
+			self.__progress(value)
+
+	def __open(self):
+		f = self.__files[0]
+		mkdir_p(os.path.dirname(f.pool_path))
+		self.__target = open(temp_name(f.pool_path), 'wb')
+		self.__checksum = GzipMd5()
+
+	def __commit(self):
+		f = self.__files.pop(0)
+		self.__target.close()
+		self.__target = None
+		if self.__checksum.digest() != f.md5:
+			os.remove(temp_name(f.pool_path))
+			raise StreamerFormatException('md5')
+		atomic_rename(temp_name(f.pool_path), f.pool_path)
+		pool_snapshot.add(f.md5)
+
+	def close(self):
+		if self.__target:
+			self.__target.close()
+			self.__target = None
+			os.remove(temp_name(self.__files[0].pool_path))
+
+	def finish(self):
+		if self.__files or self.__size:
+			raise StreamerFormatException('size')
+
+
+class SynchronizedProgress(object):
+	""" Wraps a progress object so it can be shared between threads.
+	    Keeps track of the total progress reported in value."""
+	def __init__(self, progress):
+		self.__progress = progress
+		self.__lock = threading.Lock()
+		self.value = 0
+
+	def __call__(self, value):
+		with self.__lock:
+			self.value += value
+			self.__progress(value)
+
+	def setMaximum(self, value):
+		with self.__lock:
+			self.__progress.setMaximum(value)
+
+	def maximum(self):
+		with self.__lock:
+			return self.__progress.maximum()
+
+
+class ProgressGroup(object):
+	""" Combines the progress of several concurrent operations, each of which
+	    reports to its own part(), into a single progress object."""
+	def __init__(self, progress):
+		self.__progress = progress
+		self.__lock = threading.Lock()
+		self.__maximum = 0
+
+	def part(self):
+		""" Return a new progress object for a single operation."""
+		return ProgressPart(self)
+
+	def add(self, value):
+		with self.__lock:
+			self.__progress(value)
+
+	def add_maximum(self, value):
+		with self.__lock:
+			self.__maximum += value
+			self.__progress.setMaximum(self.__maximum)
+
+
+class ProgressPart(object):
+	""" Progress object for a single operation in a ProgressGroup."""
+	def __init__(self, group):
+		self.__group = group
+		self.__maximum = 0
+
+	def __call__(self, value):
+		self.__group.add(value)
+
+	def setMaximum(self, value):
+		self.__group.add_maximum(value - self.__maximum)
+		self.__maximum = value
+
+	def maximum(self):
+		return self.__maximum
+
+
+def balanced_shards(files, n):
+	""" Split files into at most n lists of roughly equal total size, each
+	    preserving the order of files. Shards are not made smaller than
+	    STREAMER_MIN_SHARD_SIZE."""
+	total = sum(f.size for f in files)
+	n = max(1, min(n, len(files), total // STREAMER_MIN_SHARD_SIZE))
+	if n == 1:
+		return [list(files)]
+
+	# Greedily assign the largest remaining file to the smallest shard.
+	heap = [(0, i) for i in range(n)]
+	shard_of = {}
+	for f in sorted(files, key = lambda f: f.size, reverse = True):
+		size, i = heapq.heappop(heap)
+		shard_of[f] = i
+		heapq.heappush(heap, (size + f.size, i))
+
+	shards = [[] for i in range(n)]
+	for f in files:
+		shards[shard_of[f]].append(f)
+	return [x for x in shards if x]
+
 ################################################################################
 
 class RapidException(Exception):
@@ -91,6 +337,28 @@ class DetachedPackageException(RapidException):
 	pass
 
 
+class PoolReferencesException(RapidException):
+	""" Raised when the pool files used by the installed packages are not
+	    known, because an installed package can not be read."""
+	def __init__(self, filename, error):
+		self.filename = filename
+		self.error = error
+
+	def __str__(self):
+		return '%s: %s' % (self.filename, self.error)
+
+
+class PoolDirectoryException(RapidException):
+	""" Raised when the pool directory of the data directory is not the
+	    shared pool directory, and can not be made into a link to it."""
+	def __init__(self, path, pool):
+		self.path = path
+		self.pool = pool
+
+	def __str__(self):
+		return '%s is not the shared pool %s, please move its contents there and replace it by a link.' % (self.path, self.pool)
+
+
 class DependencyException(RapidException):
 	""" Raised when install/uninstall fails because of dependencies."""
 	pass
@@ -108,16 +376,48 @@ class RepositorySource(object):
 		""" Download and return list of repositories."""
 
 		# Collect OnlineRepositories
-		self.downloader.conditional_get_request(master_url, self.repos_gz, MASTER_RATE_LIMIT)
+		mirror = self.fetch_repos_gz()
 		with closing(gzip.open(self.repos_gz)) as f:
-			unique = set(x.split(',')[1] for x in f)
-			self.__repositories = [OnlineRepository(os.path.join(self.cache_dir, urlparse(x).netloc), self.downloader, x) for x in unique]
+			# sorted, so the order in which packages are merged is deterministic
+			unique = sorted(set(x.split(',')[1] for x in f))
+			repositories = [OnlineRepository(os.path.join(self.cache_dir, urlparse(x).netloc), self.downloader, self.mirrored_url(x, mirror)) for x in unique]
 
 		# Collect OfflineRepositories
 		for dirent in os.listdir(self.cache_dir):
 			path = os.path.join(self.cache_dir, dirent)
-			if os.path.isdir(path) and path not in (r.cache_dir for r in self.__repositories):
-				self.__repositories.append(OfflineRepository(path))
+			if os.path.isdir(path) and path not in (r.cache_dir for r in repositories):
+				repositories.append(OfflineRepository(path))
+
+		# Replace the list at once, the mirror server reads it concurrently.
+		self.__repositories = repositories
+
+	def fetch_repos_gz(self):
+		""" Download repos.gz from the mirror, or from master_url if there is
+		    no mirror or it is unreachable. Return the mirror URL or None."""
+		if mirror_url:
+			try:
+				self.downloader.conditional_get_request(mirror_url.rstrip('/') + '/repos.gz', self.repos_gz, MASTER_RATE_LIMIT)
+				return mirror_url.rstrip('/')
+			except urllib2.URLError as e:
+				log.warning('Mirror %s unavailable (%s), using %s instead.', mirror_url, e, master_url)
+		self.downloader.conditional_get_request(master_url, self.repos_gz, MASTER_RATE_LIMIT)
+		return None
+
+	def mirrored_url(self, url, mirror):
+		""" Return the URL of repository url on mirror."""
+		if mirror:
+			return mirror + '/' + url.split('://', 1)[-1].rstrip('/')
+		return url
+
+	def refresh(self):
+		""" Refresh versions.gz of all repositories concurrently."""
+		def host(r):
+			return urlparse(getattr(r, 'url', '')).netloc
+		try:
+			parallel_map(lambda r: r.refresh(), self.list, REFRESH_THREADS, host, REFRESH_THREADS_PER_HOST)
+		finally:
+			# Store the ETags of all repositories at once.
+			self.downloader.commit()
 
 	@property
 	def list(self):
@@ -139,47 +439,235 @@ class RepositorySource(object):
 ################################################################################
 
 class PackageSource(object):
+	""" The packages offered by all repositories.
+
+	    Loading them requires parsing packages.gz and versions.gz of every
+	    repository. The result is stored in a PackageIndex as well, which is
+	    used instead (looking up packages lazily) until any of these files
+	    changes.
+
+	    If lazy is true, packages looked up by exact name or tag using
+	    lookup() are loaded from the repository which offered them at the
+	    last load, using the map in packages.map, so only that repository
+	    (and the repositories of the dependencies) is refreshed and parsed.
+	    Such packages do not know their reverse dependencies, so they are
+	    never returned by indexing or iteration."""
+
 	def __init__(self, cache_dir, repositories):
 		self.__packages_dict = None
 		self.__packages_list = None
 		self.__tags = None
+		self.__index = None
+		self.__index_checked = False
+		self.__indexed_packages = {}    # package number -> IndexedPackage
+		self.__search_index = None
+		self.__search_index_checked = False
+		self.__repository_map = None
+		self.__lazy_packages = {}       # name or tag -> Package
 		self.cache_dir = cache_dir
 		self.repositories = repositories
 		self.packages_gz = os.path.join(cache_dir, 'packages.gz')
+		self.index_file = os.path.join(cache_dir, 'packages.idx')
+		self.search_index_file = os.path.join(cache_dir, 'packages.tri')
+		self.map_file = os.path.join(cache_dir, 'packages.map')
+		self.lazy = lazy_packages
 
 	def read_packages_gz(self):
 		""" Reads global packages.gz into a dictionary of Packages.
 
 			Contrary to versions.gz, packages.gz:
-			- is normalised (i.e. every package occurs only once),
+			- is normalised (i.e. every package occurs only once, but lines
+			  appended by write_packages_gz override earlier lines),
 			- does not support '|' characters in tags (tags are '|' separated)
 		"""
-		def read_line(line):
-			row = line[:-1].split(',')
-			return (row[3], Package(tags         = psv(row[0]), hex  = row[1],
-			                        dependencies = psv(row[2]), name = row[3]))
+		packages = {}
+		self.__packages_gz_lines = {}   # name -> line, as in packages.gz
+		self.__packages_gz_length = 0   # number of lines in packages.gz
 
 		if os.path.exists(self.packages_gz):
 			with closing(gzip.open(self.packages_gz)) as f:
-				return dict(map(read_line, f))
-		return {}
+				for line in f:
+					row = line[:-1].split(',')
+					packages[row[3]] = Package(tags         = psv(row[0]), hex  = row[1],
+					                           dependencies = psv(row[2]), name = row[3])
+					self.__packages_gz_lines[row[3]] = line
+					self.__packages_gz_length += 1
+		return packages
 
 	def write_packages_gz(self):
-		# Write to temporary file
-		tempfile = self.packages_gz + '.tmp'
-		with closing(gzip.open(tempfile, 'wb')) as f:
-			for p in self:
-				# tags, hex, dependencies, name
-				f.write(','.join(['|'.join(p.tags), p.hex, '|'.join(p.dependencies), p.name]) + '\n')
-
-		# Commit by moving temporary file over packages.gz
-		if os.path.exists(tempfile):
-			if os.path.exists(self.packages_gz):
-				os.remove(self.packages_gz)
-			os.rename(tempfile, self.packages_gz)
+		""" Write the packages to packages.gz, if they changed since it was
+		    read. If few packages changed, a gzip member containing only the
+		    changed packages is appended instead of rewriting all packages."""
+		# tags, hex, dependencies, name
+		# (dependencies may have been resolved already if load() is repeated)
+		lines = dict((p.name, ','.join(['|'.join(sorted(p.tags)), p.hex, '|'.join(sorted(map(str, p.dependencies))), p.name]) + '\n')
+		             for p in self)
+		changed = [line for name, line in sorted(lines.iteritems()) if self.__packages_gz_lines.get(name) != line]
+		removed = set(self.__packages_gz_lines) - set(lines)
+		if not changed and not removed:
+			return
+
+		# Rewrite everything when more than half of the file would be outdated.
+		append = (not removed and os.path.exists(self.packages_gz) and
+		          self.__packages_gz_length + len(changed) <= 2 * len(lines))
+		with atomic_writer(self.packages_gz) as target:
+			if append:
+				with open(self.packages_gz, 'rb') as source:
+					shutil.copyfileobj(source, target)
+			else:
+				changed = [line for name, line in sorted(lines.iteritems())]
+			with closing(gzip.GzipFile(self.packages_gz, 'wb', fileobj = target)) as f:
+				f.writelines(changed)
+
+		self.__packages_gz_lines = lines
+		self.__packages_gz_length = len(changed) + (self.__packages_gz_length if append else 0)
+
+	def signature(self):
+		""" Return a string identifying the state of all files load() reads."""
+		files = [self.packages_gz, self.repositories.repos_gz] + [r.versions_gz for r in self.repositories]
+		def stat(filename):
+			try:
+				st = os.stat(filename)
+				return '%s:%r:%d' % (filename, st.st_mtime, st.st_size)
+			except OSError:
+				return filename + ':-'
+		return '\n'.join(stat(x) for x in files)
+
+	@property
+	def index(self):
+		""" Return the package index if it is up to date and the packages
+		    have not been loaded otherwise, else None."""
+		if not self.__index_checked and self.__packages_dict is None:
+			self.__index_checked = True
+			self.repositories.refresh()
+			self.__index = PackageIndex.open(self.index_file, self.signature())
+		return self.__index
+
+	def __indexed_package(self, number):
+		if number not in self.__indexed_packages:
+			hex, name, tags, dependencies, reverse_dependencies, repository = self.index.record(number)
+			repository = [r for r in self.repositories if r.cache_dir == repository] if repository else []
+			self.__indexed_packages[number] = IndexedPackage(self, hex, name, dependencies,
+				reverse_dependencies, tags, repository[0] if repository else None)
+		return self.__indexed_packages[number]
+
+	def write_index(self):
+		""" Write the loaded packages to the package index."""
+		repositories = [r.cache_dir for r in self.repositories]
+		numbers = dict((p, i) for i, p in enumerate(self.__packages_list))
+		records = [(p.hex, p.name, p.tags, [d.name for d in p.dependencies],
+		            [r.name for r in p.reverse_dependencies],
+		            repositories.index(p.repository.cache_dir) if p.repository else None)
+		           for p in self.__packages_list]
+		keys = [(key, numbers[p], key in self.__tags)
+		        for key, p in self.__packages_dict.iteritems() if isinstance(key, basestring)]
+		PackageIndex.write(self.index_file, self.signature(), repositories, records, keys)
+		self.__search_index = TrigramIndex(sorted(key for key, number, is_tag in keys))
+		self.__search_index.write(self.search_index_file, self.signature())
+		self.__search_index_checked = True
+
+	@property
+	def search_index(self):
+		""" Return the TrigramIndex of all names and tags if it matches the
+		    files on disk, else None. The repositories are not refreshed."""
+		if not self.__search_index_checked:
+			self.__search_index_checked = True
+			self.__search_index = TrigramIndex.open(self.search_index_file, self.signature())
+		return self.__search_index
+
+	def candidates(self, needle, haystack, regex = False):
+		""" Return the items of haystack which may contain needle, or match
+		    the regular expression needle if regex is true, using the search
+		    index to avoid matching all of them.
+
+		    Only the packages and the tags are narrowed down. Other haystacks
+		    (e.g. the pinned tags) are returned as they are, because the
+		    search index is not worth opening (or making) for them."""
+		if haystack is not self and haystack is not self.__tags:
+			return haystack
+		index = self.search_index
+		if not index:
+			return haystack
+		keys = index.regex_candidates(needle) if regex else index.search(needle)
+		if haystack is self:
+			# str() of a package is its name, but keys are tags too.
+			return list(set(self[key] for key in keys))
+		# All tags of the packages are in the search index.
+		return [key for key in keys if key in haystack]
+
+	def write_repository_map(self):
+		""" Write the map from name or tag to (repository, name) of the
+		    loaded packages, which is used by lazy lookups."""
+		repository_map = dict((key, (p.repository.cache_dir, p.name)) for key, p in self.__packages_dict.iteritems()
+		                      if isinstance(key, basestring) and p.repository)
+		with atomic_writer(self.map_file) as f:
+			marshal.dump(repository_map, f)
+		self.__repository_map = repository_map
+
+	def read_repository_map(self):
+		if self.__repository_map is None:
+			try:
+				with open(self.map_file, 'rb') as f:
+					self.__repository_map = marshal.load(f)
+			except (IOError, EOFError, ValueError, TypeError):
+				self.__repository_map = {}
+		return self.__repository_map
+
+	def __lazy_lookup(self, key):
+		""" Return the package with name or tag key, loading only the
+		    repositories needed for it and its dependencies, or None if it
+		    is not in the repository it was in at the last load. Reverse
+		    dependencies of these packages are not known."""
+		if key in self.__lazy_packages:
+			return self.__lazy_packages[key]
+		cache_dir, name = self.read_repository_map().get(key, (None, None))
+		repository = [r for r in self.repositories if r.cache_dir == cache_dir]
+		if not repository or name not in repository[0].packages:
+			return None
+		offered = repository[0].packages[name]
+		if key != name and key not in offered.tags:
+			return None
+
+		p = Package(offered.hex, name, [], offered.tags, repository[0])
+		self.__lazy_packages[key] = self.__lazy_packages[name] = p
+		# Like load(), discard dependencies which were missing at the last load.
+		for d in offered.dependencies:
+			if d in self.read_repository_map():
+				d = self.__lazy_lookup(d)
+				if d is None:
+					self.__lazy_packages.pop(key, None)
+					self.__lazy_packages.pop(name, None)
+					return None
+				p.dependencies.append(d)
+		return p
+
+	def lookup(self, key):
+		""" Return the package with name or tag key, or None. If lazy is
+		    true and the packages have not been loaded, the package is
+		    looked up lazily, which means its reverse dependencies are not
+		    known and it is not identical to the package returned by
+		    __getitem__."""
+		if self.lazy and self.__packages_dict is None and isinstance(key, basestring):
+			p = self.__lazy_lookup(key)
+			if p:
+				return p
+		try:
+			return self[key]
+		except KeyError:
+			return None
 
 	def load(self):
+		if self.__index:
+			self.__index.close()
+		self.__index = None
+		self.__index_checked = True
+		self.__indexed_packages = {}
+		self.__search_index = None
+		self.__search_index_checked = False
+
 		self.__packages_dict = self.read_packages_gz()
+		# Refresh all repositories concurrently, then merge them serially.
+		self.repositories.refresh()
 		# FIXME: this is broken if a package is in repo1 with tag1 and in repo2 with tag2
 		for r in self.repositories:
 			self.__packages_dict.update(r.packages)
@@ -211,27 +699,60 @@ class PackageSource(object):
 		# Make __getitem__ idempotent.
 		self.__packages_dict.update((p, p) for p in self)
 
+		self.write_index()
+		self.write_repository_map()
+
 	@property
 	def list(self):
-		if not self.__packages_list: self.load()
+		if not self.__packages_list:
+			if self.index:
+				self.__packages_list = [self.__indexed_package(i) for i in xrange(len(self.index))]
+			else:
+				self.load()
 		return self.__packages_list
 
 	@property
 	def dict(self):
-		if not self.__packages_dict: self.load()
+		if not self.__packages_dict:
+			if self.index:
+				return dict([(key, self.__indexed_package(number)) for key, number, is_tag in self.index.keys()] +
+				            [(p, p) for p in self.list])
+			self.load()
 		return self.__packages_dict
 
 	@property
 	def tags(self):
-		if not self.__tags: self.load()
+		if not self.__tags:
+			if self.index:
+				self.__tags = set(self.index.tags())
+			else:
+				self.load()
 		return self.__tags
 
+	def __find(self, key):
+		""" Return the package number of key in the index, or None."""
+		if isinstance(key, Package):
+			number = self.index.find(key.name)
+			if number is not None and self.__indexed_package(number) is key:
+				return number
+			return None
+		if isinstance(key, basestring):
+			return self.index.find(key)
+		return None
+
 	def __getitem__(self, key):
 		if type(key) in (int, slice):
 			return self.list[key]
+		if self.index:
+			number = self.__find(key)
+			if number is None:
+				raise KeyError(key)
+			return self.__indexed_package(number)
 		return self.dict[key]
 
 	def __contains__(self, key):
+		if self.index:
+			return self.__find(key) is not None
 		return key in self.dict
 
 	def __len__(self):
@@ -244,7 +765,7 @@ class PackageSource(object):
 
 class PinnedTags(object):
 	def __init__(self):
-		self.__config_path = os.path.join(content_dir, 'main.cfg')
+		self.__config_path = os.path.join(state_dir, 'main.cfg')
 		self.__config = ConfigParser.RawConfigParser()
 		self.__config.read(self.__config_path)
 		self.__pinned_tags = set()
@@ -292,19 +813,56 @@ class PinnedTags(object):
 class Rapid(object):
 	def __init__(self, downloader = None):
 		mkdir(spring_dir)
-		mkdir(content_dir)
+		mkdir_p(content_dir)
+		mkdir(state_dir)
 		mkdir(package_dir)
 
 		if not os.path.exists(pool_dir):
-			os.mkdir(pool_dir)
 			for i in range(0, 256):
-				os.mkdir(os.path.join(pool_dir, '%02x' % i))
+				mkdir_p(os.path.join(pool_dir, '%02x' % i))
+
+		self.__link_pool()
+
+		self.__data_dirs_path = os.path.join(content_dir, 'data_dirs')
+		self.__register()
+		installed_snapshot.invalidate()
+		pool_snapshot.invalidate()
+		self.__upgrade_state_path = os.path.join(state_dir, 'upgrade.state')
 
 		self.__downloader = downloader or Downloader(os.path.join(content_dir, 'downloader.cfg'))
 		self.__repositories = RepositorySource(content_dir, self.__downloader)
 		self.__packages = PackageSource(content_dir, self.__repositories)
 		self.__pinned_tags = PinnedTags()
 
+	def __link_pool(self):
+		""" Make a shared pool visible to Spring, by linking it into the data
+		    directory. Pool files in a pool directory which the data directory
+		    used before it shared the pool are moved into the shared pool."""
+		spring_pool_dir = os.path.join(spring_dir, 'pool')
+		if os.path.realpath(spring_pool_dir) == os.path.realpath(pool_dir):
+			return
+		if not hasattr(os, 'symlink'):
+			if os.path.lexists(spring_pool_dir):
+				raise PoolDirectoryException(spring_pool_dir, pool_dir)
+			log.warning('Spring can not find pool files in %s, link it to %s.', pool_dir, spring_pool_dir)
+			return
+		if os.path.islink(spring_pool_dir) or (os.path.lexists(spring_pool_dir) and not os.path.isdir(spring_pool_dir)):
+			# Possibly a link to another shared pool, which may be in use.
+			raise PoolDirectoryException(spring_pool_dir, pool_dir)
+
+		if os.path.isdir(spring_pool_dir):
+			count = 0
+			for source, target in walk_pool(spring_pool_dir, pool_dir):
+				if not os.path.exists(target):
+					mkdir_p(os.path.dirname(target))
+					move_file(source, target)
+					count += 1
+				else:
+					os.remove(source)
+			shutil.rmtree(spring_pool_dir)
+			log.info('Moved %d pool files from %s to %s.', count, spring_pool_dir, pool_dir)
+		os.symlink(os.path.abspath(pool_dir), spring_pool_dir)
+
 	@property
 	def repositories(self):
 		return self.__repositories
@@ -321,14 +879,91 @@ class Rapid(object):
 	def pinned_tags(self):
 		return self.__pinned_tags
 
+	def __read_data_dirs(self):
+		if os.path.exists(self.__data_dirs_path):
+			with open(self.__data_dirs_path) as f:
+				return [line.rstrip('\n') for line in f if line.strip()]
+		return []
+
+	def __register(self):
+		""" Register spring_dir as one of the data directories sharing the
+		    pool, so its packages are taken into account by live_pool_paths."""
+		path = os.path.abspath(spring_dir)
+		with FileLock(self.__data_dirs_path + '.lock'):
+			data_dirs = self.__read_data_dirs()
+			if path not in data_dirs:
+				atomic_write(self.__data_dirs_path, ''.join(d + '\n' for d in data_dirs + [path]))
+
+	@property
+	def data_dirs(self):
+		""" Return the (existing) data directories sharing the pool."""
+		return [d for d in self.__read_data_dirs() if os.path.isdir(d)]
+
+	def live_md5s(self):
+		""" Return the set of md5s of the pool files used by the packages
+		    installed in any of the data directories sharing the pool.
+		    Raises PoolReferencesException if this is not known for any of
+		    the installed packages."""
+		live = set()
+		for d in self.data_dirs:
+			live.update(PoolReferences.open(d).referenced())
+		return live
+
+	def live_pool_paths(self):
+		""" Return the set of pool files used by the packages installed in
+		    any of the data directories sharing the pool."""
+		return set(pool_path(md5) for md5 in self.live_md5s())
+
+	def why(self, md5):
+		""" Return a list of (data directory, hex, name) of the installed
+		    packages which reference the pool file with md5."""
+		return [(d, hex, name) for d in self.data_dirs for hex, name in PoolReferences.open(d).why(md5)]
+
+	def upgrade_is_noop(self, exact = False):
+		""" Return true iff upgrading the pinned tags would not install
+		    anything. This only refreshes the repositories and compares the
+		    result with the state saved by save_upgrade_state; the packages
+		    are not loaded. If exact is true, additionally require that no
+		    other packages are installed."""
+		try:
+			with open(self.__upgrade_state_path, 'rb') as f:
+				signature, tags, hexes = marshal.load(f)
+		except (IOError, EOFError, ValueError, TypeError):
+			return False
+		if set(tags) != set(self.pinned_tags):
+			return False
+		self.repositories.refresh()
+		if signature != self.packages.signature():
+			return False
+		installed = installed_snapshot.hexes
+		return installed == set(hexes) if exact else installed.issuperset(hexes)
+
+	def save_upgrade_state(self, packages):
+		""" Save the state used by upgrade_is_noop, after packages (the
+		    packages of the pinned tags) have been installed. Nothing is saved
+		    if any of them or their dependencies is not installed."""
+		hexes = set()
+		todo = list(packages)
+		while todo:
+			p = todo.pop()
+			if p.hex not in hexes:
+				if not p.installed:
+					return
+				hexes.add(p.hex)
+				todo.extend(p.dependencies)
+		with atomic_writer(self.__upgrade_state_path) as f:
+			marshal.dump((self.packages.signature(), sorted(self.pinned_tags), sorted(hexes)), f)
+
 ################################################################################
 
 class Repository(object):
 	def __init__(self, cache_dir):
 		self.__packages = None
+		self.__refreshed = False
 		self.cache_dir = cache_dir
 		self.package_cache_dir = os.path.join(self.cache_dir, 'packages')
 		self.versions_gz = os.path.join(self.cache_dir, 'versions.gz')
+		self.versions_cache = os.path.join(self.cache_dir, 'versions.cache')
 
 		mkdir(self.cache_dir)
 		mkdir(self.package_cache_dir)
@@ -342,8 +977,52 @@ class Repository(object):
 	def update(self):
 		pass
 
+	def refresh(self):
+		""" Update the repository, unless this was done before already."""
+		if not self.__refreshed:
+			self.update()
+			self.__refreshed = True
+
+	def versions_gz_signature(self):
+		""" Return a string identifying the current versions.gz, or None if
+		    there is no versions.gz. (The downloader replaces versions.gz only
+		    if it changed, so its mtime and size suffice.)"""
+		try:
+			st = os.stat(self.versions_gz)
+			return '%r:%d' % (st.st_mtime, st.st_size)
+		except OSError:
+			return None
+
+	def read_versions_cache(self, signature):
+		""" Return the packages in versions.cache as a list of (hex, name,
+		    dependencies, tags) tuples, or None if it does not exist, is
+		    corrupt or does not match signature."""
+		try:
+			with open(self.versions_cache, 'rb') as f:
+				version, cached_signature, packages = marshal.load(f)
+		except (IOError, EOFError, ValueError, TypeError):
+			return None
+		if version == VERSIONS_CACHE_VERSION and cached_signature == signature:
+			return packages
+		return None
+
+	def write_versions_cache(self, signature, packages):
+		""" Write the dictionary of Packages read from versions.gz with
+		    signature to versions.cache."""
+		packages = [(p.hex, p.name, p.dependencies, sorted(p.tags)) for p in packages.itervalues()]
+		with atomic_writer(self.versions_cache) as f:
+			marshal.dump((VERSIONS_CACHE_VERSION, signature, packages), f)
+
 	def read_versions_gz(self):
-		""" Reads versions.gz-formatted file into a dictionary of Packages."""
+		""" Reads versions.gz-formatted file into a dictionary of Packages.
+
+		    The result is cached in versions.cache, which is used instead of
+		    versions.gz as long as versions.gz does not change."""
+		signature = self.versions_gz_signature()
+		cached = signature and self.read_versions_cache(signature)
+		if cached is not None:
+			return dict((name, Package(hex, name, deps, tags, self)) for hex, name, deps, tags in cached)
+
 		packages = {}
 
 		def read_line(line):
@@ -361,6 +1040,10 @@ class Repository(object):
 		with closing(gzip.open(self.versions_gz)) as f:
 			map(read_line, f)
 
+		try:
+			self.write_versions_cache(signature, packages)
+		except (IOError, OSError) as e:
+			log.warning('Could not write %s: %s', self.versions_cache, e)
 		return packages
 
 	@property
@@ -371,7 +1054,7 @@ class Repository(object):
 		if self.__packages:
 			return self.__packages
 
-		self.update()
+		self.refresh()
 		self.__packages = self.read_versions_gz()
 		return self.__packages
 
@@ -392,6 +1075,245 @@ class OnlineRepository(Repository):
 
 ################################################################################
 
+def snapshot_mtime(path, now):
+	""" Return the mtime of directory path, or None if it was modified so
+	    recently that changes in the same clock tick may follow."""
+	mtime = os.stat(path).st_mtime
+	return mtime if now - mtime > 1 else None
+
+
+class InstalledSnapshot(object):
+	""" The hexes of the packages installed in package_dir, read using a
+	    single directory listing, so checking whether many packages are
+	    installed does not require a stat call per package.
+
+	    The directory is listed again after invalidate() (i.e. after rapid
+	    installed or uninstalled a package), or when the mtime of package_dir
+	    changed, which is checked at most once per SNAPSHOT_TTL seconds."""
+
+	def __init__(self):
+		self.__lock = threading.Lock()
+		self.invalidate()
+
+	def invalidate(self):
+		with self.__lock:
+			self.__path = None
+			self.__mtime = None
+			self.__checked = 0
+			self.__hexes = set()
+
+	def __refresh(self):
+		now = time.time()
+		if self.__path == package_dir and now - self.__checked <= SNAPSHOT_TTL:
+			return
+		try:
+			# Stat before listing, so concurrent changes are not missed.
+			mtime = snapshot_mtime(package_dir, now)
+			if self.__path != package_dir or mtime is None or mtime != self.__mtime:
+				self.__hexes = set(name[:-4] for name in os.listdir(package_dir) if name.endswith('.sdp'))
+		except OSError:
+			mtime = None
+			self.__hexes = set()
+		self.__path, self.__mtime, self.__checked = package_dir, mtime, now
+
+	@property
+	def hexes(self):
+		""" Return the set of installed hexes. It is replaced, not modified,
+		    when the snapshot is refreshed."""
+		with self.__lock:
+			self.__refresh()
+			return self.__hexes
+
+	def __contains__(self, hex):
+		return hex in self.hexes
+
+
+class PoolSnapshot(object):
+	""" The files present in the pool, read using one directory listing per
+	    pool subdirectory, so checking whether the (many thousands of) files
+	    of a package are available does not require a stat call per file.
+
+	    rapid's own writes to the pool are recorded using add(). Besides, a
+	    subdirectory is listed again when its mtime changed (e.g. because
+	    another data directory sharing the pool wrote to it or collected
+	    it), which is checked at most once per SNAPSHOT_TTL seconds."""
+
+	def __init__(self):
+		self.__lock = threading.Lock()
+		self.invalidate()
+
+	def invalidate(self):
+		with self.__lock:
+			self.__path = None
+			self.__checked = 0
+			self.__mtimes = {}      # subdirectory -> mtime
+			self.__names = {}       # subdirectory -> set of file names
+
+	def __refresh(self):
+		now = time.time()
+		if self.__path == pool_dir and now - self.__checked <= SNAPSHOT_TTL:
+			return
+		if self.__path != pool_dir:
+			self.__mtimes, self.__names = {}, {}
+		for i in range(0, 256):
+			subdir = '%02x' % i
+			path = os.path.join(pool_dir, subdir)
+			try:
+				# Stat before listing, so concurrent changes are not missed.
+				mtime = snapshot_mtime(path, now)
+				if mtime is None or mtime != self.__mtimes.get(subdir):
+					self.__names[subdir] = set(os.listdir(path))
+			except OSError:
+				mtime = None
+				self.__names[subdir] = set()
+			self.__mtimes[subdir] = mtime
+		self.__path, self.__checked = pool_dir, now
+
+	def __split(self, md5):
+		""" Return the subdirectory and name of the pool file with md5."""
+		hex = binascii.hexlify(md5)
+		return hex[:2], hex[2:] + '.gz'
+
+	def add(self, md5):
+		""" Record that the pool file with md5 has been written."""
+		subdir, name = self.__split(md5)
+		with self.__lock:
+			self.__names.setdefault(subdir, set()).add(name)
+
+	def __contains__(self, md5):
+		subdir, name = self.__split(md5)
+		with self.__lock:
+			self.__refresh()
+			return name in self.__names[subdir]
+
+installed_snapshot = InstalledSnapshot()
+pool_snapshot = PoolSnapshot()
+
+
+class PoolReferences(object):
+	""" Persistent index from the md5 of each pool file to the hexes of the
+	    packages installed in a data directory which reference it, so the
+	    pool files in use are known without reading every .sdp file.
+
+	    It is updated by Package.install and Package.uninstall. Packages
+	    installed or removed by other means are picked up by sync(), which
+	    compares the index with the packages directory whenever the index
+	    is opened."""
+
+	VERSION = 1
+	__instances = {}     # data directory -> PoolReferences
+
+	def __init__(self, data_dir):
+		self.data_dir = data_dir
+		self.package_dir = os.path.join(data_dir, 'packages')
+		self.filename = os.path.join(data_dir, 'rapid', 'pool_refs')
+		self.__packages = {}     # hex -> (name, packed md5s)
+		self.__refs = {}         # md5 -> list of hexes
+		self.__errors = []       # PoolReferencesExceptions of the last sync
+		self.__stat = self.__file_stat()
+		try:
+			with open(self.filename, 'rb') as f:
+				version, packages, refs = marshal.load(f)
+			if version == self.VERSION:
+				self.__packages, self.__refs = packages, refs
+		except (IOError, EOFError, ValueError, TypeError):
+			pass
+
+	@classmethod
+	def open(cls, data_dir):
+		""" Return the PoolReferences of data_dir, synchronized with its
+		    packages directory. Instances are cached while the index file
+		    is not modified by another process."""
+		refs = cls.__instances.get(data_dir)
+		if refs is None or refs.__stat != refs.__file_stat():
+			refs = cls.__instances[data_dir] = cls(data_dir)
+		refs.sync()
+		return refs
+
+	def __file_stat(self):
+		try:
+			st = os.stat(self.filename)
+			return (st.st_mtime, st.st_size)
+		except OSError:
+			return None
+
+	def write(self):
+		try:
+			with atomic_writer(self.filename) as f:
+				marshal.dump((self.VERSION, self.__packages, self.__refs), f)
+			self.__stat = self.__file_stat()
+		except (IOError, OSError) as e:
+			log.warning('Could not write %s: %s', self.filename, e)
+
+	def add(self, hex, name, md5s):
+		""" Record that package hex (named name) references the pool files
+		    with md5s."""
+		if hex in self.__packages:
+			self.__packages[hex] = (name, self.__packages[hex][1])
+			return
+		md5s = list(md5s)
+		self.__packages[hex] = (name, ''.join(md5s))
+		for md5 in set(md5s):
+			self.__refs.setdefault(md5, []).append(hex)
+
+	def remove(self, hex):
+		""" Record that package hex does not reference pool files anymore."""
+		name, md5s = self.__packages.pop(hex, (None, ''))
+		for md5 in set(md5s[i:i + 16] for i in xrange(0, len(md5s), 16)):
+			hexes = self.__refs.get(md5, [])
+			if hex in hexes:
+				hexes.remove(hex)
+				if not hexes:
+					del self.__refs[md5]
+
+	def sync(self):
+		""" Add the packages which are installed but not in the index, and
+		    remove the packages which are not installed anymore.
+
+		    Packages which can not be read are not added, but remembered as
+		    errors, which make referenced() raise, until a sync succeeds."""
+		self.__errors = []
+		try:
+			installed = set(name[:-4] for name in os.listdir(self.package_dir) if name.endswith('.sdp'))
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				self.__errors.append(PoolReferencesException(self.package_dir, e))
+				return
+			installed = set()
+		removed = set(self.__packages) - installed
+		added = installed - set(self.__packages)
+		for hex in removed:
+			self.remove(hex)
+		for hex in list(added):
+			filename = os.path.join(self.package_dir, hex + '.sdp')
+			try:
+				self.add(hex, hex, read_sdp(filename).md5s())
+			except (IOError, RapidException) as e:
+				log.warning('Could not read %s: %s', filename, e)
+				self.__errors.append(PoolReferencesException(filename, e))
+				added.remove(hex)
+		if removed or added:
+			self.write()
+
+	def referenced(self):
+		""" Return the md5s of the pool files referenced by any package.
+		    Raises PoolReferencesException if the last sync failed to read
+		    any installed package, because its pool files are unknown."""
+		if self.__errors:
+			raise self.__errors[0]
+		return self.__refs.viewkeys()
+
+	def refcount(self, md5):
+		return len(self.__refs.get(md5, []))
+
+	def why(self, md5):
+		""" Return a list of (hex, name) of the packages referencing the pool
+		    file with md5. (name is hex if the package was not installed by
+		    rapid)"""
+		return [(hex, self.__packages[hex][0]) for hex in self.__refs.get(md5, [])]
+
+################################################################################
+
 class Package(object):
 	def __init__(self, hex, name, dependencies, tags = None, repository = None):
 		self.__files = None
@@ -403,6 +1325,7 @@ class Package(object):
 		self.repository = repository
 		if repository:
 			self.cache_file = os.path.join(repository.package_cache_dir, self.hex + '.sdp')
+			self.manifest_file = self.cache_file + '.manifest'
 
 	def __str__(self):
 		return self.name
@@ -412,46 +1335,32 @@ class Package(object):
 		""" Return the path at which the package would be visible to Spring."""
 		return os.path.join(package_dir, self.hex + '.sdp')
 
+	@property
+	def sdp_url(self):
+		""" Return the URL of the .sdp file of the package."""
+		if not self.repository:
+			raise DetachedPackageException()
+		if not hasattr(self.repository, 'url'):
+			raise OfflineRepositoryException()
+		return '%s/packages/%s.sdp' % (self.repository.url, self.hex)
+
 	def download(self):
 		""" Download the package from the repository."""
 		if not self.available:
-			if not self.repository:
-				raise DetachedPackageException()
-			if not hasattr(self.repository, 'url'):
-				raise OfflineRepositoryException()
-			self.repository.downloader.onetime_get_request('%s/packages/%s.sdp' % (self.repository.url, self.hex), self.cache_file)
+			url = self.sdp_url
+			self.repository.downloader.onetime_get_request(url, self.cache_file)
 
 	@property
 	def files(self):
 		""" Download .sdp file and return the list of files in it."""
 		if self.__files:
 			return self.__files
-		self.__files = []
 
 		self.download()
-		with closing(gzip.open(self.cache_file)) as f:
-			def really_read(n, field):
-				data = f.read(n)
-				if len(data) < n:
-					raise PackageFormatException(field)
-				return data
-
-			while True:
-				namelen = f.read(1)
-				if namelen == '': break   # normal loop termination condition
-				namelen = struct.unpack('B', namelen)[0]
-
-				name  = really_read(namelen, 'name')
-				md5   = really_read(16, 'md5')
-				crc32 = really_read(4, 'crc32')
-				size  = really_read(4, 'size')
-
-				size = struct.unpack('>L', size)[0]
-				self.__files.append(File(name, md5, crc32, size))
-
+		self.__files = read_sdp(self.cache_file, self.manifest_file)
 		return self.__files
 
-	def download_files(self, requested_files, progress = None):
+	def download_files(self, requested_files, progress = None, shards = None):
 		""" Download requested_files using the streamer.cgi interface.
 
 		    Progress is reported through the progress object, which must be
@@ -473,58 +1382,167 @@ class Package(object):
 		    * streamer.cgi also sets the Content-Length header in the reply so
 		      you can implement a proper progress bar.
 
+		    If shards (default: streamer_shards) is larger than one, the files
+		    are split in up to that many shards of roughly equal size, which
+		    are requested from streamer.cgi over concurrent connections.
+
+		    Interrupted downloads are retried up to STREAMER_RETRIES times,
+		    requesting only the files which are not in the pool yet.
 		"""
-		# Determine which files to fetch. (as bitarray and list of files)
+		# Determine which files to fetch. Each pool file is fetched once, even
+		# if the .sdp contains it multiple times. (under different names)
 		requested_files = set(requested_files)
-		bits = bitarray(map(lambda f: f in requested_files, self.files), endian='little')
-		expected_files = filter(lambda f: f in requested_files, self.files)
+		pool_paths = set()
+		expected_files = []
+		for f in self.files:
+			if f in requested_files and f.pool_path not in pool_paths:
+				pool_paths.add(f.pool_path)
+				expected_files.append(f)
 		if len(expected_files) == 0:
 			return
 
+		# Reuse pool files from the seed pools instead of downloading them.
+		reused = seed_files(expected_files)
+		missing_files = [f for f in expected_files if not f.available]
+		if len(missing_files) == 0:
+			return
+
 		# Can not download from offline repository...
 		if not hasattr(self.repository, 'url'):
 			raise OfflineRepositoryException()
 
+		progress = progress and SynchronizedProgress(progress)
+		shards = shards or streamer_shards
+
+		# Retry with exponential backoff when the download is interrupted.
+		# Only files which have not been committed to the pool yet are
+		# requested again.
+		expected_files = missing_files
+		downloaded = 0   # size of the files committed by earlier attempts
+		retries = 0
+		while True:
+			try:
+				self.__download_shards(expected_files, shards, progress)
+				break
+			except urllib2.HTTPError as e:
+				if e.code < 500 or retries >= STREAMER_RETRIES:
+					raise
+				error = e
+			except (StreamerFormatException, urllib2.URLError, httplib.HTTPException, socket.error) as e:
+				if retries >= STREAMER_RETRIES:
+					raise
+				error = e
+
+			retries += 1
+			delay = STREAMER_RETRY_DELAY * 2 ** (retries - 1)
+			done = [f for f in expected_files if f.available]
+			expected_files = [f for f in expected_files if not f.available]
+			downloaded += sum(os.path.getsize(f.pool_path) for f in done)
+			log.warning('Download of %s interrupted (%s), retrying %d of %d files in %d seconds (attempt %d of %d).',
+			            self.name, error, len(expected_files), len(missing_files), delay, retries, STREAMER_RETRIES)
+			log.info('%.2f megabytes already downloaded do not need to be downloaded again.', downloaded / (1024.*1024.))
+			time.sleep(delay)
+
+		if reused:
+			downloaded += sum(os.path.getsize(f.pool_path) for f in expected_files)
+			log.info('%.2f megabytes reused from seed pools, %.2f megabytes downloaded.', reused / (1024.*1024.), downloaded / (1024.*1024.))
+
+	def __download_shards(self, expected_files, shards, progress):
+		""" Download expected_files using up to shards concurrent requests."""
+		shards = balanced_shards(expected_files, shards)
+
+		# Perform all HTTP POST requests before downloading anything,
+		# so the progress maximum is known upfront.
+		remotes = []
+		def post(files):
+			remote = self.__post_request(files)
+			remotes.append(remote)
+			return remote
+
+		try:
+			responses = parallel_map(post, shards, len(shards))
+
+			if progress:
+				# progress.value > 0 if we are resuming an interrupted download
+				progress.setMaximum( progress.value + sum(int(r.info()['Content-Length']) for r in responses) )
+				progress(0)
+
+			parallel_map(lambda (files, remote): self.receive_files(remote, files, progress),
+			             zip(shards, responses), len(shards))
+		finally:
+			for remote in remotes:
+				remote.close()
+
+	def streamer_request(self, files):
+		""" Return the URL and POST data of the streamer.cgi request for files."""
 		# Build HTTP POST data.
 		# NOTE: bitarray < 0.4.0 has only tostring()
 		#       bitarray >= 0.4.0 has tobytes() and tostring(), but tostring()
 		#       decodes the bits as 7-bit ascii, so many bytes trigger an error.
+		files = set(files)
+		bits = bitarray(map(lambda f: f in files, self.files), endian='little')
 		postdata = bits.tobytes() if hasattr(bits, 'tobytes') else bits.tostring()
 		postdata = gzip_string(postdata)
 
-		# Perform HTTP POST request and download and process the response.
 		url = '%s/streamer.cgi?%s' % (self.repository.url, self.hex)
-		with closing(self.repository.downloader.post(url, postdata)) as remote:
-			if not remote.info().has_key('Content-Length'):
-				raise StreamerFormatException('Content-Length')
+		return (url, postdata)
+
+	def __post_request(self, files):
+		""" Request files from streamer.cgi and return the response."""
+		remote = self.repository.downloader.post(*self.streamer_request(files))
+		if not remote.info().has_key('Content-Length'):
+			remote.close()
+			raise StreamerFormatException('Content-Length')
+		return remote
+
+	def receive_files(self, remote, expected_files, progress = None, copy = None):
+		""" Process the streamer.cgi response containing expected_files,
+		    which must be in the order in which they occur in the .sdp.
+		    If copy is given, the response is also written to this file
+		    object as it is read. (e.g. to pass it on to a mirror client)"""
+		for f in expected_files:
+			size = remote.read(4)
+			if len(size) != 4: raise StreamerFormatException('size')
+			if copy:
+				copy.write(size)
+			size = struct.unpack('>L', size)[0]
 
 			if progress:
-				progress.setMaximum( int(remote.info()['Content-Length']) )
-				progress(0)
-
-			for f in expected_files:
-				size = remote.read(4)
-				if size == '': raise StreamerFormatException('size')
-				size = struct.unpack('>L', size)[0]
-
-				data = remote.read(size)
-				if len(data) < size: raise StreamerFormatException('data')
-
-				# check md5 hash
-				with closing(gzip.GzipFile(mode = 'rb', fileobj = StringIO(data))) as g:
-					if md5(g.read()).digest() != f.md5:
-						raise StreamerFormatException('md5')
-
-				mkdir_p( os.path.dirname(f.pool_path) )
-				atomic_write(f.pool_path, data)
+				progress(4)
+
+			mkdir_p( os.path.dirname(f.pool_path) )
+			self.__stream_file(remote, f, size, progress, copy)
+
+	def __stream_file(self, remote, f, size, progress, copy):
+		""" Copy the next size bytes (a gzipped pool file) from the streamer
+		    response into the pool (and into copy, if given), checking the
+		    md5 hash on the fly."""
+		checksum = GzipMd5()
+		with atomic_writer(f.pool_path) as target:
+			while size > 0:
+				data = remote.read(min(size, STREAMER_CHUNK_SIZE))
+				if data == '': raise StreamerFormatException('data')
+				size -= len(data)
+
+				target.write(data)
+				if copy:
+					copy.write(data)
+				try:
+					checksum.update(data)
+				except zlib.error:
+					raise StreamerFormatException('md5')
 
 				if progress:
-					progress(4 + size)
+					progress(len(data))
+
+			if checksum.digest() != f.md5:
+				raise StreamerFormatException('md5')
+		pool_snapshot.add(f.md5)
 
 	@property
 	def missing_files(self):
 		""" Return a list of files which are not locally available."""
-		return filter(lambda f: not f.available, self.files)
+		return self.files.missing()
 
 	@property
 	def can_be_installed(self):
@@ -541,10 +1559,16 @@ class Package(object):
 			if not self.can_be_installed:
 				raise DependencyException()
 			self.download_files(self.missing_files, progress)
-			if hasattr(os, 'link'):
+			references = PoolReferences.open(os.path.abspath(spring_dir))
+			try:
 				os.link(self.cache_file, self.installed_path)
-			else:
+			except (AttributeError, OSError):
+				# No hardlinks on this platform, or the content dir is shared
+				# and on another file system than the data dir.
 				shutil.copy(self.cache_file, self.installed_path)
+			installed_snapshot.invalidate()
+			references.add(self.hex, self.name, self.files.md5s())
+			references.write()
 			if progress:
 				progress(progress.maximum())
 
@@ -562,12 +1586,16 @@ class Package(object):
 		if self.installed:
 			if not self.can_be_uninstalled:
 				raise DependencyException()
+			references = PoolReferences.open(os.path.abspath(spring_dir))
 			os.unlink(self.installed_path)
+			installed_snapshot.invalidate()
+			references.remove(self.hex)
+			references.write()
 
 	@property
 	def installed(self):
 		""" Return true if the package is installed, false otherwise."""
-		return os.path.exists(self.installed_path)
+		return self.hex in installed_snapshot
 
 	@property
 	def available(self):
@@ -595,46 +1623,372 @@ class Package(object):
 		return ((self.available and self.missing_files == []) or
 				(self.repository and hasattr(self.repository, 'url')))
 
+class IndexedPackage(Package):
+	""" Package read from a PackageIndex. Its dependencies and reverse
+	    dependencies are looked up in the PackageSource on first use."""
+
+	def __init__(self, source, hex, name, dependencies, reverse_dependencies, tags, repository):
+		Package.__init__(self, hex, name, set(), tags, repository)
+		self.__source = source
+		self.__dependency_names = dependencies
+		self.__reverse_dependency_names = reverse_dependencies
+
+	@property
+	def dependencies(self):
+		if self.__dependency_names is not None:
+			self.__dependencies = set(self.__source[name] for name in self.__dependency_names)
+			self.__dependency_names = None
+		return self.__dependencies
+
+	@dependencies.setter
+	def dependencies(self, value):
+		self.__dependencies = value
+		self.__dependency_names = None
+
+	@property
+	def reverse_dependencies(self):
+		if self.__reverse_dependency_names is not None:
+			self.__reverse_dependencies = set(self.__source[name] for name in self.__reverse_dependency_names)
+			self.__reverse_dependency_names = None
+		return self.__reverse_dependencies
+
+	@reverse_dependencies.setter
+	def reverse_dependencies(self, value):
+		self.__reverse_dependencies = value
+		self.__reverse_dependency_names = None
+
 ################################################################################
 
+def plan_downloads(packages, seed = True):
+	""" Plan the streamer.cgi requests to download the missing pool files of
+	    all packages at once. Returns a list of (package, files) tuples.
+
+	    Pool files which are missing in multiple packages are planned only
+	    once. Requests are chosen greedily: each next request is for the
+	    package offering the most remaining missing pool files, so the number
+	    of requests is (close to) minimal.
+
+	    If seed is true, missing pool files available in the seed pools are
+	    put in the pool first, so they need not be downloaded. Otherwise
+	    these files are left out of the plan without touching the pool."""
+	seeded = set()      # pool_paths which are available in the seed pools
+	if seed:
+		seed_files(set(f for p in packages for f in p.missing_files))
+	elif seed_pools:
+		seeded = set(f.pool_path for p in packages for f in p.missing_files if seed_source(f))
+
+	# Collect missing pool files and the packages which can be used to
+	# download them. (only packages in online repositories qualify)
+	missing = {}        # pool_path -> first package having it missing
+	offered = {}        # package -> set of pool_paths
+	for p in packages:
+		for f in p.missing_files:
+			if f.pool_path in seeded:
+				continue
+			missing.setdefault(f.pool_path, p)
+			if hasattr(p.repository, 'url'):
+				offered.setdefault(p, set()).add(f.pool_path)
+
+	plan = []
+	remaining = set(missing)
+	candidates = [p for p in packages if p in offered]
+	while remaining and candidates:
+		# max returns the first of equal candidates, which keeps plans stable
+		best = max(candidates, key = lambda p: len(offered[p] & remaining))
+		pool_paths = offered[best] & remaining
+		if not pool_paths:
+			break
+		plan.append((best, [f for f in best.files if f.pool_path in pool_paths]))
+		remaining -= pool_paths
+		candidates.remove(best)
+
+	# Files not offered by any online package are planned nevertheless, so
+	# download_files raises the appropriate exception.
+	for p in packages:
+		pool_paths = set(x for x in remaining if missing[x] == p)
+		if pool_paths:
+			plan.append((p, [f for f in p.files if f.pool_path in pool_paths]))
+			remaining -= pool_paths
+
+	return plan
+
+def compression_ratio(packages):
+	""" Estimate the ratio of the compressed to the uncompressed size of
+	    pool files, from the files of packages which are in the pool already,
+	    or else from a sample of the pool. Returns None if there is no data."""
+	size = 0
+	compressed = 0
+	pool_paths = set()
+	for p in packages:
+		for f in p.files:
+			if f.size and f.pool_path not in pool_paths and f.available:
+				pool_paths.add(f.pool_path)
+				size += f.size
+				compressed += os.path.getsize(f.pool_path)
+
+	# Otherwise sample the pool. The last 4 bytes of a gzip file are the
+	# uncompressed size. (modulo 2**32)
+	if not size:
+		sample = []
+		for i in range(0, 256):
+			d = os.path.join(pool_dir, '%02x' % i)
+			if os.path.isdir(d):
+				sample += [os.path.join(d, x) for x in os.listdir(d) if x.endswith('.gz')]
+			if len(sample) >= COMPRESSION_SAMPLE_SIZE:
+				break
+		for path in sample[:COMPRESSION_SAMPLE_SIZE]:
+			with open(path, 'rb') as f:
+				f.seek(-4, os.SEEK_END)
+				size += struct.unpack('<L', f.read(4))[0]
+			compressed += os.path.getsize(path)
+
+	if size:
+		return float(compressed) / size
+	return None
+
+
+def verify_pool_file(path, digest):
+	""" Return true iff the decompressed contents of the pool file at path
+	    have the md5 digest."""
+	checksum = GzipMd5()
+	try:
+		with open(path, 'rb') as f:
+			while True:
+				data = f.read(STREAMER_CHUNK_SIZE)
+				if data == '': break
+				checksum.update(data)
+	except (IOError, zlib.error):
+		return False
+	return checksum.digest() == digest
+
+
+def seed_source(f):
+	""" Return the path of the verified copy of pool file f in the first of
+	    the seed_pools having one, or None."""
+	relative_path = os.path.relpath(f.pool_path, pool_dir)
+	for seed_pool in seed_pools:
+		source = os.path.join(seed_pool, relative_path)
+		if os.path.exists(source) and verify_pool_file(source, f.md5):
+			return source
+	return None
+
+
+def seed_files(files):
+	""" Hardlink (or copy) the files which are missing from the pool from the
+	    first of the seed_pools having a verified copy of them. Returns the
+	    number of bytes reused."""
+	count = 0
+	reused = 0
+	for f in files:
+		if not seed_pools or f.available:
+			continue
+		source = seed_source(f)
+		if source:
+			mkdir_p(os.path.dirname(f.pool_path))
+			try:
+				os.link(source, f.pool_path)
+			except (AttributeError, OSError):
+				# No hardlinks on this platform, or another file system.
+				if not f.available:
+					with atomic_writer(f.pool_path) as target:
+						with open(source, 'rb') as source_file:
+							shutil.copyfileobj(source_file, target, STREAMER_CHUNK_SIZE)
+			pool_snapshot.add(f.md5)
+			count += 1
+			reused += os.path.getsize(f.pool_path)
+	if count:
+		log.info('Reused %d files (%.2f megabytes) from seed pools.', count, reused / (1024.*1024.))
+	return reused
+
+
+def parse_sdp(data):
+	""" Parse the decompressed contents of a .sdp file into a Manifest."""
+	names, offsets, md5s, crc32s, sizes = [], array('I', [0]), [], [], array('I')
+	offset, end, total = 0, len(data), 0
+	unpack_from = struct.unpack_from
+	while offset < end:
+		namelen = ord(data[offset])
+		start = offset + 1
+		offset = start + namelen + 24
+		if offset > end:
+			# Report the first field which is truncated.
+			for field, field_end in [('name', start + namelen), ('md5', start + namelen + 16), ('crc32', start + namelen + 20)]:
+				if field_end > end:
+					raise PackageFormatException(field)
+			raise PackageFormatException('size')
+		md5 = start + namelen
+		names.append(data[start:md5])
+		total += namelen
+		offsets.append(total)
+		md5s.append(data[md5:md5 + 16])
+		crc32s.append(data[md5 + 16:md5 + 20])
+		sizes.append(unpack_from('>L', data, md5 + 20)[0])
+	return Manifest(''.join(names), offsets, ''.join(md5s), ''.join(crc32s), sizes)
+
+
+def read_manifest(filename, signature):
+	""" Return the Manifest saved by write_manifest, or None if filename does
+	    not exist, is corrupt or does not match signature."""
+	try:
+		with open(filename, 'rb') as f:
+			version, file_signature, names, offsets, md5s, crc32s, sizes = marshal.loads(f.read())
+	except (IOError, EOFError, ValueError, TypeError):
+		return None
+	if version != MANIFEST_VERSION or file_signature != signature:
+		return None
+	return Manifest(names, array('I', offsets), md5s, crc32s, array('I', sizes))
+
+
+def write_manifest(filename, signature, manifest):
+	""" Save the columns of manifest, so they can be loaded by read_manifest
+	    with a single read."""
+	names, offsets, md5s, crc32s, sizes = manifest.columns
+	with atomic_writer(filename) as f:
+		f.write(marshal.dumps((MANIFEST_VERSION, signature, names, offsets.tostring(), md5s, crc32s, sizes.tostring())))
+
+
+def read_sdp(filename, manifest = None):
+	""" Read a .sdp file and return the Manifest of the files in it.
+
+	    If manifest is given, the decoded .sdp file is cached in that file,
+	    which is used instead of the .sdp file as long as it does not change."""
+	if manifest:
+		st = os.stat(filename)
+		signature = '%r:%d' % (st.st_mtime, st.st_size)
+		files = read_manifest(manifest, signature)
+		if files is not None:
+			return files
+
+	with open(filename, 'rb') as f:
+		data = f.read()
+	try:
+		# .sdp files consist of a single gzip member.
+		files = parse_sdp(zlib.decompress(data, 16 + zlib.MAX_WBITS) if data else '')
+	except zlib.error:
+		raise PackageFormatException('gzip')
+
+	if manifest:
+		try:
+			write_manifest(manifest, signature, files)
+		except (IOError, OSError) as e:
+			log.warning('Could not write %s: %s', manifest, e)
+	return files
+
+
+def pool_path(md5):
+	""" Return the path of the pool file with md5."""
+	hex = binascii.hexlify(md5)
+	return os.path.join(pool_dir, hex[:2], hex[2:]) + '.gz'
+
+
+def walk_pool(source_pool, target_pool):
+	""" Yield (source, target) for each file in source_pool, where target
+	    is the path of the same file in target_pool."""
+	for dirpath, dirnames, filenames in os.walk(source_pool):
+		for name in filenames:
+			source = os.path.join(dirpath, name)
+			yield (source, os.path.join(target_pool, os.path.relpath(source, source_pool)))
+
+
+def move_file(source, target):
+	""" Move source to target, which may be on another file system. The
+	    target never contains a partial copy of source."""
+	try:
+		os.rename(source, target)
+	except OSError:
+		with open(source, 'rb') as f:
+			with atomic_writer(target) as g:
+				shutil.copyfileobj(f, g, STREAMER_CHUNK_SIZE)
+		os.remove(source)
+
+
+def pool_md5(path):
+	""" Return the md5 of the pool file at path (or of the given hex md5),
+	    or None if it is not the path of a pool file."""
+	if path.endswith('.gz'):
+		path = os.path.basename(os.path.dirname(path)) + os.path.basename(path)[:-3]
+	try:
+		md5 = binascii.unhexlify(path)
+	except TypeError:
+		return None
+	return md5 if len(md5) == 16 else None
+
+################################################################################
+
+class Manifest(object):
+	""" The files in a .sdp file, stored column-wise: the names in a single
+	    string (indexed by an array of offsets), the md5 and crc32 checksums
+	    in packed strings, and the sizes in an array. This takes a fraction
+	    of the memory of a list of File objects, for packages with many
+	    thousands of files.
+
+	    Indexing or iterating a Manifest returns File objects, which are
+	    created on demand. The columns can be used directly to avoid that."""
+
+	def __init__(self, names, offsets, md5s, crc32s, sizes):
+		self.__names = names
+		self.__offsets = offsets
+		self.__md5s = md5s
+		self.__crc32s = crc32s
+		self.__sizes = sizes
+
+	@property
+	def columns(self):
+		return (self.__names, self.__offsets, self.__md5s, self.__crc32s, self.__sizes)
+
+	def __len__(self):
+		return len(self.__sizes)
+
+	def __getitem__(self, i):
+		i = xrange(len(self))[i]   # IndexError, negative indices
+		return File(self.__names[self.__offsets[i]:self.__offsets[i + 1]],
+		            self.__md5s[16 * i:16 * i + 16], self.__crc32s[4 * i:4 * i + 4], self.__sizes[i])
+
+	def __iter__(self):
+		for i in xrange(len(self)):
+			yield self[i]
+
+	def md5s(self):
+		""" Iterate over the md5 checksums of the files."""
+		return (self.__md5s[16 * i:16 * i + 16] for i in xrange(len(self)))
+
+	def pool_paths(self):
+		""" Iterate over the pool paths of the files."""
+		return (pool_path(md5) for md5 in self.md5s())
+
+	def missing(self):
+		""" Return the list of files which are not in the pool."""
+		return [self[i] for i, md5 in enumerate(self.md5s()) if md5 not in pool_snapshot]
+
+
 class File(object):
-	""" Stores metadata about a pool file. Uses flyweight pattern to reduce
-	    memory consumption. (Many pool files may be shared between packages.)"""
+	""" Stores metadata about a pool file. Files are equal if they have the
+	    same name and md5, so the Files returned by a Manifest can be used
+	    as set members and dictionary keys."""
 
-	__slots__ = ['pool_path', 'name', 'md5', 'crc32', 'size', '__weakref__']
-	__files = weakref.WeakValueDictionary()
+	__slots__ = ['name', 'md5', 'crc32', 'size']
 
-	def __new__(cls, name, md5, crc32, size):
-		""" Factory participant of Flyweight pattern used to store huge amounts
-		    of Files without requiring extraordinate amounts of memory."""
-		# Get the physical path to the file in the pool.
-		hex = binascii.hexlify(md5)
-		pool_path = os.path.join(pool_dir, hex[:2], hex[2:]) + '.gz'
-
-		# pool_path identifies the pool file, but name may differ per package.
-		key = (pool_path, name)
-
-		# If we got it already, return flyweight File object.
-		if key in File.__files:
-			f = File.__files[key]
-			assert (f.pool_path == pool_path)
-			assert (f.name == name)
-			assert (f.md5 == md5)
-			assert (f.crc32 == crc32)
-			assert (f.size == size)
-			return f
-
-		# Use a local variable to ensure a strong ref exists until return!
-		f = object.__new__(cls)
-		f.pool_path = pool_path
-		f.name = name
-		f.md5 = md5
-		f.crc32 = crc32
-		f.size = size
-		File.__files[key] = f
-		return f
+	def __init__(self, name, md5, crc32, size):
+		self.name = name
+		self.md5 = md5
+		self.crc32 = crc32
+		self.size = size
+
+	def __eq__(self, other):
+		return isinstance(other, File) and self.md5 == other.md5 and self.name == other.name
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash((self.md5, self.name))
+
+	@property
+	def pool_path(self):
+		""" Return the physical path to the file in the pool."""
+		return pool_path(self.md5)
 
 	@property
 	def available(self):
 		""" Return true iff the file is available locally."""
-		return os.path.exists(self.pool_path)
+		return self.md5 in pool_snapshot
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Tobi Vollebregt
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from bitarray import bitarray
+from contextlib import closing
+from StringIO import StringIO
+import gzip, httplib, os, re, shutil, struct, threading
+import logging, urllib2
+
+from rapid import STREAMER_CHUNK_SIZE, Package, RapidException, StreamerFormatException
+
+log = logging.getLogger('root')
+
+# rapid serve listens on this port by default
+MIRROR_PORT = 8080
+
+################################################################################
+
+class MirrorServer(ThreadingMixIn, HTTPServer):
+	""" HTTP server which mirrors the repositories known to a Rapid instance.
+
+	    The mirror implements the same protocol as the upstream servers:
+
+	    * /repos.gz lists the upstream repositories,
+	    * /<repository>/versions.gz lists the packages of a repository,
+	    * /<repository>/packages/<hex>.sdp are the packages,
+	    * /<repository>/streamer.cgi?<hex> streams pool files.
+
+	    Where <repository> is the URL of the upstream repository without the
+	    'http://' prefix. Content which is not available locally is downloaded
+	    from upstream first, so each file is fetched from upstream only once.
+	    Pool files are passed on to the client while they are downloaded.
+	    Only requests for the same missing file wait for each other.
+	    (Mirror clients use the upstream URLs to name their cache directories,
+	    which is why /repos.gz is passed on unmodified.)"""
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, rapid, address = ('', MIRROR_PORT)):
+		HTTPServer.__init__(self, address, MirrorRequestHandler)
+		self.rapid = rapid
+		# Serializes refreshes of repos.gz and versions.gz.
+		self.lock = threading.Lock()
+		self.__repos_gz_stat = None   # (mtime, size) of the loaded repos.gz
+		# Serialize downloads of individual files from upstream.
+		self.__file_locks = {}   # filename -> Lock
+		self.__file_locks_lock = threading.Lock()
+
+	def file_locks(self, filenames):
+		""" Return the locks serializing downloads of filenames, in an
+		    order in which they can be acquired without deadlocks."""
+		with self.__file_locks_lock:
+			return [self.__file_locks.setdefault(f, threading.Lock()) for f in sorted(set(filenames))]
+
+	def repository(self, path):
+		""" Return (repository, remaining path) for a request path."""
+		for r in self.rapid.repositories:
+			if hasattr(r, 'url'):
+				prefix = '/' + r.url.split('://', 1)[-1].rstrip('/') + '/'
+				if path.startswith(prefix):
+					return (r, path[len(prefix):])
+		return (None, None)
+
+	def repos_gz(self):
+		""" Refresh repos.gz (rate limited) and return its filename.
+
+		    The repositories are only reloaded if repos.gz changed, because
+		    other threads use them (see repository()) while this runs."""
+		with self.lock:
+			repositories = self.rapid.repositories
+			repositories.fetch_repos_gz()
+			st = os.stat(repositories.repos_gz)
+			if (st.st_mtime, st.st_size) != self.__repos_gz_stat:
+				repositories.load()
+				self.__repos_gz_stat = (st.st_mtime, st.st_size)
+			return repositories.repos_gz
+
+	def versions_gz(self, repository):
+		""" Refresh versions.gz (rate limited) and return its filename."""
+		with self.lock:
+			repository.update()
+			repository.downloader.commit()
+			return repository.versions_gz
+
+	def package(self, repository, hex):
+		""" Return the package with hex from repository, with its .sdp file
+		    downloaded. Only hex and repository matter for mirroring."""
+		p = Package(hex, hex, [], repository = repository)
+		if not p.available:
+			lock, = self.file_locks([p.cache_file])
+			with lock:
+				p.download()
+		p.files
+		return p
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+	""" Handles requests to a MirrorServer."""
+
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, format, *args):
+		log.info('%s - %s', self.client_address[0], format % args)
+
+	def do_GET(self):
+		try:
+			if self.path == '/repos.gz':
+				return self.send_file(self.server.repos_gz())
+
+			repository, path = self.server.repository(self.path)
+			if not repository:
+				return self.send_error(404)
+			if path == 'versions.gz':
+				return self.send_file(self.server.versions_gz(repository))
+			match = re.match(r'^packages/([0-9a-fA-F]+)\.sdp$', path)
+			if match:
+				return self.send_file(self.server.package(repository, match.group(1)).cache_file)
+			self.send_error(404)
+		except urllib2.HTTPError as e:
+			self.send_error(e.code)
+		except (urllib2.URLError, RapidException) as e:
+			self.send_error(502, str(e))
+
+	def do_POST(self):
+		try:
+			body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+			repository, path = self.server.repository(self.path)
+			match = re.match(r'^streamer\.cgi\?([0-9a-fA-F]+)$', path or '')
+			if not match:
+				return self.send_error(404)
+			p = self.server.package(repository, match.group(1))
+
+			try:
+				with closing(gzip.GzipFile(fileobj = StringIO(body))) as f:
+					bits = bitarray(endian = 'little')
+					bits.frombytes(f.read())
+			except (IOError, EOFError):
+				return self.send_error(400)
+			files = [f for f, requested in zip(p.files, bits) if requested]
+
+			self.send_pool_files(p, files)
+		except urllib2.HTTPError as e:
+			self.send_error(e.code)
+		except (urllib2.URLError, RapidException) as e:
+			self.send_error(502, str(e))
+
+	def send_file(self, filename):
+		""" Send a complete file as response."""
+		with open(filename, 'rb') as f:
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/octet-stream')
+			self.send_header('Content-Length', os.path.getsize(filename))
+			self.end_headers()
+			shutil.copyfileobj(f, self.wfile, STREAMER_CHUNK_SIZE)
+
+	def send_pool_files(self, p, files):
+		""" Send files of p as streamer.cgi response: the size of each
+		    (gzipped) pool file as big endian int32, followed by the pool file.
+
+		    Files which are not in the pool yet are requested from upstream in
+		    a single request, and passed on to the client while they are
+		    written to the pool."""
+		missing = [f for f in files if not f.available]
+		locks = self.server.file_locks(f.pool_path for f in missing)
+		for lock in locks:
+			lock.acquire()
+		remote = None
+		try:
+			# Another request may have downloaded them in the meantime.
+			missing = [f for f in missing if not f.available]
+			length = 0
+			if missing:
+				log.info('Downloading %d files for: %s', len(missing), p.hex)
+				remote = p.repository.downloader.post(*p.streamer_request(missing))
+				if not remote.info().has_key('Content-Length'):
+					raise StreamerFormatException('Content-Length')
+				length = int(remote.info()['Content-Length'])
+			upstream = set(f.pool_path for f in missing)
+			sizes = dict((f.pool_path, os.path.getsize(f.pool_path)) for f in files if f.pool_path not in upstream)
+
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/octet-stream')
+			self.send_header('Content-Length', length + sum(4 + sizes[f.pool_path] for f in files if f.pool_path in sizes))
+			self.end_headers()
+			try:
+				for f in files:
+					if f.pool_path in upstream:
+						p.receive_files(remote, [f], copy = self.wfile)
+					else:
+						self.wfile.write(struct.pack('>L', sizes[f.pool_path]))
+						with open(f.pool_path, 'rb') as source:
+							shutil.copyfileobj(source, self.wfile, STREAMER_CHUNK_SIZE)
+			except (IOError, RapidException, httplib.HTTPException) as e:
+				# Too late to send an error, the client notices the
+				# truncated response and retries.
+				log.warning('Streaming %s to %s failed: %s', p.hex, self.client_address[0], e)
+				self.close_connection = 1
+		finally:
+			if remote:
+				remote.close()
+			for lock in locks:
+				lock.release()
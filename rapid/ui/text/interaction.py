@@ -34,11 +34,16 @@ class TextUserInteraction:
 			return []
 		return [options[x] for x in which]
 
+	def candidates(self, needle, haystack, regex = False):
+		""" Override/patch this to narrow down haystack to the items which
+		may match needle (e.g. using a search index) before searching it."""
+		return haystack
+
 	def _select_core(self, needle, haystack):
 		""" Override/patch this to implement other search strategy.
 		This variant implements a simple case-insensitive substring search."""
 		n = needle.lower()
-		return filter(lambda s: n in str(s).lower(), haystack)
+		return filter(lambda s: n in str(s).lower(), self.candidates(needle, haystack))
 
 	def select(self, noun, needle, haystack):
 		""" Select items from a list based on needle, and take appropriate
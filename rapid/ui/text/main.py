@@ -4,6 +4,7 @@ import os, re, sys
 import logging
 from optparse import OptionParser
 from rapid.main import *
+import rapid.main as core
 from .interaction import TextUserInteraction
 from rapid.unitsync.api import get_writable_data_directory
 
@@ -26,6 +27,9 @@ Where the different verbs and their arguments are:
  * `collect-pool`: Remove pool files not needed by any installed package.
  * `make-sdd <tag|package> <dir>`: Extract pool files of a package into
 	`~/.spring/games/<dir>`.
+ * `serve [port]`: Serve packages and pool files to other rapid clients,
+	which use it with `--mirror=http://<host>:<port>`.
+ * `why <pool file>`: Show which installed packages use a pool file.
 
 Examples:
 
@@ -52,6 +56,10 @@ def main():
 		action='store', dest='datadir',
 		help='Override the default data directory. '
 			'(~/.spring on Linux or the one reported by unitsync on Windows)')
+	parser.add_option('--shared-dir',
+		action='store', dest='shared_dir',
+		help='Share the pool and downloaded metadata with other data directories '
+		'using SHARED_DIR.')
 	parser.add_option('--unitsync',
 		action='store_true', dest='unitsync',
 		help='Use unitsync to locate the data directory Spring uses.',
@@ -66,6 +74,27 @@ def main():
 	parser.add_option('-y', '--yes',
 		action='store_true', dest='force',
 		help='Answer all confirmations with yes. MAY BE DANGEROUS!')
+	parser.add_option('-n', '--dry-run',
+		action='store_true', dest='dry_run',
+		help='Show what pin, install and upgrade would download, without '
+		'downloading or installing anything.')
+	parser.add_option('--shards',
+		action='store', type='int', dest='shards', default=1,
+		help='Download large packages using up to SHARDS concurrent connections.')
+	parser.add_option('--seed-pool',
+		action='append', dest='seed_pools', default=[],
+		help='Reuse pool files from the pool directory SEED_POOL (e.g. of another '
+		'Spring installation) instead of downloading them. May be given multiple times.')
+	parser.add_option('--mirror',
+		action='store', dest='mirror',
+		help='Download through the mirror at MIRROR (see serve) if it is available.')
+	parser.add_option('--lazy',
+		action='store_true', dest='lazy',
+		help='Look up exact package names and tags in the repositories which '
+		'offered them before, instead of loading all repositories.')
+	parser.add_option('--event-loop',
+		action='store_true', dest='event_loop',
+		help='Perform all downloads from a single thread using an event loop.')
 
 	(options, args) = parser.parse_args()
 
@@ -106,17 +135,23 @@ def main():
 	verb = args.pop(0)
 
 	ui = TextUserInteraction(options.force)
+	rapid.streamer_shards = options.shards
+	rapid.mirror_url = options.mirror
+	rapid.seed_pools = options.seed_pools
+	rapid.lazy_packages = options.lazy
+	core.event_loop = options.event_loop
+	core.dry_run = options.dry_run
 
 	if options.regex:
 		ui._select_core = (lambda needle, haystack:
-			[candidate for candidate in haystack if re.search(needle, str(candidate), re.I)])
+			[candidate for candidate in ui.candidates(needle, haystack, True) if re.search(needle, str(candidate), re.I)])
 
 	if options.datadir:
-		init(options.datadir, ui)
+		init(options.datadir, ui, options.shared_dir)
 	elif options.unitsync:
-		init(get_writable_data_directory(), ui)
+		init(get_writable_data_directory(), ui, options.shared_dir)
 	elif os.name == 'posix':
-		init(os.path.expanduser('~/.spring'), ui)
+		init(os.path.expanduser('~/.spring'), ui, options.shared_dir)
 	else:
 		print 'No data directory specified. Specify one using either --datadir or --unitsync.'
 		print
@@ -165,6 +200,10 @@ def main():
 		collect_pool()
 	elif verb == 'make-sdd':
 		make_sdd(req_arg(), req_arg())
+	elif verb == 'serve':
+		serve(opt_arg())
+	elif verb == 'why':
+		why(req_arg())
 	elif not handled:
 		print 'Unknown operation: ' + verb
 		print
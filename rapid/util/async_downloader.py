@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Tobi Vollebregt
+
+from atomic import atomic_rename, temp_name
+from downloader import IncompleteDownloadError, MockDownloader, uses_proxy
+from metadata import MetadataStore
+from StringIO import StringIO
+from urlparse import urljoin, urlsplit
+import asyncore
+import base64
+import httplib
+import os
+import socket
+import sys
+import tempfile
+import time
+import urllib
+import urllib2
+
+import downloader
+
+################################################################################
+
+spool_size = 1024 * 1024   # POST responses larger than this are spooled to disk
+
+################################################################################
+
+def parse_proxy(proxy):
+	""" Return (netloc, authorization) of the proxy URL proxy, where
+	    authorization is the Proxy-Authorization header to send, or None."""
+	if '://' not in proxy:
+		proxy = 'http://' + proxy
+	scheme, netloc = urlsplit(proxy)[:2]
+	if scheme != 'http':
+		raise urllib2.URLError('unsupported proxy scheme: ' + scheme)
+	userinfo, at, netloc = netloc.rpartition('@')
+	if not at:
+		return netloc, None
+	return netloc, 'Basic ' + base64.b64encode(urllib.unquote(userinfo))
+
+################################################################################
+
+class Future(object):
+	""" The result of an asynchronous request, which is available once the
+	    AsyncDownloader event loop has completed the request."""
+
+	def __init__(self):
+		self.__done = False
+		self.__result = None
+		self.__exc_info = None
+
+	def done(self):
+		return self.__done
+
+	def set_result(self, result):
+		self.__result = result
+		self.__done = True
+
+	def set_exception(self, exc_info):
+		self.__exc_info = exc_info
+		self.__done = True
+
+	def result(self):
+		""" Return the result, or raise the exception, of the request."""
+		assert self.__done
+		if self.__exc_info:
+			raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+		return self.__result
+
+
+class HTTPResponse(object):
+	""" File-like response to an asynchronous POST request."""
+
+	def __init__(self, code, headers, body):
+		self.code = code
+		self.__headers = headers
+		self.__body = body
+		self.__body.seek(0)
+
+	def read(self, amt = -1):
+		return self.__body.read(amt)
+
+	def info(self):
+		return self.__headers
+
+	def close(self):
+		self.__body.close()
+
+
+class HTTPChannel(asyncore.dispatcher):
+	""" A single HTTP/1.0 request, driven by the asyncore event loop.
+
+	    HTTP/1.0 is used so the end of the response body is simply marked by
+	    the server closing the connection. (i.e. no chunked encoding)
+	    The body of a successful response is written into the file object
+	    returned by open_sink(headers) while it arrives, after which
+	    done(code, headers, sink) is called. Errors are passed to
+	    fail(exc_info), after closing the sink.
+
+	    The loop drops the channel if it has been idle for timeout seconds.
+	    Like urllib2, the channel connects to the proxy configured by the
+	    http_proxy environment variable, if any."""
+
+	def __init__(self, loop, method, url, data, headers, open_sink, done, fail, timeout):
+		asyncore.dispatcher.__init__(self, map = loop.socket_map)
+		self.__loop = loop
+		self.timeout = timeout
+		self.__method = method
+		self.__url = url
+		self.__data = data
+		self.__headers = headers
+		self.__open_sink = open_sink
+		self.__done = done
+		self.__fail = fail
+		self.__response = ''        # buffered until headers are complete
+		self.__code = None
+		self.__message = None
+		self.__sink = None
+		self.__received = 0
+		self.__finished = False
+		self.last_activity = time.time()
+
+		scheme, netloc, path, query, fragment = urlsplit(url)
+		if scheme != 'http':
+			raise urllib2.URLError('unsupported URL scheme: ' + scheme)
+		lines = ['%s %s HTTP/1.0' % (method, (path or '/') + ('?' + query if query else '')),
+		         'Host: ' + netloc]
+		if uses_proxy(url):
+			# Connect to the proxy instead, and send it the absolute URI.
+			netloc, authorization = parse_proxy(urllib2.getproxies()[scheme])
+			lines[0] = '%s %s HTTP/1.0' % (method, url.split('#', 1)[0])
+			if authorization:
+				lines.append('Proxy-Authorization: ' + authorization)
+		host, port = netloc, 80
+		if ':' in netloc:
+			host, port = netloc.rsplit(':', 1)
+			port = int(port)
+		lines += ['%s: %s' % x for x in headers.iteritems()]
+		if data is not None:
+			lines.append('Content-Length: %d' % len(data))
+		self.__out = '\r\n'.join(lines) + '\r\n\r\n' + (data or '')
+
+		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.connect((loop.resolve(host), port))
+
+	def writable(self):
+		return not self.connected or len(self.__out) > 0
+
+	def handle_connect(self):
+		pass
+
+	def handle_write(self):
+		sent = self.send(self.__out)
+		self.__out = self.__out[sent:]
+		self.last_activity = time.time()
+
+	def handle_read(self):
+		data = self.recv(downloader.chunk_size)
+		self.last_activity = time.time()
+		if self.__code is None:
+			self.__response += data
+			end = self.__response.find('\r\n\r\n')
+			if end < 0:
+				return
+			data = self.__response[end + 4:]
+			status, headers = (self.__response[:end] + '\r\n').split('\r\n', 1)
+			self.__response = None
+			self.__code = int(status.split(None, 2)[1])
+			self.__message = httplib.HTTPMessage(StringIO(headers))
+			if 200 <= self.__code < 300:
+				self.__sink = self.__open_sink(self.__message)
+		if self.__sink and data:
+			self.__sink.write(data)
+			self.__received += len(data)
+
+	def handle_close(self):
+		self.close()
+		if self.__finished:
+			return
+		self.__finished = True
+		try:
+			self.__finish()
+		except Exception:
+			if self.__sink:
+				self.__sink.close()
+			self.__fail(sys.exc_info())
+
+	def handle_error(self):
+		self.close()
+		if not self.__finished:
+			self.__finished = True
+			if self.__sink:
+				self.__sink.close()
+			e = sys.exc_info()[1]
+			self.__fail((urllib2.URLError, urllib2.URLError(e), sys.exc_info()[2]))
+
+	def handle_timeout(self):
+		""" Called by the loop when the connection has been idle too long."""
+		self.abort('timed out')
+
+	def abort(self, reason):
+		""" Close the connection and fail the request, if it is pending."""
+		self.close()
+		if not self.__finished:
+			self.__finished = True
+			if self.__sink:
+				self.__sink.close()
+			self.__fail((urllib2.URLError, urllib2.URLError(reason), None))
+
+	def __finish(self):
+		if self.__code is None:
+			raise urllib2.URLError('connection closed before response was received')
+
+		code, message = self.__code, self.__message
+		location = message.getheader('Location')
+		if code in (301, 302, 303, 307) and location:
+			method, data, headers = self.__method, self.__data, self.__headers
+			if code != 307:
+				method, data = 'GET', None
+			HTTPChannel(self.__loop, method, urljoin(self.__url, location), data, headers,
+			            self.__open_sink, self.__done, self.__fail, self.timeout)
+			return
+		if code >= 400:
+			raise urllib2.HTTPError(self.__url, code, 'HTTP error', message, None)
+
+		length = message.getheader('Content-Length')
+		if (self.__sink and downloader.validate_length and length is not None and
+		    self.__received < int(length)):
+			raise IncompleteDownloadError(self.__url, int(length), self.__received)
+
+		self.__done(code, message, self.__sink)
+
+################################################################################
+
+class AsyncDownloader:
+	""" Event loop driven counterpart of Downloader, which multiplexes any
+	    number of concurrent requests on a single thread using asyncore.
+
+	    It has the same methods as Downloader, but these return a Future
+	    immediately. The requests are performed by run() or as_completed().
+	    Metadata (ETags etc.) is shared with Downloaders using the same
+	    configuration file.
+
+	    Host names are resolved (once per host) synchronously."""
+
+	def __init__(self, config_filename):
+		self.__metadata = MetadataStore.open(config_filename)
+		self.__addresses = {}
+		self.socket_map = {}
+		self._304 = False    # for unit tests
+
+	def resolve(self, host):
+		if host not in self.__addresses:
+			self.__addresses[host] = socket.gethostbyname(host)
+		return self.__addresses[host]
+
+	def commit(self):
+		""" Persist the metadata (ETags etc.) of all requests made so far."""
+		self.__metadata.commit()
+
+	def __request(self, method, url, data, headers, open_sink, done, fail):
+		try:
+			headers.setdefault('User-Agent', 'Python-urllib/%s' % urllib2.__version__)
+			timeout = downloader.timeout
+			if data is not None:
+				headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+				timeout = downloader.post_timeout
+			HTTPChannel(self, method, url, data, headers, open_sink, done, fail, timeout)
+		except (socket.error, urllib2.URLError) as e:
+			fail((urllib2.URLError, urllib2.URLError(e), sys.exc_info()[2]))
+
+	def __get_to_file(self, future, url, filename, headers = {}, on_done = None, on_fail = None):
+		temp = temp_name(filename)
+		def open_sink(message):
+			return open(temp, 'wb')
+		def done(code, message, sink):
+			if sink:
+				sink.close()
+				atomic_rename(temp, filename)
+			if on_done:
+				on_done(code, message)
+			future.set_result(None)
+		def fail(exc_info):
+			if os.path.exists(temp):
+				os.remove(temp)
+			if on_fail and on_fail(exc_info):
+				future.set_result(None)
+			else:
+				future.set_exception(exc_info)
+		self.__request('GET', url, None, dict(headers), open_sink, done, fail)
+
+	def onetime_get_request(self, url, filename):
+		future = Future()
+		if os.path.exists(filename):
+			future.set_result(None)
+		else:
+			self.__get_to_file(future, url, filename)
+		return future
+
+	def conditional_get_request(self, url, filename, rate_limit = None):
+		future = Future()
+		section = url + ',' + filename
+		etag = self.__metadata.get(section, 'etag')
+		last_modified = self.__metadata.get(section, 'last_modified')
+		last_requested = self.__metadata.get(section, 'last_requested')
+
+		# rate limiting
+		if (rate_limit and last_requested and
+			time.time() - float(last_requested) <= rate_limit and
+			os.path.exists(filename)):
+			future.set_result(None)
+			return future
+
+		headers = {}
+		if os.path.exists(filename):
+			if etag:
+				headers['If-None-Match'] = etag
+			if last_modified:
+				headers['If-Modified-Since'] = last_modified
+
+		def on_done(code, message):
+			if code == 304:
+				self._304 = True
+			self.__metadata.update(section,
+				etag = message.getheader('ETag'),
+				last_modified = message.getheader('Last-Modified'),
+				last_requested = repr(time.time()))
+
+		def on_fail(exc_info):
+			# Keep using the old file if the request fails.
+			return issubclass(exc_info[0], urllib2.URLError) and os.path.exists(filename)
+
+		self.__get_to_file(future, url, filename, headers, on_done, on_fail)
+		return future
+
+	def post(self, url, data, open_sink = None):
+		""" Returns a Future whose result is the (file-like) response.
+
+		    If open_sink is given, it is called with the headers of the
+		    response to create a file-like object, into which the body is
+		    written while it arrives, and which is the result instead."""
+		future = Future()
+		if open_sink:
+			def done(code, message, sink):
+				future.set_result(sink)
+		else:
+			def open_sink(message):
+				return tempfile.SpooledTemporaryFile(spool_size)
+			def done(code, message, sink):
+				future.set_result(HTTPResponse(code, message, sink or StringIO()))
+		self.__request('POST', url, data, {}, open_sink, done, future.set_exception)
+		return future
+
+	def poll(self, timeout = 0.1):
+		""" Run one iteration of the event loop."""
+		if self.socket_map:
+			asyncore.loop(timeout, map = self.socket_map, count = 1)
+		now = time.time()
+		for channel in self.socket_map.values():
+			if now - channel.last_activity > channel.timeout:
+				channel.handle_timeout()
+
+	def close(self):
+		""" Abort all pending requests."""
+		for channel in self.socket_map.values():
+			channel.abort('aborted')
+
+	def as_completed(self, futures):
+		""" Run the event loop, yielding futures as they complete."""
+		pending = list(futures)
+		while pending:
+			for future in [f for f in pending if f.done()]:
+				pending.remove(future)
+				yield future
+			if pending:
+				self.poll()
+
+	def run(self, futures):
+		""" Run the event loop until all futures have completed."""
+		for future in self.as_completed(futures):
+			pass
+
+################################################################################
+
+class MockAsyncDownloader:
+	""" Asynchronous twin of MockDownloader: requests are performed by run()
+	    or as_completed(), in the order in which they were made."""
+
+	def __init__(self, www = None):
+		self.mock = MockDownloader(www)
+		self.www = self.mock.www
+		self.__queue = []
+
+	@property
+	def request_count(self):
+		return self.mock.request_count
+
+	@property
+	def _304(self):
+		return self.mock._304
+
+	def commit(self):
+		pass
+
+	def close(self):
+		for future, function, args in self.__queue:
+			future.set_exception((urllib2.URLError, urllib2.URLError('aborted'), None))
+		del self.__queue[:]
+
+	def __defer(self, function, *args):
+		future = Future()
+		self.__queue.append((future, function, args))
+		return future
+
+	def onetime_get_request(self, url, filename):
+		return self.__defer(self.mock.onetime_get_request, url, filename)
+
+	def conditional_get_request(self, url, filename, rate_limit = None):
+		return self.__defer(self.mock.conditional_get_request, url, filename, rate_limit)
+
+	def post(self, url, data, open_sink = None):
+		if open_sink:
+			return self.__defer(self.__post_to_sink, url, data, open_sink)
+		return self.__defer(self.mock.post, url, data)
+
+	def __post_to_sink(self, url, data, open_sink):
+		remote = self.mock.post(url, data)
+		sink = open_sink(remote.info())
+		try:
+			# Small chunks, as if the response arrived in many packets.
+			data = remote.read(1024)
+			while data:
+				sink.write(data)
+				data = remote.read(1024)
+		except Exception:
+			sink.close()
+			raise
+		return sink
+
+	def poll(self):
+		if self.__queue:
+			future, function, args = self.__queue.pop(0)
+			try:
+				future.set_result(function(*args))
+			except Exception:
+				future.set_exception(sys.exc_info())
+
+	def as_completed(self, futures):
+		pending = list(futures)
+		while pending:
+			for future in [f for f in pending if f.done()]:
+				pending.remove(future)
+				yield future
+			if pending:
+				self.poll()
+
+	def run(self, futures):
+		for future in self.as_completed(futures):
+			pass
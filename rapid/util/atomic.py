@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Tobi Vollebregt
+
+from contextlib import contextmanager
+import os
+
+################################################################################
+
+def temp_name(filename):
+	""" Return the name of the temporary file used to write filename.
+	    It is unique per process, as the directory may be shared."""
+	return '%s.%d.tmp' % (filename, os.getpid())
+
+
+@contextmanager
+def atomic_writer(filename):
+	""" Context manager yielding a temporary file which replaces filename
+	    when the block completes, or is removed when the block raises."""
+	temp = temp_name(filename)
+	try:
+		with open(temp, 'wb') as f:
+			yield f
+	except:
+		if os.path.exists(temp):
+			os.remove(temp)
+		raise
+	atomic_rename(temp, filename)
+
+
+def atomic_rename(temp, filename):
+	""" Move temp over filename."""
+	if os.path.exists(filename): # on Windows rename doesn't overwrite destination
+		os.remove(filename)
+	os.rename(temp, filename)
+
+
+def atomic_write(filename, data):
+	with atomic_writer(filename) as f:
+		f.write(data)
@@ -1,26 +1,56 @@
 #!/usr/bin/env python
 # Copyright (C) 2010 Tobi Vollebregt
 
+from atomic import atomic_write, atomic_writer
 from contextlib import closing
-import ConfigParser
+from metadata import MetadataStore
+from urlparse import urljoin, urlsplit
+import httplib
 import os
+import socket
+import threading
 import time
+import urllib
 import urllib2
 
 ################################################################################
 
 timeout = 5     # change timeout here if desired
+post_timeout = 60   # streamer.cgi may take a while to answer large requests
 
-################################################################################
+pool_size = 4            # idle keep-alive connections kept per host
+pool_idle_timeout = 30   # seconds after which idle connections are closed
+
+max_redirects = 5
+
+chunk_size = 64 * 1024   # response bodies are written to disk in chunks
+validate_length = True   # verify the body length against Content-Length
 
-def atomic_write(filename, data):
-	temp = filename + '.tmp'
-	with open(temp, 'wb') as f:
-		f.write(data)
-	if os.path.exists(filename): # on Windows rename doesn't overwrite destination
-		os.remove(filename)
-	os.rename(temp, filename)
+################################################################################
 
+class IncompleteDownloadError(urllib2.URLError):
+	""" Raised when less data is received than announced by the server."""
+	def __init__(self, url, expected, received):
+		urllib2.URLError.__init__(self, 'incomplete download of %s: got %d of %d bytes' % (url, received, expected))
+
+
+def atomic_write_response(filename, remote):
+	""" Like atomic_write, but reads the data from remote in chunks.
+
+	    If validate_length is set, IncompleteDownloadError is raised (and
+	    filename is left untouched) when fewer bytes are received than the
+	    Content-Length header announced."""
+	length = remote.info().getheader('Content-Length')
+	received = 0
+	with atomic_writer(filename) as f:
+		while True:
+			data = remote.read(chunk_size)
+			if not data:
+				break
+			f.write(data)
+			received += len(data)
+		if validate_length and length is not None and received < int(length):
+			raise IncompleteDownloadError(remote.geturl(), int(length), received)
 
 class NotModifiedHandler(urllib2.BaseHandler):
 
@@ -31,43 +61,198 @@ class NotModifiedHandler(urllib2.BaseHandler):
 
 ################################################################################
 
-class Downloader:
-	def __init__(self, config_filename):
-		#print ('reading configuration from ' + config_filename)
-		self.__config = ConfigParser.RawConfigParser()
-		self._304 = False    # for unit tests
-		self.__config_filename = config_filename
-		self.__config.read(config_filename)
+class ConnectionPool(object):
+	""" Per host pool of persistent (HTTP/1.1 keep-alive) connections.
+
+	    Connections are handed out by request() and put back into the pool
+	    when the response has been read completely and closed. At most
+	    pool_size idle connections are kept per host, and connections that
+	    have been idle for more than pool_idle_timeout seconds are closed.
+
+	    Requests which have to go through a proxy (configured using the
+	    http_proxy etc. environment variables) are passed on to urllib2,
+	    which implements proxy support, instead of using the pool."""
+
+	def __init__(self):
+		self.__idle = {}   # (scheme, netloc) -> list of (since, connection)
+		self.__lock = threading.Lock()
+
+	def __evict(self, now):
+		# Caller must hold the lock.
+		for key, idle in self.__idle.items():
+			for since, conn in [x for x in idle if now - x[0] > pool_idle_timeout]:
+				idle.remove((since, conn))
+				conn.close()
+			if not idle:
+				del self.__idle[key]
+
+	def acquire(self, key):
+		""" Return a tuple (connection, reused) for the host identified by key."""
+		with self.__lock:
+			self.__evict(time.time())
+			if key in self.__idle:
+				conn = self.__idle[key].pop()[1]
+				if not self.__idle[key]:
+					del self.__idle[key]
+				return (conn, True)
+		scheme, netloc = key
+		if scheme == 'https':
+			return (httplib.HTTPSConnection(netloc, timeout = timeout), False)
+		return (httplib.HTTPConnection(netloc, timeout = timeout), False)
+
+	def release(self, key, conn):
+		""" Return an idle connection to the pool."""
+		with self.__lock:
+			idle = self.__idle.setdefault(key, [])
+			if len(idle) < pool_size:
+				idle.append((time.time(), conn))
+				conn = None
+		if conn:
+			conn.close()
+
+	def clear(self):
+		""" Close all idle connections."""
+		with self.__lock:
+			for idle in self.__idle.values():
+				for since, conn in idle:
+					conn.close()
+			self.__idle.clear()
+
+	def idle_count(self, key = None):
+		""" Return the number of idle connections (to host key, if given)."""
+		with self.__lock:
+			if key:
+				return len(self.__idle.get(key, []))
+			return sum(len(x) for x in self.__idle.values())
+
+	def request(self, method, url, data = None, headers = None, read_timeout = None):
+		""" Perform a HTTP request and return a PooledResponse.
+
+		    Redirects are followed, error responses (4xx and 5xx) raise
+		    urllib2.HTTPError and network errors raise urllib2.URLError,
+		    consistent with urllib2.urlopen. read_timeout (default: timeout)
+		    is the socket timeout of the request."""
+		headers = dict(headers or {})
+		headers.setdefault('User-Agent', 'Python-urllib/%s' % urllib2.__version__)
+		if data is not None:
+			headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+		read_timeout = read_timeout or timeout
+
+		if uses_proxy(url):
+			request = urllib2.Request(url, data, headers)
+			request.get_method = lambda: method
+			# Not urlopen, its opener keeps using the proxies configured when
+			# it was first called, and does not return 304 responses.
+			return urllib2.build_opener(NotModifiedHandler()).open(request, timeout = read_timeout)
+
+		for i in range(max_redirects + 1):
+			remote = self.__request(method, url, data, headers, read_timeout)
+			if remote.code in (301, 302, 303, 307) and remote.info().getheader('Location'):
+				remote.read()
+				remote.close()
+				url = urljoin(url, remote.info().getheader('Location'))
+				if remote.code != 307:
+					method, data = 'GET', None
+					headers.pop('Content-Type', None)
+				continue
+			if remote.code >= 400:
+				remote.close()
+				raise urllib2.HTTPError(url, remote.code, remote.msg, remote.info(), None)
+			return remote
+		raise urllib2.HTTPError(url, remote.code, 'too many redirects', remote.info(), None)
+
+	def __request(self, method, url, data, headers, read_timeout):
+		scheme, netloc, path, query, fragment = urlsplit(url)
+		key = (scheme, netloc)
+		path = (path or '/') + ('?' + query if query else '')
+		while True:
+			conn, reused = self.acquire(key)
+			try:
+				# Pooled connections may have been used with another timeout.
+				conn.timeout = read_timeout
+				if conn.sock:
+					conn.sock.settimeout(read_timeout)
+				conn.request(method, path, data, headers)
+				return PooledResponse(self, key, conn, conn.getresponse(), url)
+			except (httplib.HTTPException, socket.error) as e:
+				conn.close()
+				# The server may have closed an idle connection, in which case
+				# the request is retried once over a fresh connection.
+				if not reused:
+					raise urllib2.URLError(e)
+
+
+def uses_proxy(url):
+	""" Return true iff a request for url has to go through a proxy."""
+	scheme, netloc = urlsplit(url)[:2]
+	return scheme in urllib2.getproxies() and not urllib.proxy_bypass(netloc.split(':')[0])
+
+
+class PooledResponse(object):
+	""" File-like HTTP response which returns its connection to the pool when
+	    closed, provided the body has been read completely."""
+
+	def __init__(self, pool, key, conn, response, url):
+		self.__pool = pool
+		self.__key = key
+		self.__conn = conn
+		self.__response = response
+		self.__url = url
+		self.code = response.status
+		self.msg = response.reason
+
+	def read(self, amt = None):
+		try:
+			return self.__response.read(amt)
+		except (httplib.HTTPException, socket.error) as e:
+			raise urllib2.URLError(e)
+
+	def info(self):
+		return self.__response.msg
+
+	def geturl(self):
+		return self.__url
+
+	def close(self):
+		if not self.__conn:
+			return
+		response = self.__response
+		if not response.isclosed() and response.length == 0:
+			response.read()
+		if response.isclosed() and not response.will_close:
+			self.__pool.release(self.__key, self.__conn)
+		else:
+			self.__conn.close()
+		self.__conn = None
 
-	def __write_config(self):
-		#print ('writing configuration to ' + self.__config_filename)
-		with open(self.__config_filename, 'wb') as f:
-			self.__config.write(f)
 
-	def __config_get(self, section, option):
-		if self.__config.has_option(section, option):
-			return self.__config.get(section, option)
+connection_pool = ConnectionPool()   # shared by all Downloaders in the process
 
-	def __config_set(self, section, option, value):
-		if value:
-			if not self.__config.has_section(section):
-				self.__config.add_section(section)
-			self.__config.set(section, option, value)
+################################################################################
+
+class Downloader:
+	def __init__(self, config_filename, pool = None):
+		self.__pool = pool or connection_pool
+		self.__metadata = MetadataStore.open(config_filename)
+		self._304 = False    # for unit tests
+
+	def commit(self):
+		""" Persist the metadata (ETags etc.) of all requests made so far.
+		    This is done automatically when the process exits too."""
+		self.__metadata.commit()
 
 	def onetime_get_request(self, url, filename):
 		if os.path.exists(filename):
 			return
 
-		request = urllib2.Request(url, unverifiable=True)
-
-		with closing(urllib2.urlopen(request, timeout = timeout)) as remote:
-			atomic_write(filename, remote.read())
+		with closing(self.__pool.request('GET', url)) as remote:
+			atomic_write_response(filename, remote)
 
 	def conditional_get_request(self, url, filename, rate_limit = None):
 		section = url + ',' + filename
-		etag = self.__config_get(section, 'etag')
-		last_modified = self.__config_get(section, 'last_modified')
-		last_requested = self.__config_get(section, 'last_requested')
+		etag = self.__metadata.get(section, 'etag')
+		last_modified = self.__metadata.get(section, 'last_modified')
+		last_requested = self.__metadata.get(section, 'last_requested')
 
 		# rate limiting
 		if (rate_limit and last_requested and
@@ -75,28 +260,28 @@ class Downloader:
 			os.path.exists(filename)):
 			return
 
-		request = urllib2.Request(url, unverifiable=True)
+		headers = {}
 
 		if os.path.exists(filename):
 			if etag:
-				request.add_header('If-None-Match', etag)
+				headers['If-None-Match'] = etag
 			if last_modified:
-				request.add_header('If-Modified-Since', last_modified)
+				headers['If-Modified-Since'] = last_modified
 
 		try:
-			with closing(urllib2.build_opener(NotModifiedHandler()).open(request, timeout = timeout)) as remote:
-				headers = remote.info()
-				self.__config_set(section, 'etag', headers.getheader('ETag'))
-				self.__config_set(section, 'last_modified', headers.getheader('Last-Modified'))
-				self.__config_set(section, 'last_requested', time.time())
-				self.__write_config()
-
-				if hasattr(remote, 'code') and remote.code == 304:
+			with closing(self.__pool.request('GET', url, headers = headers)) as remote:
+				if remote.code == 304:
 					#print 'the file has not been modified'
 					self._304 = True
-					return
+				else:
+					atomic_write_response(filename, remote)
 
-				atomic_write(filename, remote.read())
+				# Only remember the ETag once the file has been written.
+				headers = remote.info()
+				self.__metadata.update(section,
+					etag = headers.getheader('ETag'),
+					last_modified = headers.getheader('Last-Modified'),
+					last_requested = repr(time.time()))
 
 		except urllib2.URLError:
 			if os.path.exists(filename):
@@ -104,10 +289,7 @@ class Downloader:
 			raise
 
 	def post(self, url, data):
-		request = urllib2.Request(url, unverifiable=True)
-		request.add_data(data)
-
-		return urllib2.urlopen(request)
+		return self.__pool.request('POST', url, data, read_timeout = post_timeout)
 
 ################################################################################
 
@@ -127,6 +309,9 @@ class MockDownloader:
 		self.request_count += 1
 		atomic_write(filename, self.www[url])
 
+	def commit(self):
+		pass
+
 	def conditional_get_request(self, url, filename, rate_limit = None):
 		if (rate_limit and url in self.last_visited and
 			time.time() - self.last_visited[url] <= rate_limit and
@@ -143,8 +328,12 @@ class MockDownloader:
 		self.last_visited[url] = time.time()
 
 	def post(self, url, data):
+		# www may contain a function to emulate e.g. streamer.cgi
+		content = self.www[url]
+		if callable(content):
+			content = content(data)
 		def info():
-			return {'Content-Length': len(self.www[url])}
-		remote = StringIO(self.www[url])
+			return {'Content-Length': len(content)}
+		remote = StringIO(content)
 		remote.info = info
 		return remote
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Tobi Vollebregt
+
+from atomic import atomic_writer
+from StringIO import StringIO
+import mmap
+import os
+import struct
+
+################################################################################
+
+class PackageIndex(object):
+	""" Compact, memory mapped, read-only index of packages.
+
+	    The index stores for each package its hex, name, tags, dependencies,
+	    reverse dependencies and repository, and a sorted table of keys (the
+	    names and tags of the packages), so a key can be looked up using a
+	    binary search without reading the rest of the index.
+
+	    The index is tagged with a signature of the files it was built from,
+	    and open() only returns indices with the expected signature.
+
+	    File format (big endian):
+
+	    header:       'RPI1', signature length (I), signature
+	    counts:       #repositories (I), #packages (I), #keys (I)
+	    repositories: length (H) and name of each repository
+	    packages:     offset (I) of the record of each package
+	    keys:         offset (I), length (H), package number (I) and
+	                  is_tag (B) of each key, sorted by key
+	    strings:      keys and records, where a record is its length (I)
+	                  followed by its NUL separated fields"""
+
+	MAGIC = 'RPI1'
+	KEY = struct.Struct('>IHIB')
+
+	@classmethod
+	def open(cls, filename, signature):
+		""" Return the index in filename, or None if it does not exist, is
+		    corrupt or does not match signature."""
+		try:
+			with open(filename, 'rb') as f:
+				if os.path.getsize(filename) == 0:
+					return None
+				data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		except (IOError, OSError, mmap.error):
+			return None
+		try:
+			index = cls(data)
+			if index.signature == signature:
+				return index
+		except (struct.error, IndexError, ValueError):
+			pass
+		data.close()
+		return None
+
+	@classmethod
+	def write(cls, filename, signature, repositories, records, keys):
+		""" Write an index to filename.
+
+		    records is a list of (hex, name, tags, dependencies,
+		    reverse_dependencies, repository) tuples, where repository is an
+		    index into the list of names repositories, or None. The keys are
+		    (key, package number, is_tag) tuples."""
+		# Everything preceding the strings has a known size.
+		head = StringIO()
+		head.write(cls.MAGIC + struct.pack('>I', len(signature)) + signature)
+		head.write(struct.pack('>III', len(repositories), len(records), len(keys)))
+		for r in repositories:
+			head.write(struct.pack('>H', len(r)) + r)
+		offset = head.tell() + 4 * len(records) + cls.KEY.size * len(keys)
+
+		strings = StringIO()
+		for hex, name, tags, dependencies, reverse_dependencies, repository in records:
+			record = '\0'.join([hex, name, '|'.join(tags), '|'.join(dependencies),
+			                    '|'.join(reverse_dependencies), '' if repository is None else str(repository)])
+			head.write(struct.pack('>I', offset + strings.tell()))
+			strings.write(struct.pack('>I', len(record)) + record)
+		for key, number, is_tag in sorted(keys):
+			head.write(cls.KEY.pack(offset + strings.tell(), len(key), number, is_tag))
+			strings.write(key)
+
+		with atomic_writer(filename) as f:
+			f.write(head.getvalue())
+			f.write(strings.getvalue())
+
+	def __init__(self, data):
+		self.__data = data
+		if data[:4] != self.MAGIC:
+			raise ValueError('not a package index')
+		length = struct.unpack_from('>I', data, 4)[0]
+		self.signature = data[8:8 + length]
+		offset = 8 + length
+		self.__repository_count, self.__package_count, self.__key_count = struct.unpack_from('>III', data, offset)
+		offset += 12
+		self.repositories = []
+		for i in xrange(self.__repository_count):
+			length = struct.unpack_from('>H', data, offset)[0]
+			self.repositories.append(data[offset + 2:offset + 2 + length])
+			offset += 2 + length
+		self.__packages = offset
+		self.__keys = offset + 4 * self.__package_count
+
+	def close(self):
+		self.__data.close()
+
+	def __len__(self):
+		return self.__package_count
+
+	def __key(self, i):
+		offset, length, number, is_tag = self.KEY.unpack_from(self.__data, self.__keys + self.KEY.size * i)
+		return (self.__data[offset:offset + length], number, is_tag)
+
+	def record(self, number):
+		""" Return the (hex, name, tags, dependencies, reverse_dependencies,
+		    repository) of package number. Repository is a name or None."""
+		if not 0 <= number < self.__package_count:
+			raise IndexError(number)
+		offset = struct.unpack_from('>I', self.__data, self.__packages + 4 * number)[0]
+		length = struct.unpack_from('>I', self.__data, offset)[0]
+		fields = self.__data[offset + 4:offset + 4 + length].split('\0')
+		hex, name, tags, dependencies, reverse_dependencies, repository = fields
+		def psv(s):
+			return [x for x in s.split('|') if x]
+		repository = self.repositories[int(repository)] if repository else None
+		return (hex, name, psv(tags), psv(dependencies), psv(reverse_dependencies), repository)
+
+	def find(self, key):
+		""" Return the number of the package with name or tag key, or None."""
+		lo, hi = 0, self.__key_count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.__key(mid)[0] < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo < self.__key_count:
+			k, number, is_tag = self.__key(lo)
+			if k == key:
+				return number
+		return None
+
+	def keys(self):
+		""" Return a list of (key, package number, is_tag) tuples."""
+		return [self.__key(i) for i in xrange(self.__key_count)]
+
+	def tags(self):
+		""" Return the list of all tags."""
+		return [key for key, number, is_tag in self.keys() if is_tag]
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Tobi Vollebregt
+
+from atomic import atomic_write
+from StringIO import StringIO
+import atexit
+import ConfigParser
+import errno
+import os
+import threading
+import time
+
+################################################################################
+
+lock_timeout = 10   # seconds to wait for another process to release a lock
+lock_stale = 60     # seconds after which a lock is assumed to be abandoned
+
+################################################################################
+
+class FileLock(object):
+	""" Inter-process lock, implemented by exclusively creating filename.
+	    This works on all platforms and file systems rapid runs on."""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.__fd = None
+
+	def __enter__(self):
+		start = time.time()
+		while True:
+			try:
+				self.__fd = os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+				os.write(self.__fd, str(os.getpid()))
+				return self
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+			try:
+				if time.time() - os.path.getmtime(self.filename) > lock_stale:
+					os.remove(self.filename)
+					continue
+			except OSError:
+				continue   # lock was released just now
+			if time.time() - start > lock_timeout:
+				raise IOError(errno.EAGAIN, 'could not acquire lock', self.filename)
+			time.sleep(0.05)
+
+	def __exit__(self, type, value, traceback):
+		os.close(self.__fd)
+		os.remove(self.filename)
+		self.__fd = None
+
+
+class MetadataStore(object):
+	""" Persistent mapping from keys (e.g. URLs) to dictionaries of string
+	    fields (e.g. etag, last_modified), stored in ConfigParser format.
+
+	    Updates are kept in memory until commit(), which re-reads the file,
+	    merges the updates into it and atomically replaces it, all while
+	    holding a lock. Hence concurrent processes do not lose each other's
+	    updates, and readers never see a partially written file.
+
+	    Use MetadataStore.open to share one store per file in a process.
+	    Stores with uncommitted updates are committed when the process exits."""
+
+	__stores = {}
+	__stores_lock = threading.Lock()
+
+	@classmethod
+	def open(cls, filename):
+		""" Return the store for filename, creating it if needed."""
+		filename = os.path.abspath(filename)
+		with cls.__stores_lock:
+			if filename in cls.__stores:
+				store = cls.__stores[filename]
+				store.reload()
+			else:
+				store = cls.__stores[filename] = cls(filename)
+		return store
+
+	@classmethod
+	def commit_all(cls):
+		""" Commit all stores opened by MetadataStore.open."""
+		with cls.__stores_lock:
+			stores = cls.__stores.values()
+		for store in stores:
+			# The directory may have been removed meanwhile. (e.g. unit tests)
+			if os.path.isdir(os.path.dirname(store.filename)):
+				store.commit()
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.__lock = threading.Lock()
+		self.__data = {}
+		self.__pending = {}
+		self.__signature = None
+		self.reload()
+
+	def __stat(self):
+		try:
+			st = os.stat(self.filename)
+			return (st.st_mtime, st.st_size, st.st_ino)
+		except OSError:
+			return None
+
+	def __read(self):
+		config = ConfigParser.RawConfigParser()
+		config.read(self.filename)
+		return dict((section, dict(config.items(section))) for section in config.sections())
+
+	def reload(self):
+		""" Re-read the file if it changed, keeping uncommitted updates."""
+		with self.__lock:
+			signature = self.__stat()
+			if signature != self.__signature:
+				self.__data = self.__read()
+				self.__signature = signature
+				for key, fields in self.__pending.iteritems():
+					self.__data.setdefault(key, {}).update(fields)
+
+	def get(self, key, field):
+		""" Return the value of field for key, or None if it is not set."""
+		with self.__lock:
+			return self.__data.get(key, {}).get(field)
+
+	def update(self, key, **fields):
+		""" Set fields for key. Fields with empty values are ignored."""
+		fields = dict((k, str(v)) for k, v in fields.iteritems() if v)
+		with self.__lock:
+			self.__data.setdefault(key, {}).update(fields)
+			self.__pending.setdefault(key, {}).update(fields)
+
+	def commit(self):
+		""" Write uncommitted updates to the file."""
+		with self.__lock:
+			if not self.__pending:
+				return
+			with FileLock(self.filename + '.lock'):
+				data = self.__read()
+				for key, fields in self.__pending.iteritems():
+					data.setdefault(key, {}).update(fields)
+
+				config = ConfigParser.RawConfigParser()
+				for key in sorted(data):
+					config.add_section(key)
+					for field, value in sorted(data[key].iteritems()):
+						config.set(key, field, value)
+				output = StringIO()
+				config.write(output)
+				atomic_write(self.filename, output.getvalue())
+
+				self.__data = data
+				self.__pending = {}
+				self.__signature = self.__stat()
+
+
+atexit.register(MetadataStore.commit_all)
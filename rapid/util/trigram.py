@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Tobi Vollebregt
+
+from array import array
+from atomic import atomic_writer
+import marshal
+
+################################################################################
+
+def trigrams(s):
+	""" Return the set of (lower case) trigrams of s."""
+	s = s.lower()
+	return set(s[i:i + 3] for i in xrange(len(s) - 2))
+
+
+def required_literals(pattern):
+	""" Return a list of strings which occur in every string matched by the
+	    regular expression pattern, or None if they can not be determined.
+
+	    This is conservative: only runs of literal characters outside of
+	    groups and character classes are returned, and patterns containing
+	    alternatives or groups are not analyzed at all."""
+	runs, run = [], ''
+	i = 0
+	while i < len(pattern):
+		c = pattern[i]
+		if c in '(|)':
+			return None
+		if c == '\\':
+			i += 1
+			if i < len(pattern) and not pattern[i].isalnum():
+				run += pattern[i]
+			else:
+				runs.append(run)
+				run = ''
+		elif c in '*?{':
+			# The preceding character is optional.
+			runs.append(run[:-1])
+			run = ''
+			if c == '{':
+				i = pattern.find('}', i)
+				if i < 0:
+					return None
+		elif c == '+':
+			runs.append(run)
+			run = ''
+		elif c == '[':
+			runs.append(run)
+			run = ''
+			# A ']' directly after '[' or '[^' is literal, as is '\]'.
+			i += 1
+			if pattern[i:i + 1] == '^':
+				i += 1
+			if pattern[i:i + 1] == ']':
+				i += 1
+			while i < len(pattern) and pattern[i] != ']':
+				i += 2 if pattern[i] == '\\' else 1
+			if i >= len(pattern):
+				return None
+		elif c in '.^$':
+			runs.append(run)
+			run = ''
+		else:
+			run += c
+		i += 1
+	runs.append(run)
+	return [r for r in runs if r]
+
+################################################################################
+
+class TrigramIndex(object):
+	""" Index of the trigrams of a list of strings (keys), which is used to
+	    find the keys containing a substring, or matching a regular
+	    expression, without scanning all keys. Matching is case-insensitive.
+
+	    The index is tagged with a signature, like PackageIndex, and stored
+	    using marshal. The posting list of each trigram is stored as a
+	    string, which is only converted to an array when it is used."""
+
+	VERSION = 1
+
+	def __init__(self, keys, postings = None):
+		self.keys = list(keys)
+		if postings is None:
+			lists = {}
+			for i, key in enumerate(self.keys):
+				for t in trigrams(key):
+					lists.setdefault(t, array('i')).append(i)
+			postings = dict((t, a.tostring()) for t, a in lists.iteritems())
+		self.__postings = postings
+
+	@classmethod
+	def open(cls, filename, signature):
+		""" Return the index in filename, or None if it does not exist, is
+		    corrupt or does not match signature."""
+		try:
+			with open(filename, 'rb') as f:
+				version, file_signature, keys, postings = marshal.load(f)
+		except (IOError, EOFError, ValueError, TypeError):
+			return None
+		if version != cls.VERSION or file_signature != signature:
+			return None
+		return cls(keys, postings)
+
+	def write(self, filename, signature):
+		with atomic_writer(filename) as f:
+			marshal.dump((self.VERSION, signature, self.keys, self.__postings), f)
+
+	def __lookup(self, literals):
+		""" Return the keys containing all trigrams of all literals, in
+		    index order."""
+		grams = set()
+		for literal in literals:
+			grams.update(trigrams(literal))
+		postings = sorted((self.__postings.get(t, '') for t in grams), key = len)
+		numbers = None
+		for posting in postings:
+			a = array('i')
+			a.fromstring(posting)
+			numbers = set(a) if numbers is None else numbers.intersection(a)
+			if not numbers:
+				return []
+		return [self.keys[i] for i in sorted(numbers)]
+
+	def search(self, needle):
+		""" Return the keys which contain needle."""
+		n = needle.lower()
+		keys = self.keys if len(n) < 3 else self.__lookup([n])
+		return [key for key in keys if n in key.lower()]
+
+	def regex_candidates(self, pattern):
+		""" Return the keys which may match the regular expression pattern
+		    (i.e. a superset of the keys which match it)."""
+		literals = [l for l in required_literals(pattern) or [] if len(l) >= 3]
+		if not literals:
+			return list(self.keys)
+		return self.__lookup(literals)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Tobi Vollebregt
+
+from collections import defaultdict
+import sys
+import threading
+
+################################################################################
+
+def parallel_map(function, items, threads, key = None, per_key = None):
+	""" Apply function to each item using a pool of at most `threads' threads.
+
+	    If key and per_key are given, at most per_key calls run concurrently
+	    for items which have the same key(item) (e.g. the same host).
+
+	    Results are returned in the order of items, so merging them gives the
+	    same result as a serial map. If any call raises an exception, the
+	    remaining items are still processed and the exception belonging to
+	    the first failing item is re-raised afterwards."""
+	items = list(items)
+	if threads <= 1 or len(items) <= 1:
+		return map(function, items)
+
+	keys = [key(x) if key else None for x in items]
+	results = [None] * len(items)
+	errors = [None] * len(items)
+	pending = range(len(items))
+	running = defaultdict(int)
+	cond = threading.Condition()
+
+	def next_index():
+		# Caller must hold cond. Returns None when there is no work left.
+		while pending:
+			for i in pending:
+				if not per_key or running[keys[i]] < per_key:
+					pending.remove(i)
+					running[keys[i]] += 1
+					return i
+			cond.wait()
+		return None
+
+	def worker():
+		while True:
+			with cond:
+				i = next_index()
+			if i is None:
+				return
+			try:
+				results[i] = function(items[i])
+			except Exception:
+				errors[i] = sys.exc_info()
+			with cond:
+				running[keys[i]] -= 1
+				cond.notify_all()
+
+	workers = [threading.Thread(target = worker) for x in range(min(threads, len(items)))]
+	for t in workers:
+		t.daemon = True
+		t.start()
+	for t in workers:
+		t.join()
+
+	for e in errors:
+		if e:
+			raise e[0], e[1], e[2]
+	return results
@@ -0,0 +1,271 @@
+# Copyright (C) 2010 Tobi Vollebregt
+
+import binascii
+import hashlib
+import os
+import shutil
+import struct
+import sys
+import time
+import unittest
+import urllib2
+import rapid.main as main
+import rapid.rapid as rapid
+from cStringIO import StringIO
+from rapid.rapid import Rapid, gzip_string, master_url, mkdir_p, set_spring_dir
+from rapid.ui.text.interaction import TextUserInteraction
+from rapid.util.async_downloader import MockAsyncDownloader
+from rapid.util.downloader import MockDownloader
+
+
+class MockUserInteraction(TextUserInteraction):
+	def __init__(self):
+		TextUserInteraction.__init__(self, True)
+		self.questions = []
+		self.output = []
+
+	def confirm(self, text):
+		self.questions.append(text)
+		return self.force
+
+	def output_header(self, text):
+		self.output.append(text)
+
+	def output_detail(self, text):
+		self.output.append(text)
+
+
+class TestMain(unittest.TestCase):
+	test_dir = os.path.realpath('.test-main')
+	md5 = binascii.unhexlify('d41d8cd98f00b204e9800998ecf8427e')
+
+	def setUp(self):
+		set_spring_dir(self.test_dir)
+		mkdir_p(rapid.pool_dir)
+		self.old_stdout = sys.stdout
+		sys.stdout = StringIO()
+		self.retry_delay = rapid.STREAMER_RETRY_DELAY
+		rapid.STREAMER_RETRY_DELAY = 0
+		self.downloader = MockDownloader()
+		www = self.downloader.www
+		www[master_url] = gzip_string(',http://ts1,,\n')
+		www['http://ts1/versions.gz'] = gzip_string('xta:latest,1234,dependency,XTA 9.6\n,5678,,dependency\n')
+		www['http://ts1/packages/1234.sdp'] = gzip_string('\3foo' + self.md5 + 8 * '\0')
+		www['http://ts1/packages/5678.sdp'] = gzip_string('')
+		www['http://ts1/streamer.cgi?1234'] = struct.pack('>L', len(gzip_string(''))) + gzip_string('')
+		self.ui = MockUserInteraction()
+		self.rapid = main.rapid
+		main.ui = self.ui
+		main.rapid = Rapid(self.downloader)
+		main.pool_dir = rapid.pool_dir
+		main.content_dir = rapid.content_dir
+
+	def tearDown(self):
+		main.rapid = self.rapid
+		rapid.STREAMER_RETRY_DELAY = self.retry_delay
+		sys.stdout = self.old_stdout
+		shutil.rmtree(self.test_dir)
+
+	def lazy_rapid(self):
+		""" Return a Rapid with lazy packages, which uses the package index
+		    written by the current one."""
+		self.assertEqual(2, len(main.rapid.packages))
+		main.rapid = Rapid(self.downloader)
+		main.rapid.packages.lazy = True
+		return main.rapid
+
+	def test_pin_lazy(self):
+		self.lazy_rapid()
+		main.pin('xta:latest')
+		self.assertTrue('xta:latest' in main.rapid.pinned_tags)
+		self.assertTrue(main.rapid.packages.lookup('XTA 9.6').installed)
+		self.assertTrue(main.rapid.packages.lookup('dependency').installed)
+
+	def test_upgrade_lazy(self):
+		main.pin('xta:latest')
+		r = self.lazy_rapid()
+		upgraded = []
+		install_many = main.install_many
+		try:
+			main.install_many = lambda packages: upgraded.extend(packages) or install_many(packages)
+			main.upgrade()
+		finally:
+			main.install_many = install_many
+		self.assertEqual([r.packages.lookup('xta:latest')], upgraded)
+		self.assertFalse(isinstance(upgraded[0], rapid.IndexedPackage))
+		self.assertTrue(Rapid(self.downloader).upgrade_is_noop())
+
+	def test_uninstall_lazy(self):
+		main.pin('xta:latest')
+		r = self.lazy_rapid()
+		self.assertFalse(r.packages['dependency'].can_be_uninstalled)
+		main.uninstall('dependency')
+		self.assertTrue(r.packages['dependency'].installed)
+
+	def test_uninstall_unpinned_lazy(self):
+		main.pin('xta:latest')
+		self.lazy_rapid()
+		main.uninstall_unpinned()
+		self.assertEqual([], self.ui.questions)
+		self.assertTrue(main.rapid.packages['XTA 9.6'].installed)
+		self.assertTrue(main.rapid.packages['dependency'].installed)
+
+	def test_unpin_offline(self):
+		main.pin('xta:latest')
+		main.rapid = Rapid(self.downloader)
+		self.ui.candidates = main.rapid.packages.candidates
+		request_count = self.downloader.request_count
+		old_time = time.time
+		try:
+			# Unpinning does not refresh the repositories, even if the
+			# rate limit has expired.
+			time.time = lambda: old_time() + rapid.MASTER_RATE_LIMIT + 1
+			main.unpin('latest')
+		finally:
+			time.time = old_time
+		self.assertEqual(request_count, self.downloader.request_count)
+		self.assertFalse('xta:latest' in main.rapid.pinned_tags)
+
+	def streamer_requests(self, url, response = None):
+		""" Count the requests to url, which fail with HTTP 404 unless a
+		    response is given."""
+		requests = []
+		def streamer(data):
+			requests.append(data)
+			if response is None:
+				raise urllib2.HTTPError(url, 404, 'Not Found', {}, None)
+			return response
+		self.downloader.www[url] = streamer
+		return requests
+
+	def test_install_many(self):
+		requests = self.streamer_requests('http://ts1/streamer.cgi?1234', self.downloader.www['http://ts1/streamer.cgi?1234'])
+		main.install_many([main.rapid.packages['XTA 9.6']])
+		self.assertTrue(main.rapid.packages['XTA 9.6'].installed)
+		self.assertTrue(main.rapid.packages['dependency'].installed)
+		self.assertTrue(os.path.exists(rapid.pool_path(self.md5)))
+		self.assertEqual(1, len(requests))
+
+	def test_install_many_failure(self):
+		# The dependency has a file which can not be downloaded.
+		www = self.downloader.www
+		www['http://ts1/packages/5678.sdp'] = gzip_string('\3bar' + hashlib.md5('bar').digest() + 8 * '\0')
+		requests = self.streamer_requests('http://ts1/streamer.cgi?5678')
+		try:
+			main.install_many([main.rapid.packages['XTA 9.6']])
+			self.fail('expected HTTP 404')
+		except urllib2.HTTPError as e:
+			self.assertEqual(404, e.code)
+		# Neither the dependency nor the package depending on it is installed,
+		# and the failed download is not retried by Package.install.
+		self.assertFalse(main.rapid.packages['dependency'].installed)
+		self.assertFalse(main.rapid.packages['XTA 9.6'].installed)
+		self.assertEqual(1, len(requests))
+		# The files of the package itself have been downloaded.
+		self.assertTrue(os.path.exists(rapid.pool_path(self.md5)))
+
+	def test_install_many_install_failure(self):
+		requests = self.streamer_requests('http://ts1/streamer.cgi?1234', self.downloader.www['http://ts1/streamer.cgi?1234'])
+		dependency = main.rapid.packages['dependency']
+		def install(progress = None):
+			raise IOError('disk full')
+		dependency.install = install
+		self.assertRaises(IOError, main.install_many, [main.rapid.packages['XTA 9.6']])
+		# The downloads are finished before the error is raised.
+		self.assertEqual(1, len(requests))
+		self.assertTrue(os.path.exists(rapid.pool_path(self.md5)))
+		self.assertFalse(main.rapid.packages['XTA 9.6'].installed)
+
+	def test_install_many_event_loop(self):
+		requests = self.streamer_requests('http://ts1/streamer.cgi?1234', self.downloader.www['http://ts1/streamer.cgi?1234'])
+		main.install_many_event_loop([main.rapid.packages['XTA 9.6']], MockAsyncDownloader(self.downloader.www))
+		self.assertTrue(main.rapid.packages['XTA 9.6'].installed)
+		self.assertTrue(main.rapid.packages['dependency'].installed)
+		self.assertTrue(os.path.exists(rapid.pool_path(self.md5)))
+		self.assertEqual(1, len(requests))
+
+	def test_install_many_event_loop_failure(self):
+		www = self.downloader.www
+		www['http://ts1/packages/5678.sdp'] = gzip_string('\3bar' + hashlib.md5('bar').digest() + 8 * '\0')
+		requests = self.streamer_requests('http://ts1/streamer.cgi?5678')
+		try:
+			main.install_many_event_loop([main.rapid.packages['XTA 9.6']], MockAsyncDownloader(www))
+			self.fail('expected HTTP 404')
+		except urllib2.HTTPError as e:
+			self.assertEqual(404, e.code)
+		self.assertFalse(main.rapid.packages['dependency'].installed)
+		self.assertFalse(main.rapid.packages['XTA 9.6'].installed)
+		self.assertTrue(os.path.exists(rapid.pool_path(self.md5)))
+		# The failed request is retried once by Package.download_files.
+		self.assertEqual(2, len(requests))
+
+	def test_install_many_event_loop_sdp_failure(self):
+		www = self.downloader.www
+		www['http://ts1/versions.gz'] += gzip_string(',90ab,,other\n')
+		www['http://ts1/packages/90ab.sdp'] = gzip_string('')
+		del www['http://ts1/packages/5678.sdp']
+		packages = [main.rapid.packages['XTA 9.6'], main.rapid.packages['other']]
+		self.assertRaises(KeyError, main.install_many_event_loop, packages, MockAsyncDownloader(www))
+		# Only the package whose .sdp could be downloaded is installed.
+		self.assertFalse(main.rapid.packages['dependency'].installed)
+		self.assertFalse(main.rapid.packages['XTA 9.6'].installed)
+		self.assertTrue(main.rapid.packages['other'].installed)
+
+	def test_show_plan(self):
+		requests = self.streamer_requests('http://ts1/streamer.cgi?1234')
+		main.dry_run = True
+		try:
+			main.install('XTA 9.6')
+		finally:
+			main.dry_run = False
+		self.assertEqual([], requests)
+		self.assertFalse(main.rapid.packages['XTA 9.6'].installed)
+		self.assertEqual(['Packages to install:', 'dependency (dependency)', 'XTA 9.6', 'Total'],
+			[line[:40].strip() for line in self.ui.output])
+		self.assertEqual(['0', '1', '1'], [line[40:].split()[0] for line in self.ui.output[1:]])
+
+	def test_show_plan_seed_pool(self):
+		seed_pool = os.path.join(self.test_dir, 'seed')
+		source = os.path.join(seed_pool, os.path.relpath(rapid.pool_path(self.md5), rapid.pool_dir))
+		mkdir_p(os.path.dirname(source))
+		with open(source, 'wb') as f:
+			f.write(gzip_string(''))
+		rapid.seed_pools = [seed_pool]
+		main.dry_run = True
+		try:
+			main.install('XTA 9.6')
+		finally:
+			main.dry_run = False
+			rapid.seed_pools = []
+		# The file in the seed pool is not counted as download.
+		self.assertEqual(['0', '0', '0'], [line[40:].split()[0] for line in self.ui.output[1:]])
+		self.assertFalse(os.path.exists(rapid.pool_path(self.md5)))
+
+	def test_collect_pool(self):
+		for i in range(256):
+			mkdir_p(os.path.join(rapid.pool_dir, '%02x' % i))
+		main.install('XTA 9.6')
+		p = main.rapid.packages['XTA 9.6']
+		garbage = rapid.pool_path(16 * '\1')
+		open(garbage, 'wb').close()
+		main.collect_pool()
+		self.assertFalse(os.path.exists(garbage))
+		self.assertTrue(os.path.exists(p.files[0].pool_path))
+
+	def test_collect_pool_unreadable_package(self):
+		for i in range(256):
+			mkdir_p(os.path.join(rapid.pool_dir, '%02x' % i))
+		main.install('XTA 9.6')
+		p = main.rapid.packages['XTA 9.6']
+		with open(os.path.join(rapid.package_dir, '90AB.sdp'), 'wb') as f:
+			f.write(gzip_string('\3fo'))
+		garbage = rapid.pool_path(16 * '\1')
+		open(garbage, 'wb').close()
+		main.collect_pool()
+		self.assertEqual([], self.ui.questions)
+		self.assertTrue(os.path.exists(garbage))
+		self.assertTrue(os.path.exists(p.files[0].pool_path))
+
+
+if __name__ == '__main__':
+	unittest.main()
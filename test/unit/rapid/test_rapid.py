@@ -1,13 +1,23 @@
 # Copyright (C) 2010 Tobi Vollebregt
 
 import binascii
+import gzip
+import hashlib
+import logging
 import os
 import shutil
 import struct
+import time
 import unittest
+import urllib2
 import rapid.rapid as rapid
+from bitarray import bitarray
+from StringIO import StringIO
 from rapid.rapid import DependencyException, DetachedPackageException, OfflineRepositoryException, \
-	PinnedTags, Rapid, mkdir_p, set_spring_dir, gzip_string, master_url
+	PackageFormatException, PoolDirectoryException, PoolReferencesException, StreamerFormatException, StreamerWriter, GzipMd5, PinnedTags, ProgressGroup, Rapid, balanced_shards, mkdir_p, set_spring_dir, gzip_string, \
+	master_url, parse_sdp, plan_downloads, pool_md5, pool_path
+from rapid.ui.text.interaction import TextUserInteraction
+from rapid.util.atomic import temp_name
 from rapid.util.downloader import MockDownloader
 
 
@@ -49,12 +59,212 @@ class TestPinnedTags(unittest.TestCase):
 		self.assertTrue('foo' in PinnedTags())
 
 
+class TestGzipMd5(unittest.TestCase):
+
+	def digest(self, data, chunk_size):
+		checksum = GzipMd5()
+		for i in range(0, len(data), chunk_size):
+			checksum.update(data[i:i + chunk_size])
+		return checksum.digest()
+
+	def test_chunks(self):
+		data = os.urandom(1000) * 300
+		for chunk_size in (1, 7, 4096, 10 ** 6):
+			self.assertEqual(hashlib.md5(data).digest(), self.digest(gzip_string(data), chunk_size))
+
+	def test_multiple_members(self):
+		self.assertEqual(hashlib.md5('foobar').digest(), self.digest(gzip_string('foo') + gzip_string('bar'), 5))
+
+
+class TestBalancedShards(unittest.TestCase):
+
+	class MockFile(object):
+		def __init__(self, size):
+			self.size = size
+
+	def setUp(self):
+		self.old_min_shard_size = rapid.STREAMER_MIN_SHARD_SIZE
+		rapid.STREAMER_MIN_SHARD_SIZE = 10
+
+	def tearDown(self):
+		rapid.STREAMER_MIN_SHARD_SIZE = self.old_min_shard_size
+
+	def test_balanced(self):
+		files = [self.MockFile(x) for x in (50, 10, 20, 30, 40, 50)]
+		shards = balanced_shards(files, 2)
+		self.assertEqual([100, 100], [sum(f.size for f in x) for x in shards])
+		# order of files is preserved within each shard
+		for x in shards:
+			self.assertEqual(sorted(x, key = files.index), x)
+
+	def test_min_shard_size(self):
+		files = [self.MockFile(x) for x in (4, 4, 4, 4)]
+		self.assertEqual([files], balanced_shards(files, 4))
+		files.append(self.MockFile(4))
+		self.assertEqual(2, len(balanced_shards(files, 4)))
+
+	def test_few_files(self):
+		files = [self.MockFile(100)]
+		self.assertEqual([files], balanced_shards(files, 4))
+
+
+class MockProgress(object):
+	def __init__(self):
+		self.value = 0
+		self.max = None
+
+	def __call__(self, value):
+		self.value += value
+
+	def setMaximum(self, value):
+		self.max = value
+
+	def maximum(self):
+		return self.max
+
+
+class TestProgressGroup(unittest.TestCase):
+
+	def test_parts(self):
+		progress = MockProgress()
+		group = ProgressGroup(progress)
+		a, b = group.part(), group.part()
+		a.setMaximum(10)
+		b.setMaximum(20)
+		a(5)
+		b(20)
+		a.setMaximum(15)   # e.g. when resuming an interrupted download
+		self.assertEqual(15, a.maximum())
+		self.assertEqual(35, progress.maximum())
+		self.assertEqual(25, progress.value)
+
+
+class TestSharedPool(unittest.TestCase):
+	test_dir = os.path.realpath('.test-rapid')
+	shared_dir = os.path.join(test_dir, 'shared')
+
+	def setUp(self):
+		mkdir_p(self.test_dir)
+		self.downloader = MockDownloader()
+		www = self.downloader.www
+		www[master_url] = gzip_string(',http://ts1,,\n')
+		www['http://ts1/versions.gz'] = gzip_string('xta:latest,1234,,XTA 9.6\n')
+		www['http://ts1/packages/1234.sdp'] = gzip_string('\3foo' + binascii.unhexlify('d41d8cd98f00b204e9800998ecf8427e') + 8 * '\0')
+		www['http://ts1/streamer.cgi?1234'] = struct.pack('>L', len(gzip_string(''))) + gzip_string('')
+
+	def tearDown(self):
+		shutil.rmtree(self.test_dir)
+
+	def rapid_for(self, name):
+		set_spring_dir(os.path.join(self.test_dir, name), self.shared_dir)
+		return Rapid(self.downloader)
+
+	def test_shared_pool(self):
+		a = self.rapid_for('a')
+		a.packages['xta:latest'].install()
+		a.pinned_tags.add('xta:latest')
+		b = self.rapid_for('b')
+		self.assertEqual(os.path.join(self.shared_dir, 'pool'), rapid.pool_dir)
+		self.assertEqual(os.path.realpath(rapid.pool_dir), os.path.realpath(os.path.join(self.test_dir, 'b', 'pool')))
+		# Packages and pinned tags are per data directory.
+		self.assertFalse(b.packages['xta:latest'].installed)
+		self.assertEqual(0, len(b.pinned_tags))
+		# Files installed in any data directory are live.
+		self.assertEqual([os.path.join(self.test_dir, x) for x in 'ab'], b.data_dirs)
+		self.assertEqual(set(f.pool_path for f in b.packages['xta:latest'].files), b.live_pool_paths())
+
+	def test_removed_data_dir(self):
+		a = self.rapid_for('a')
+		a.packages['xta:latest'].install()
+		b = self.rapid_for('b')
+		shutil.rmtree(os.path.join(self.test_dir, 'a'))
+		self.assertEqual([os.path.join(self.test_dir, 'b')], b.data_dirs)
+		self.assertEqual(set(), b.live_pool_paths())
+
+	def test_migrate_pool(self):
+		# A data directory which used its own pool before sharing it.
+		set_spring_dir(os.path.join(self.test_dir, 'c'))
+		Rapid(self.downloader)
+		for name in ('d41d8cd98f00b204e9800998ecf8427e', 32 * '0'):
+			with open(os.path.join(rapid.pool_dir, name[:2], name[2:] + '.gz'), 'wb') as f:
+				f.write(name)
+		mkdir_p(os.path.join(self.shared_dir, 'pool', '00'))
+		with open(os.path.join(self.shared_dir, 'pool', '00', 30 * '0' + '.gz'), 'wb') as f:
+			f.write('shared')
+		c = self.rapid_for('c')
+		self.assertTrue(os.path.islink(os.path.join(self.test_dir, 'c', 'pool')))
+		self.assertEqual('d41d8cd98f00b204e9800998ecf8427e', open(os.path.join(rapid.pool_dir, 'd4', '1d8cd98f00b204e9800998ecf8427e.gz')).read())
+		# Files which are in the shared pool already are not replaced.
+		self.assertEqual('shared', open(os.path.join(rapid.pool_dir, '00', 30 * '0' + '.gz')).read())
+
+	def test_pool_linked_elsewhere(self):
+		mkdir_p(os.path.join(self.test_dir, 'c'))
+		mkdir_p(os.path.join(self.test_dir, 'other'))
+		os.symlink(os.path.join(self.test_dir, 'other'), os.path.join(self.test_dir, 'c', 'pool'))
+		self.assertRaises(PoolDirectoryException, self.rapid_for, 'c')
+
+	def test_why(self):
+		a = self.rapid_for('a')
+		a.packages['xta:latest'].install()
+		b = self.rapid_for('b')
+		b.packages['xta:latest'].install()
+		md5 = b.packages['xta:latest'].files[0].md5
+		self.assertEqual([(os.path.join(self.test_dir, x), '1234', 'XTA 9.6') for x in 'ab'], b.why(md5))
+		b.packages['xta:latest'].uninstall()
+		self.assertEqual([(os.path.join(self.test_dir, 'a'), '1234', 'XTA 9.6')], b.why(md5))
+		self.assertEqual(set([md5]), b.live_md5s())
+		self.assertEqual([], b.why(16 * '\0'))
+
+	def test_pool_references_sync(self):
+		a = self.rapid_for('a')
+		a.packages['xta:latest'].install()
+		# Packages removed (or added) behind rapid's back are picked up.
+		os.remove(os.path.join(self.test_dir, 'a', 'packages', '1234.sdp'))
+		self.assertEqual(set(), self.rapid_for('b').live_md5s())
+		shutil.copy(a.packages['xta:latest'].cache_file, os.path.join(self.test_dir, 'a', 'packages'))
+		self.assertEqual([(os.path.join(self.test_dir, 'a'), '1234', '1234')], a.why(a.packages['xta:latest'].files[0].md5))
+
+	def test_pool_references_unreadable(self):
+		a = self.rapid_for('a')
+		a.packages['xta:latest'].install()
+		bad = os.path.join(self.test_dir, 'a', 'packages', '5678.sdp')
+		with open(bad, 'wb') as f:
+			f.write(gzip_string('\3fo'))
+		# Pool files of an installed package which can not be read are not
+		# known, so none are known to be unused.
+		b = self.rapid_for('b')
+		self.assertRaises(PoolReferencesException, b.live_md5s)
+		self.assertRaises(PoolReferencesException, b.live_md5s)
+		os.remove(bad)
+		self.assertEqual(set([a.packages['xta:latest'].files[0].md5]), b.live_md5s())
+
+	def test_pool_md5(self):
+		md5 = binascii.unhexlify('d41d8cd98f00b204e9800998ecf8427e')
+		self.assertEqual(md5, pool_md5(pool_path(md5)))
+		self.assertEqual(md5, pool_md5('d41d8cd98f00b204e9800998ecf8427e'))
+		self.assertEqual(None, pool_md5('d4/1d8cd98f00b204e9800998ecf8427e.gz.tmp'))
+		self.assertEqual(None, pool_md5('foo'))
+
+
+class MessageRecorder(logging.Handler):
+	def __init__(self, messages):
+		logging.Handler.__init__(self)
+		self.messages = messages
+
+	def emit(self, record):
+		self.messages.append(record.getMessage())
+
+
 class TestRapid(unittest.TestCase):
 	test_dir = os.path.realpath('.test-rapid')
+	retry_delay = rapid.STREAMER_RETRY_DELAY
 
 	def setUp(self):
 		set_spring_dir(self.test_dir)
 
+		# Retry interrupted downloads immediately.
+		rapid.STREAMER_RETRY_DELAY = 0
+
 		# Speed up the test because if pool is present the 256 pool
 		# directories are created on demand instead of beforehand.
 		mkdir_p(rapid.pool_dir)
@@ -78,11 +288,275 @@ class TestRapid(unittest.TestCase):
 			self.rapid = Rapid(self.downloader)
 
 	def tearDown(self):
+		rapid.STREAMER_RETRY_DELAY = self.retry_delay
+		rapid.mirror_url = None
+		rapid.seed_pools = []
 		shutil.rmtree(self.test_dir)
 
 	def test_get_repositories(self):
 		self.assertEqual(1, len(self.rapid.repositories))
 
+	def test_refresh_multiple_repositories(self):
+		www = self.downloader.www
+		www[master_url] = gzip_string(',http://ts2,,\n,http://ts1,,\n')
+		www['http://ts2/versions.gz'] = gzip_string('ba:latest,CDEF,,BA 7.0\nxta:test,1234,dependency,XTA 9.6\n')
+		self.assertEqual(['http://ts1', 'http://ts2'], [r.url for r in self.rapid.repositories])
+		self.assertEqual(3, len(self.rapid.packages))
+		self.assertEqual('CDEF', self.rapid.packages['ba:latest'].hex)
+		# Both repositories offer 'XTA 9.6', the last one (in URL order) wins.
+		self.assertEqual(set(['xta:test']), self.rapid.packages['XTA 9.6'].tags)
+		self.assertEqual(3, self.downloader.request_count)
+
+	def test_mirror_url(self):
+		www = self.downloader.www
+		rapid.mirror_url = 'http://mirror:8080/'
+		www['http://mirror:8080/repos.gz'] = www[master_url]
+		www['http://mirror:8080/ts1/versions.gz'] = www['http://ts1/versions.gz']
+		self.assertEqual(['http://mirror:8080/ts1'], [r.url for r in self.rapid.repositories])
+		self.assertEqual(os.path.join(rapid.content_dir, 'ts1'), self.rapid.repositories[0].cache_dir)
+		self.assertEqual(2, len(self.rapid.packages))
+
+	def test_mirror_url_unavailable(self):
+		class Unreachable(dict):
+			def __missing__(self, key):
+				raise urllib2.URLError('unreachable')
+		self.downloader.www = Unreachable(self.downloader.www)
+		rapid.mirror_url = 'http://mirror:8080'
+		self.assertEqual(['http://ts1'], [r.url for r in self.rapid.repositories])
+
+	def test_package_index(self):
+		self.assertEqual(2, len(self.rapid.packages))
+		read_versions_gz = rapid.Repository.read_versions_gz
+		try:
+			def fail(self):
+				raise AssertionError('versions.gz should not be read')
+			rapid.Repository.read_versions_gz = fail
+			packages = Rapid(self.downloader).packages
+			self.assertTrue(packages.index)
+			p = packages['xta:latest']
+			self.assertTrue(p is packages['XTA 9.6'])
+			self.assertTrue(p is packages[p])
+			self.assertEqual('1234', p.hex)
+			self.assertEqual(set(['xta:latest']), p.tags)
+			self.assertEqual(['dependency'], [d.name for d in p.dependencies])
+			self.assertEqual(set([p]), list(p.dependencies)[0].reverse_dependencies)
+			self.assertEqual('http://ts1', p.repository.url)
+			self.assertFalse('XXXXXX' in packages)
+			self.assertRaises(KeyError, lambda: packages['XXXXXX'])
+			self.assertEqual(set(['xta:latest']), packages.tags)
+			self.assertEqual(2, len(packages))
+		finally:
+			rapid.Repository.read_versions_gz = read_versions_gz
+
+	def test_package_index_outdated(self):
+		self.assertEqual(2, len(self.rapid.packages))
+		versions_gz = self.rapid.repositories[0].versions_gz
+		with open(versions_gz, 'wb') as f:
+			f.write(gzip_string('xta:latest,1234,,XTA 9.6\nba:latest,CDEF,,BA 7.0\n'))
+		packages = Rapid(self.downloader).packages
+		self.assertFalse(packages.index)
+		self.assertEqual(3, len(packages))
+
+	def test_packages_gz_unchanged(self):
+		self.rapid.packages.load()
+		packages_gz = self.rapid.packages.packages_gz
+		os.utime(packages_gz, (0, 0))
+		self.rapid.packages.load()
+		self.assertEqual(0, os.path.getmtime(packages_gz))
+
+	def test_packages_gz_append(self):
+		self.rapid.packages.load()
+		packages_gz = self.rapid.packages.packages_gz
+		before = open(packages_gz, 'rb').read()
+		versions_gz = self.rapid.repositories[0].versions_gz
+		with open(versions_gz, 'wb') as f:
+			f.write(gzip_string('xta:latest,1234,dependency,XTA 9.6\n,5678,,dependency\nba:latest,CDEF,,BA 7.0\n'))
+		Rapid(self.downloader).packages.load()
+		after = open(packages_gz, 'rb').read()
+		self.assertTrue(after.startswith(before))
+		# two original lines + one appended line (BA 7.0 is new)
+		self.assertEqual(3, len(gzip.open(packages_gz).readlines()))
+		self.assertEqual(3, len(Rapid(self.downloader).packages))
+
+	def test_versions_cache(self):
+		repository = self.rapid.repositories[0]
+		packages = repository.packages
+		self.assertTrue(os.path.exists(repository.versions_cache))
+		repository = Rapid(self.downloader).repositories[0]
+		gzip_open = rapid.gzip.open
+		try:
+			def fail(*args):
+				raise AssertionError('versions.gz should not be read')
+			rapid.gzip.open = fail
+			cached = repository.read_versions_gz()
+		finally:
+			rapid.gzip.open = gzip_open
+		self.assertEqual(sorted(packages), sorted(cached))
+		self.assertEqual(set(['xta:latest']), cached['XTA 9.6'].tags)
+		self.assertEqual(['dependency'], cached['XTA 9.6'].dependencies)
+
+	def test_versions_cache_outdated(self):
+		repository = self.rapid.repositories[0]
+		repository.packages
+		with open(repository.versions_gz, 'wb') as f:
+			f.write(gzip_string('ba:latest,CDEF,,BA 7.0\n'))
+		self.assertEqual(['BA 7.0'], Rapid(self.downloader).repositories[0].read_versions_gz().keys())
+
+	def test_upgrade_is_noop(self):
+		self.assertFalse(self.rapid.upgrade_is_noop())
+		self.rapid.pinned_tags.add('xta:latest')
+		p = self.rapid.packages['xta:latest']
+		for d in p.dependencies:
+			d.install()
+		self.rapid.save_upgrade_state([p])
+		self.assertFalse(self.rapid.upgrade_is_noop(), 'nothing should be saved before installing')
+		p.install()
+		self.rapid.save_upgrade_state([p])
+		self.assertTrue(Rapid(self.downloader).upgrade_is_noop())
+		self.assertTrue(Rapid(self.downloader).upgrade_is_noop(exact = True))
+		# An unpinned package is installed.
+		open(os.path.join(rapid.package_dir, 'ABCD.sdp'), 'wb').close()
+		self.assertTrue(Rapid(self.downloader).upgrade_is_noop())
+		self.assertFalse(Rapid(self.downloader).upgrade_is_noop(exact = True))
+
+	def test_upgrade_is_noop_changed(self):
+		self.rapid.pinned_tags.add('xta:latest')
+		p = self.rapid.packages['xta:latest']
+		for x in list(p.dependencies) + [p]:
+			x.install()
+		self.rapid.save_upgrade_state([p])
+		# A tag is pinned.
+		r = Rapid(self.downloader)
+		r.pinned_tags.add('ba:latest')
+		self.assertFalse(r.upgrade_is_noop())
+		r.pinned_tags.remove('ba:latest')
+		self.assertTrue(r.upgrade_is_noop())
+		# A package is uninstalled.
+		os.remove(p.installed_path)
+		self.assertFalse(Rapid(self.downloader).upgrade_is_noop())
+		p.install()
+		# versions.gz changed.
+		with open(self.rapid.repositories[0].versions_gz, 'wb') as f:
+			f.write(gzip_string('xta:latest,1234,dependency,XTA 9.6\n,5678,,dependency\nba:latest,CDEF,,BA 7.0\n'))
+		self.assertFalse(Rapid(self.downloader).upgrade_is_noop())
+
+	def test_lazy_lookup(self):
+		www = self.downloader.www
+		www[master_url] = gzip_string(',http://ts2,,\n,http://ts1,,\n')
+		www['http://ts2/versions.gz'] = gzip_string('ba:latest,CDEF,,BA 7.0\n')
+		self.assertEqual(3, len(self.rapid.packages))
+		r = Rapid(self.downloader)
+		r.packages.lazy = True
+		read_versions_gz = rapid.Repository.read_versions_gz
+		try:
+			def count(repository):
+				loaded.append(repository.cache_dir)
+				return read_versions_gz(repository)
+			loaded = []
+			rapid.Repository.read_versions_gz = count
+			p = r.packages.lookup('xta:latest')
+			self.assertTrue(p is r.packages.lookup('XTA 9.6'))
+			self.assertEqual(['dependency'], [d.name for d in p.dependencies])
+			self.assertEqual(None, r.packages.lookup('XXXXXX'))
+		finally:
+			rapid.Repository.read_versions_gz = read_versions_gz
+		# Only the repository offering XTA 9.6 and its dependency is loaded.
+		self.assertEqual([r.repositories[0].cache_dir], loaded)
+		self.assertFalse(isinstance(p, rapid.IndexedPackage))
+		self.assertEqual('1234', p.hex)
+		# Indexing does not return lazily looked up packages, which do not
+		# know their reverse dependencies.
+		self.assertTrue(isinstance(r.packages['xta:latest'], rapid.IndexedPackage))
+
+	def test_lazy_lookup_moved(self):
+		self.assertEqual(2, len(self.rapid.packages))
+		versions_gz = self.rapid.repositories[0].versions_gz
+		with open(versions_gz, 'wb') as f:
+			f.write(gzip_string('xta:stable,1234,,XTA 9.6\n'))
+		r = Rapid(self.downloader)
+		r.packages.lazy = True
+		self.assertEqual(None, r.packages.lookup('xta:latest'))
+		self.assertEqual(set(['xta:stable']), r.packages['XTA 9.6'].tags)
+
+	def test_search_candidates(self):
+		self.assertEqual(2, len(self.rapid.packages))
+		packages = Rapid(self.downloader).packages
+		self.assertTrue(packages.search_index)
+		self.assertEqual(['xta:latest'], packages.candidates('latest', packages.tags))
+		# Other haystacks are not narrowed down.
+		self.assertEqual(['dependency', 'XTA 9.6'], packages.candidates('9.6', ['dependency', 'XTA 9.6']))
+		self.assertEqual([packages['XTA 9.6']], packages.candidates('xta', packages))
+		self.assertEqual(['xta:latest'], packages.candidates('^xta:l', packages.tags, True))
+		r = Rapid(self.downloader)
+		r.pinned_tags.add('old:tag')
+		r.pinned_tags.add('xta:latest')
+		ui = TextUserInteraction()
+		ui.candidates = r.packages.candidates
+		self.assertEqual(['old:tag'], ui.select('pinned tag', 'old', r.pinned_tags))
+
+	def test_installed_snapshot(self):
+		p = self.rapid.packages['dependency']
+		self.assertFalse(p.installed)
+		p.install()
+		self.assertTrue(p.installed, 'install should invalidate the snapshot')
+		os.remove(p.installed_path)
+		old_time = time.time
+		try:
+			# Another process uninstalled the package, which is noticed
+			# when package_dir is checked again.
+			time.time = lambda: old_time() + rapid.SNAPSHOT_TTL + 1
+			os.utime(rapid.package_dir, (0, 0))
+			self.assertFalse(p.installed)
+		finally:
+			time.time = old_time
+
+	def test_pool_snapshot(self):
+		p = self.rapid.packages['XTA 9.6']
+		f = p.files[0]
+		self.assertFalse(f.available)
+		p.download_files(p.files)
+		self.assertTrue(f.available, 'downloads should be added to the snapshot')
+		os.remove(f.pool_path)
+		old_time = time.time
+		try:
+			# Another data directory sharing the pool collected the file,
+			# which is noticed when the pool directory is checked again.
+			time.time = lambda: old_time() + rapid.SNAPSHOT_TTL + 1
+			self.assertFalse(f.available)
+		finally:
+			time.time = old_time
+
+	def test_parse_sdp(self):
+		md5 = hashlib.md5('').digest()
+		data = '\3foo' + md5 + 'CRC3' + struct.pack('>L', 1234) + '\0' + md5 + 'CRC3' + struct.pack('>L', 0)
+		files = parse_sdp(data)
+		self.assertEqual(2, len(files))
+		self.assertEqual([('foo', md5, 'CRC3', 1234), ('', md5, 'CRC3', 0)], [(f.name, f.md5, f.crc32, f.size) for f in files])
+		self.assertEqual([files[0].pool_path] * 2, list(files.pool_paths()))
+		self.assertEqual(files[0], parse_sdp(data)[0])
+		self.assertNotEqual(files[0], files[1])
+		for length, field in [(2, 'name'), (10, 'md5'), (22, 'crc32'), (26, 'size')]:
+			try:
+				parse_sdp(data[:length])
+				self.fail('truncated .sdp should not be parsed')
+			except PackageFormatException as e:
+				self.assertEqual(field, e.field)
+
+	def test_sdp_manifest(self):
+		p = self.rapid.packages['XTA 9.6']
+		files = p.files
+		self.assertTrue(os.path.exists(p.manifest_file))
+		decompress = rapid.zlib.decompress
+		try:
+			def fail(*args):
+				raise AssertionError('.sdp should not be read')
+			rapid.zlib.decompress = fail
+			cached = rapid.read_sdp(p.cache_file, p.manifest_file)
+		finally:
+			rapid.zlib.decompress = decompress
+		self.assertEqual(list(files), list(cached))
+		self.assertEqual([('foo', 0)], [(f.name, f.size) for f in cached])
+
 	def test_get_package_by_name(self):
 		self.assertRaises(KeyError, lambda: self.rapid.packages['XXXXXX'])
 		self.assertTrue(self.rapid.packages['XTA 9.6'])
@@ -111,6 +585,226 @@ class TestRapid(unittest.TestCase):
 		p.uninstall()
 		self.assertFalse(os.path.exists(os.path.join(rapid.package_dir, '1234.sdp')))
 
+	def sdp_entry(self, name, data):
+		return (chr(len(name)) + name + hashlib.md5(data).digest() +
+			4 * '\0' + struct.pack('>L', len(data)))
+
+	def streamer_entry(self, data):
+		data = gzip_string(data)
+		return struct.pack('>L', len(data)) + data
+
+	def test_download_files_streaming(self):
+		big = os.urandom(1000) * 200
+		www = self.downloader.www
+		www['http://ts1/packages/1234.sdp'] = gzip_string(self.sdp_entry('big', big) + self.sdp_entry('small', 'bar'))
+		www['http://ts1/streamer.cgi?1234'] = self.streamer_entry(big) + self.streamer_entry('bar')
+		old_chunk_size = rapid.STREAMER_CHUNK_SIZE
+		try:
+			rapid.STREAMER_CHUNK_SIZE = 1000
+			p = self.rapid.packages['xta:latest']
+			p.download_files(p.files)
+		finally:
+			rapid.STREAMER_CHUNK_SIZE = old_chunk_size
+		self.assertFalse(p.missing_files)
+		with open(p.files[0].pool_path, 'rb') as f:
+			self.assertEqual(gzip_string(big), f.read())
+
+	def streamer(self, contents):
+		""" Returns a function emulating streamer.cgi for a package
+		    containing files with the given contents."""
+		def streamer(postdata):
+			bits = bitarray(endian = 'little')
+			bits.frombytes(gzip.GzipFile(fileobj = StringIO(postdata)).read())
+			self.streamer_requests += 1
+			return ''.join(self.streamer_entry(x) for x, b in zip(contents, bits) if b)
+		self.streamer_requests = 0
+		return streamer
+
+	def test_download_files_sharded(self):
+		contents = [os.urandom(100) * i for i in range(1, 8)] + ['0'] * 2
+		www = self.downloader.www
+		www['http://ts1/packages/1234.sdp'] = gzip_string(''.join(self.sdp_entry(str(i), x) for i, x in enumerate(contents)))
+		www['http://ts1/streamer.cgi?1234'] = self.streamer(contents)
+		old_min_shard_size = rapid.STREAMER_MIN_SHARD_SIZE
+		try:
+			rapid.STREAMER_MIN_SHARD_SIZE = 1
+			p = self.rapid.packages['xta:latest']
+			progress = MockProgress()
+			p.download_files(p.files, progress, shards = 3)
+		finally:
+			rapid.STREAMER_MIN_SHARD_SIZE = old_min_shard_size
+		self.assertEqual(3, self.streamer_requests)
+		self.assertFalse(p.missing_files)
+		# the duplicate file is downloaded only once
+		self.assertEqual(sum(len(self.streamer_entry(x)) for x in contents[:-1]), progress.max)
+		self.assertEqual(progress.max, progress.value)
+
+	def test_download_files_resume(self):
+		contents = ['foo', 'bar', 'baz']
+		requested = []
+		www = self.downloader.www
+		www['http://ts1/packages/1234.sdp'] = gzip_string(''.join(self.sdp_entry(str(i), x) for i, x in enumerate(contents)))
+		streamer = self.streamer(contents)
+		def interrupted_streamer(postdata):
+			data = streamer(postdata)
+			requested.append(len(data))
+			if self.streamer_requests == 1:
+				return data[:len(self.streamer_entry('foo')) + 10]   # truncated
+			return data
+		www['http://ts1/streamer.cgi?1234'] = interrupted_streamer
+		p = self.rapid.packages['xta:latest']
+		progress = MockProgress()
+		p.download_files(p.files, progress)
+		self.assertFalse(p.missing_files)
+		self.assertEqual(2, self.streamer_requests)
+		# second request excludes the file downloaded by the first one
+		self.assertEqual(requested[0] - len(self.streamer_entry('foo')), requested[1])
+		self.assertEqual(progress.max, progress.value)
+
+	def test_download_files_md5_mismatch(self):
+		www = self.downloader.www
+		www['http://ts1/streamer.cgi?1234'] = self.streamer_entry('corrupt')
+		p = self.rapid.packages['xta:latest']
+		self.assertRaises(StreamerFormatException, lambda: p.download_files(p.files))
+		self.assertFalse(os.path.exists(p.files[0].pool_path))
+		self.assertFalse(os.path.exists(temp_name(p.files[0].pool_path)))
+
+	def test_streamer_writer(self):
+		p = self.rapid.packages['xta:latest']
+		progress = MockProgress()
+		writer = StreamerWriter(p.files, progress)
+		# Fed in chunks of any size, e.g. one byte at a time.
+		for c in self.downloader.www['http://ts1/streamer.cgi?1234']:
+			writer.write(c)
+		writer.finish()
+		self.assertTrue(os.path.exists(p.files[0].pool_path))
+		self.assertTrue(p.files[0].available)
+		self.assertEqual(len(self.downloader.www['http://ts1/streamer.cgi?1234']), progress.value)
+		self.assertRaises(StreamerFormatException, lambda: writer.write('x'))
+
+	def test_streamer_writer_incomplete(self):
+		p = self.rapid.packages['xta:latest']
+		writer = StreamerWriter(p.files)
+		writer.write(self.downloader.www['http://ts1/streamer.cgi?1234'][:-1])
+		self.assertRaises(StreamerFormatException, writer.finish)
+		writer.close()
+		self.assertFalse(os.path.exists(p.files[0].pool_path))
+		self.assertFalse(os.path.exists(temp_name(p.files[0].pool_path)))
+
+	def test_streamer_writer_md5_mismatch(self):
+		p = self.rapid.packages['xta:latest']
+		writer = StreamerWriter(p.files)
+		self.assertRaises(StreamerFormatException, lambda: writer.write(self.streamer_entry('corrupt')))
+		writer.close()
+		self.assertFalse(os.path.exists(p.files[0].pool_path))
+		self.assertFalse(os.path.exists(temp_name(p.files[0].pool_path)))
+
+	def test_download_files_truncated(self):
+		www = self.downloader.www
+		data = www['http://ts1/streamer.cgi?1234'][:-1]
+		requests = []
+		www['http://ts1/streamer.cgi?1234'] = lambda postdata: requests.append(postdata) or data
+		p = self.rapid.packages['xta:latest']
+		self.assertRaises(StreamerFormatException, lambda: p.download_files(p.files))
+		self.assertTrue(p.missing_files)
+		self.assertEqual(1 + rapid.STREAMER_RETRIES, len(requests))
+
+	def seed_pool(self, data):
+		seed_pool = os.path.join(self.test_dir, 'seed')
+		mkdir_p(os.path.join(seed_pool, 'd4'))
+		with open(os.path.join(seed_pool, 'd4', '1d8cd98f00b204e9800998ecf8427e.gz'), 'wb') as f:
+			f.write(data)
+		rapid.seed_pools = [os.path.join(self.test_dir, 'nonexisting'), seed_pool]
+
+	def test_seed_pool(self):
+		self.seed_pool(gzip_string(''))
+		del self.downloader.www['http://ts1/streamer.cgi?1234']
+		p = self.rapid.packages['xta:latest']
+		self.install(p)
+		self.assertEqual('', gzip.open(p.files[0].pool_path).read())
+		if hasattr(os, 'link'):
+			self.assertEqual(2, os.stat(p.files[0].pool_path).st_nlink)
+
+	def test_download_files_statistics(self):
+		self.seed_pool(gzip_string(''))
+		contents = ['', os.urandom(300 * 1024), os.urandom(300 * 1024), os.urandom(300 * 1024)]
+		www = self.downloader.www
+		www['http://ts1/packages/1234.sdp'] = gzip_string(''.join(self.sdp_entry(str(i), x) for i, x in enumerate(contents)))
+		streamer = self.streamer(contents)
+		def interrupted_streamer(postdata):
+			data = streamer(postdata)
+			if self.streamer_requests <= 2:
+				return data[:len(self.streamer_entry(contents[1])) + 10]   # truncated
+			return data
+		www['http://ts1/streamer.cgi?1234'] = interrupted_streamer
+		p = self.rapid.packages['xta:latest']
+		messages = []
+		handler = MessageRecorder(messages)
+		level = rapid.log.level
+		rapid.log.addHandler(handler)
+		rapid.log.setLevel(logging.INFO)
+		try:
+			p.download_files(p.files)
+		finally:
+			rapid.log.setLevel(level)
+			rapid.log.removeHandler(handler)
+		self.assertEqual(3, self.streamer_requests)
+		sizes = [os.path.getsize(f.pool_path) / (1024.*1024.) for f in p.files]
+		# The files downloaded by all earlier attempts are counted.
+		self.assertEqual(['%.2f megabytes already downloaded do not need to be downloaded again.' % x for x in (sizes[1], sizes[1] + sizes[2])],
+			[m for m in messages if 'already downloaded' in m])
+		self.assertEqual(['retrying 2 of 3 files', 'retrying 1 of 3 files'],
+			[m.split(', ')[1].split(' in ')[0] for m in messages if 'interrupted' in m])
+		self.assertEqual('%.2f megabytes reused from seed pools, %.2f megabytes downloaded.' % (sizes[0], sum(sizes[1:])), messages[-1])
+
+	def test_seed_pool_md5_mismatch(self):
+		self.seed_pool(gzip_string('corrupt'))
+		p = self.rapid.packages['xta:latest']
+		self.install(p)
+		self.assertEqual('', gzip.open(p.files[0].pool_path).read())
+
+	def test_plan_downloads_seed_pool(self):
+		self.seed_pool(gzip_string(''))
+		p = self.rapid.packages['xta:latest']
+		self.assertEqual([], plan_downloads([p]))
+		self.assertFalse(p.missing_files)
+
+	def test_plan_downloads_seed_pool_dry_run(self):
+		self.seed_pool(gzip_string(''))
+		p = self.rapid.packages['xta:latest']
+		self.assertEqual([], plan_downloads([p], seed = False))
+		self.assertTrue(p.missing_files, 'the pool should not be touched')
+
+	def test_compression_ratio(self):
+		big = 'a' * 100000
+		www = self.downloader.www
+		www['http://ts1/packages/1234.sdp'] = gzip_string(self.sdp_entry('big', big))
+		www['http://ts1/streamer.cgi?1234'] = self.streamer_entry(big)
+		p = self.rapid.packages['xta:latest']
+		self.assertEqual(None, rapid.compression_ratio([p]))
+		p.download_files(p.files)
+		ratio = float(len(gzip_string(big))) / len(big)
+		self.assertAlmostEqual(ratio, rapid.compression_ratio([p]))
+		# Estimated from a sample of the pool if the packages have no files in it.
+		self.assertAlmostEqual(ratio, rapid.compression_ratio([]))
+
+	def test_plan_downloads(self):
+		www = self.downloader.www
+		www['http://ts1/versions.gz'] = gzip_string('a,AAAA,,A\nb,BBBB,,B\nc,CCCC,,C\n')
+		www['http://ts1/packages/AAAA.sdp'] = gzip_string(self.sdp_entry('x', 'x') + self.sdp_entry('y', 'y'))
+		www['http://ts1/packages/BBBB.sdp'] = gzip_string(self.sdp_entry('x', 'x') + self.sdp_entry('y', 'y') + self.sdp_entry('z', 'z'))
+		www['http://ts1/packages/CCCC.sdp'] = gzip_string(self.sdp_entry('w', 'w') + self.sdp_entry('other name for x', 'x'))
+		a, b, c = [self.rapid.packages[x] for x in 'abc']
+		plan = plan_downloads([a, b, c])
+		self.assertEqual([b, c], [p for p, files in plan])
+		self.assertEqual(['x', 'y', 'z'], [f.name for f in plan[0][1]])
+		self.assertEqual(['w'], [f.name for f in plan[1][1]])
+
+	def test_plan_downloads_nothing_missing(self):
+		p = self.rapid.packages['dependency']
+		p.install()
+		self.assertEqual([], plan_downloads([p]))
+
 	def test_install_missing_dependency(self):
 		p = self.rapid.packages['xta:latest']
 		self.assertRaises(DependencyException, lambda: p.install())
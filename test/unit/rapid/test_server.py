@@ -0,0 +1,149 @@
+# Copyright (C) 2010 Tobi Vollebregt
+
+import binascii
+import os
+import shutil
+import struct
+import unittest
+import urllib2
+import rapid.rapid as rapid
+from bitarray import bitarray
+from contextlib import closing
+from threading import Event, Thread
+from rapid.rapid import Rapid, gzip_string, master_url, mkdir_p, set_spring_dir
+from rapid.server import MirrorServer
+from rapid.util.atomic import atomic_write
+from rapid.util.downloader import MockDownloader
+
+
+class BlockingResponse(object):
+	""" Streamer response which blocks after the first chunk of data,
+	    until it is released."""
+
+	def __init__(self, content, head):
+		self.__content = content
+		self.__head = head
+		self.__offset = 0
+		self.blocked = Event()
+		self.released = Event()
+
+	def info(self):
+		return {'Content-Length': len(self.__content)}
+
+	def read(self, amt):
+		if self.__offset == self.__head:
+			self.blocked.set()
+			self.released.wait(10)
+		end = self.__head if self.__offset < self.__head else len(self.__content)
+		data = self.__content[self.__offset:min(self.__offset + amt, end)]
+		self.__offset += len(data)
+		return data
+
+	def close(self):
+		pass
+
+
+class BlockingDownloader(MockDownloader):
+	""" MockDownloader whose POST requests return self.response, if set."""
+	response = None
+
+	def post(self, url, data):
+		if self.response:
+			self.request_count += 1
+			return self.response
+		return MockDownloader.post(self, url, data)
+
+
+class TestMirrorServer(unittest.TestCase):
+	test_dir = os.path.realpath('.test-server')
+
+	def setUp(self):
+		set_spring_dir(self.test_dir)
+		mkdir_p(rapid.pool_dir)
+
+		# The upstream repositories.
+		self.downloader = BlockingDownloader()
+		www = self.downloader.www
+		www[master_url] = gzip_string(',http://ts1/xta,,\n')
+		www['http://ts1/xta/versions.gz'] = gzip_string('xta:latest,1234,,XTA 9.6\n')
+		www['http://ts1/xta/packages/1234.sdp'] = gzip_string('\3foo' + binascii.unhexlify('d41d8cd98f00b204e9800998ecf8427e') + 8 * '\0')
+		www['http://ts1/xta/streamer.cgi?1234'] = struct.pack('>L', len(gzip_string(''))) + gzip_string('')
+
+		self.server = MirrorServer(Rapid(self.downloader), ('localhost', 0))
+		self.url = 'http://localhost:%d' % self.server.server_address[1]
+		self.thread = Thread(target = self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.test_dir)
+
+	def get(self, path, data = None):
+		with closing(urllib2.urlopen(self.url + path, data)) as remote:
+			return remote.read()
+
+	def test_repos_gz(self):
+		self.assertEqual(self.downloader.www[master_url], self.get('/repos.gz'))
+
+	def test_repos_gz_reload(self):
+		self.get('/repos.gz')
+		repositories = self.server.rapid.repositories.list
+		self.get('/repos.gz')
+		self.assertTrue(repositories is self.server.rapid.repositories.list,
+			'repositories should not be reloaded if repos.gz did not change')
+		atomic_write(self.server.rapid.repositories.repos_gz, gzip_string(',http://ts1/xta,,\n,http://ts2/ba,,\n'))
+		self.get('/repos.gz')
+		self.assertEqual(2, len(self.server.rapid.repositories))
+
+	def test_versions_gz(self):
+		self.assertEqual(self.downloader.www['http://ts1/xta/versions.gz'], self.get('/ts1/xta/versions.gz'))
+
+	def test_sdp(self):
+		sdp = self.downloader.www['http://ts1/xta/packages/1234.sdp']
+		self.assertEqual(sdp, self.get('/ts1/xta/packages/1234.sdp'))
+		self.assertEqual(sdp, self.get('/ts1/xta/packages/1234.sdp'))
+		self.assertEqual(2, self.downloader.request_count)   # repos.gz, 1234.sdp
+
+	def test_streamer(self):
+		bits = bitarray([True], endian = 'little')
+		data = self.get('/ts1/xta/streamer.cgi?1234', gzip_string(bits.tobytes()))
+		self.assertEqual(self.downloader.www['http://ts1/xta/streamer.cgi?1234'], data)
+		# The pool file has been mirrored.
+		self.assertEqual(1, len(os.listdir(os.path.join(rapid.pool_dir, 'd4'))))
+
+	def test_streamer_nothing_requested(self):
+		bits = bitarray([False], endian = 'little')
+		self.assertEqual('', self.get('/ts1/xta/streamer.cgi?1234', gzip_string(bits.tobytes())))
+
+	def test_streamer_concurrent(self):
+		streamer = self.downloader.www['http://ts1/xta/streamer.cgi?1234']
+		self.downloader.response = BlockingResponse(streamer, 6)
+		self.get('/ts1/xta/packages/1234.sdp')
+		bits = bitarray([True], endian = 'little')
+		remote = urllib2.urlopen(self.url + '/ts1/xta/streamer.cgi?1234', gzip_string(bits.tobytes()), 5)
+		try:
+			# The first bytes are passed on before upstream is done.
+			self.assertEqual(streamer[:6], remote.read(6))
+			self.assertTrue(self.downloader.response.blocked.wait(5))
+			# Other requests are served in the meantime.
+			with closing(urllib2.urlopen(self.url + '/ts1/xta/packages/1234.sdp', None, 5)) as other:
+				self.assertEqual(self.downloader.www['http://ts1/xta/packages/1234.sdp'], other.read())
+			self.downloader.response.released.set()
+			self.assertEqual(streamer[6:], remote.read())
+		finally:
+			self.downloader.response.released.set()
+			remote.close()
+		self.assertEqual(1, len(os.listdir(os.path.join(rapid.pool_dir, 'd4'))))
+
+	def test_not_found(self):
+		try:
+			self.get('/ts2/versions.gz')
+			self.fail('expected HTTP 404')
+		except urllib2.HTTPError as e:
+			self.assertEqual(404, e.code)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,129 @@
+# Copyright (C) 2010 Tobi Vollebregt
+
+import unittest
+import os
+import shutil
+import urllib2
+from StringIO import StringIO
+from test_downloader import MockHTTPServerThread
+from rapid.util.atomic import temp_name
+from rapid.util.async_downloader import AsyncDownloader, MockAsyncDownloader
+from rapid.util.downloader import IncompleteDownloadError
+
+
+class TestAsyncDownloader(unittest.TestCase):
+	test_dir = '.test-async-downloader'
+	config_file = os.path.join(test_dir, 'test.cfg')
+
+	def setUp(self):
+		if os.path.exists(self.test_dir):
+			shutil.rmtree(self.test_dir)
+		os.mkdir(self.test_dir)
+		self.server = MockHTTPServerThread()
+		self.url = 'http://localhost:%d/' % self.server.port
+
+	def tearDown(self):
+		self.server.shutdown()
+		shutil.rmtree(self.test_dir)
+
+	def test_concurrent_get_requests(self):
+		d = AsyncDownloader(self.config_file)
+		names = [os.path.join(self.test_dir, str(i)) for i in range(5)]
+		futures = [d.onetime_get_request(self.url + str(i), name) for i, name in enumerate(names)]
+		self.assertEqual(5, len(list(d.as_completed(futures))))
+		for future, name in zip(futures, names):
+			self.assertEqual(None, future.result())
+			self.assertEqual('Hello world', file(name).read())
+		self.assertEqual(5, self.server.request_count)
+
+	def test_http_304_not_modified(self):
+		name = os.path.join(self.test_dir, 'hello')
+		d = AsyncDownloader(self.config_file)
+		d.run([d.conditional_get_request(self.url, name)])
+		self.assertFalse(d._304)
+		d.run([d.conditional_get_request(self.url, name)])
+		self.assertTrue(d._304)
+		self.assertEqual('Hello world', file(name).read())
+
+	def test_truncated(self):
+		name = os.path.join(self.test_dir, 'hello')
+		d = AsyncDownloader(self.config_file)
+		future = d.onetime_get_request(self.url + 'truncated', name)
+		d.run([future])
+		self.assertRaises(IncompleteDownloadError, future.result)
+		self.assertFalse(os.path.exists(name))
+		self.assertFalse(os.path.exists(temp_name(name)))
+
+	def test_connection_refused(self):
+		d = AsyncDownloader(self.config_file)
+		future = d.post('http://localhost:1/', 'payload')
+		d.run([future])
+		self.assertRaises(urllib2.URLError, future.result)
+
+	def test_post(self):
+		d = AsyncDownloader(self.config_file)
+		future = d.post(self.url + 'POST', 'payload')
+		d.run([future])
+		remote = future.result()
+		self.assertEqual('7', remote.info().getheader('Content-Length'))
+		self.assertEqual('payload', remote.read())
+
+	def test_close(self):
+		d = AsyncDownloader(self.config_file)
+		sink = StringIO()
+		future = d.post(self.url + 'POST', 'payload', lambda headers: sink)
+		d.close()
+		self.assertEqual({}, d.socket_map)
+		self.assertRaises(urllib2.URLError, future.result)
+
+	def test_post_to_sink(self):
+		d = AsyncDownloader(self.config_file)
+		sink = StringIO()
+		future = d.post(self.url + 'POST', 'payload', lambda headers: sink)
+		d.run([future])
+		self.assertTrue(future.result() is sink)
+		self.assertEqual('payload', sink.getvalue())
+
+	def test_proxy(self):
+		name = os.path.join(self.test_dir, 'hello')
+		old_environ = dict(os.environ)
+		try:
+			os.environ['http_proxy'] = self.url
+			os.environ.pop('no_proxy', None)
+			d = AsyncDownloader(self.config_file)
+			future = d.onetime_get_request('http://rapid.invalid/foo', name)
+			d.run([future])
+		finally:
+			os.environ.clear()
+			os.environ.update(old_environ)
+		self.assertEqual(None, future.result())
+		self.assertEqual('Hello world', file(name).read())
+		self.assertEqual('http://rapid.invalid/foo', self.server.last_path,
+			'request should have been sent to the proxy')
+
+
+class TestMockAsyncDownloader(unittest.TestCase):
+	def test_post(self):
+		d = MockAsyncDownloader({'url': lambda data: data.upper()})
+		future = d.post('url', 'payload')
+		self.assertFalse(future.done())
+		d.run([future])
+		self.assertEqual('PAYLOAD', future.result().read())
+
+	def test_post_to_sink(self):
+		d = MockAsyncDownloader({'url': lambda data: data.upper()})
+		sink = StringIO()
+		future = d.post('url', 'payload', lambda headers: sink)
+		d.run([future])
+		self.assertTrue(future.result() is sink)
+		self.assertEqual('PAYLOAD', sink.getvalue())
+
+	def test_error(self):
+		d = MockAsyncDownloader()
+		future = d.post('url', 'payload')
+		d.run([future])
+		self.assertRaises(KeyError, future.result)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -4,26 +4,45 @@ import unittest
 import os
 import shutil
 import time
+from contextlib import closing
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from threading import Thread
-from rapid.util.downloader import Downloader, MockDownloader
+import rapid.util.downloader as downloader
+from rapid.util.atomic import temp_name
+from rapid.util.downloader import ConnectionPool, Downloader, IncompleteDownloadError, MockDownloader
 
 
 class MockHTTPRequestHandler(BaseHTTPRequestHandler):
-	def log_request(self, code, size = None):
+	timeout = 1
+
+	def setup(self):
+		BaseHTTPRequestHandler.setup(self)
+		self.server.connection_count += 1
+
+	def log_message(self, format, *args):
 		pass
 
 	def do_GET(self):
 		'''handle GET request'''
 		self.server.request_count += 1
+		self.server.last_path = self.path
+		if self.path == '/truncated':
+			self.send_response(200)
+			self.send_header('Content-Length', 100)
+			self.end_headers()
+			self.wfile.write('Hello')
+			self.close_connection = 1
+			return
 		etag = self.headers.getheader('If-None-Match')
 		date = self.headers.getheader('If-Modified-Since')
 		if etag == 'hi' and date == 'now':
 			self.send_response(304)
+			self.end_headers()
 		else:
 			self.send_response(200)
 			self.send_header('Etag', 'hi')
 			self.send_header('Last-Modified', 'now')
+			self.send_header('Content-Length', len('Hello world'))
 			self.end_headers()
 			self.wfile.write('Hello world')
 
@@ -31,19 +50,25 @@ class MockHTTPRequestHandler(BaseHTTPRequestHandler):
 		'''handle POST request by echoing it'''
 		self.server.request_count += 1
 		length = int(self.headers.getheader('Content-Length', 0))
+		if self.path == '/slow':
+			time.sleep(1)
 		self.send_response(200)
 		self.send_header('Content-Length', length)
 		self.end_headers()
 		self.wfile.write(self.rfile.read(length))
 
 
+class KeepAliveHTTPRequestHandler(MockHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+
 class MockHTTPServerThread(Thread, HTTPServer):
 	port = 8000
 
-	def __init__(self):
+	def __init__(self, handler = MockHTTPRequestHandler):
 		Thread.__init__(self)
 		MockHTTPServerThread.port += 1
-		HTTPServer.__init__(self, ('', self.port), MockHTTPRequestHandler)
+		HTTPServer.__init__(self, ('', self.port), handler)
 		# Thread
 		self.daemon = True
 		# HTTPServer
@@ -51,6 +76,8 @@ class MockHTTPServerThread(Thread, HTTPServer):
 		# self
 		self.keep_going = True
 		self.request_count = 0
+		self.connection_count = 0
+		self.last_path = None
 		self.start()
 
 	def run(self):
@@ -131,6 +158,86 @@ class TestDownloader(unittest.TestCase, TestDownloaderCore):
 	def get_request_count(self):
 		return self.httpd.request_count
 
+	def test_truncated_onetime_get_request(self):
+		d = self.get_downloader()
+		self.assertRaises(IncompleteDownloadError,
+			lambda: d.onetime_get_request(self.url + 'truncated', self.test_file))
+		self.assertFalse(os.path.exists(self.test_file))
+		self.assertFalse(os.path.exists(temp_name(self.test_file)))
+
+	def test_truncated_conditional_get_request(self):
+		d = self.get_downloader()
+		self.assertRaises(IncompleteDownloadError,
+			lambda: d.conditional_get_request(self.url + 'truncated', self.test_file))
+		self.assertFalse(os.path.exists(self.test_file))
+		with open(self.test_file, 'wb') as f:
+			f.write('old')
+		d.conditional_get_request(self.url + 'truncated', self.test_file)
+		self.assertEqual('old', file(self.test_file).read(),
+			'truncated download should not replace existing file')
+
+	def test_chunked_get_request(self):
+		old_chunk_size = downloader.chunk_size
+		try:
+			downloader.chunk_size = 2
+			self.get_downloader().onetime_get_request(self.url, self.test_file)
+		finally:
+			downloader.chunk_size = old_chunk_size
+		self.assertEqual('Hello world', file(self.test_file).read())
+
+	def test_commit(self):
+		d = self.get_downloader()
+		d.conditional_get_request(self.url, self.test_file)
+		self.assertFalse(os.path.exists(self.config_file),
+			'metadata should not be written before commit')
+		d.commit()
+		self.assertTrue(os.path.exists(self.config_file))
+
+	def test_proxy(self):
+		old_environ = dict(os.environ)
+		try:
+			os.environ['http_proxy'] = self.url
+			os.environ.pop('no_proxy', None)
+			self.get_downloader().onetime_get_request('http://rapid.invalid/foo', self.test_file)
+		finally:
+			os.environ.clear()
+			os.environ.update(old_environ)
+		self.assertEqual('Hello world', file(self.test_file).read())
+		self.assertEqual('http://rapid.invalid/foo', self.httpd.last_path,
+			'request should have been sent to the proxy')
+
+	def test_proxy_304_not_modified(self):
+		old_environ = dict(os.environ)
+		try:
+			os.environ['http_proxy'] = self.url
+			os.environ.pop('no_proxy', None)
+			d = self.get_downloader()
+			d.conditional_get_request('http://rapid.invalid/foo', self.test_file, 60)
+			self.assertFalse(d._304, 'first request should be 200 OK')
+			old_time = time.time
+			try:
+				time.time = lambda: old_time() + 90
+				d.conditional_get_request('http://rapid.invalid/foo', self.test_file, 60)
+				self.assertTrue(d._304, 'second request should be 304 Not Modified')
+				# The 304 response counts as a request for rate limiting.
+				d.conditional_get_request('http://rapid.invalid/foo', self.test_file, 60)
+			finally:
+				time.time = old_time
+		finally:
+			os.environ.clear()
+			os.environ.update(old_environ)
+		self.assertEqual(2, self.get_request_count())
+		self.assertEqual('http://rapid.invalid/foo', self.httpd.last_path)
+
+	def test_post_timeout(self):
+		old_timeout = downloader.timeout
+		try:
+			downloader.timeout = 0.5
+			remote = self.get_downloader().post(self.url + 'slow', 'payload')
+		finally:
+			downloader.timeout = old_timeout
+		self.assertEqual('payload', remote.read())
+
 	def test_config_is_not_shared(self):
 		self.get_downloader().conditional_get_request(self.url, self.test_file)
 		# create new downloader:
@@ -139,6 +246,82 @@ class TestDownloader(unittest.TestCase, TestDownloaderCore):
 		self.assertFalse(d._304, 'second request should be 200 OK')
 
 
+class TestDownloaderKeepAlive(TestDownloader):
+	'''test the Downloader class against a HTTP/1.1 MockHTTPServerThread'''
+
+	def setUp(self):
+		TestDownloaderCore.setUp(self)
+		self.httpd = MockHTTPServerThread(KeepAliveHTTPRequestHandler)
+		self.url = 'http://localhost:%d/' % self.httpd.port
+
+	def test_connection_reuse(self):
+		d = self.get_downloader()
+		d.conditional_get_request(self.url, self.test_file)
+		d.conditional_get_request(self.url, self.test_file)
+		with closing(d.post(self.url + 'POST', 'payload')) as remote:
+			self.assertEqual('payload', remote.read())
+		self.get_downloader().onetime_get_request(self.url, self.test_file + '.2')
+		self.assertEqual(4, self.get_request_count())
+		self.assertEqual(1, self.httpd.connection_count,
+			'all requests should have used the same connection')
+
+	def test_reconnect_after_server_closed_connection(self):
+		d = self.get_downloader()
+		d.conditional_get_request(self.url, self.test_file)
+		time.sleep(1.5)   # server times out idle connection after 1 second
+		self.assertEqual('payload', d.post(self.url + 'POST', 'payload').read())
+		self.assertEqual(2, self.get_request_count())
+		self.assertEqual(2, self.httpd.connection_count)
+
+
+class TestConnectionPool(unittest.TestCase):
+	'''test the ConnectionPool class without any network activity'''
+
+	class MockConnection(object):
+		def __init__(self):
+			self.closed = False
+		def close(self):
+			self.closed = True
+
+	def setUp(self):
+		self.pool = ConnectionPool()
+		self.key = ('http', 'localhost')
+
+	def test_acquire_release(self):
+		conn, reused = self.pool.acquire(self.key)
+		self.assertFalse(reused)
+		self.pool.release(self.key, conn)
+		self.assertEqual(1, self.pool.idle_count(self.key))
+		self.assertEqual((conn, True), self.pool.acquire(self.key))
+		self.assertEqual(0, self.pool.idle_count())
+
+	def test_pool_size(self):
+		conns = [self.MockConnection() for i in range(downloader.pool_size + 1)]
+		for conn in conns:
+			self.pool.release(self.key, conn)
+		self.assertEqual(downloader.pool_size, self.pool.idle_count(self.key))
+		self.assertTrue(conns[-1].closed)
+
+	def test_idle_eviction(self):
+		conn = self.MockConnection()
+		self.pool.release(self.key, conn)
+		old_time = time.time
+		try:
+			time.time = lambda: old_time() + downloader.pool_idle_timeout + 1
+			self.assertFalse(self.pool.acquire(self.key)[1])
+		finally:
+			time.time = old_time
+		self.assertTrue(conn.closed)
+		self.assertEqual(0, self.pool.idle_count())
+
+	def test_clear(self):
+		conn = self.MockConnection()
+		self.pool.release(self.key, conn)
+		self.pool.clear()
+		self.assertTrue(conn.closed)
+		self.assertEqual(0, self.pool.idle_count())
+
+
 class TestMockDownloader(unittest.TestCase, TestDownloaderCore):
 	'''test the MockDownloader'''
 
@@ -0,0 +1,58 @@
+# Copyright (C) 2010 Tobi Vollebregt
+
+import os
+import shutil
+import unittest
+from rapid.util.index import PackageIndex
+
+
+class TestPackageIndex(unittest.TestCase):
+	test_dir = os.path.realpath('.test-index')
+	test_file = os.path.join(test_dir, 'packages.idx')
+
+	def setUp(self):
+		if os.path.exists(self.test_dir):
+			shutil.rmtree(self.test_dir)
+		os.mkdir(self.test_dir)
+		PackageIndex.write(self.test_file, 'signature', ['repo'], [
+			('1234', 'XTA 9.6', ['xta:latest', 'xta:stable'], ['dependency'], [], 0),
+			('5678', 'dependency', [], [], ['XTA 9.6'], None),
+		], [('XTA 9.6', 0, False), ('xta:latest', 0, True), ('xta:stable', 0, True), ('dependency', 1, False)])
+
+	def tearDown(self):
+		shutil.rmtree(self.test_dir)
+
+	def test_find(self):
+		index = PackageIndex.open(self.test_file, 'signature')
+		self.assertEqual(2, len(index))
+		self.assertEqual(0, index.find('XTA 9.6'))
+		self.assertEqual(0, index.find('xta:latest'))
+		self.assertEqual(1, index.find('dependency'))
+		self.assertEqual(None, index.find('xta'))
+		self.assertEqual(None, index.find('zzz'))
+		index.close()
+
+	def test_record(self):
+		index = PackageIndex.open(self.test_file, 'signature')
+		self.assertEqual(('1234', 'XTA 9.6', ['xta:latest', 'xta:stable'], ['dependency'], [], 'repo'), index.record(0))
+		self.assertEqual(('5678', 'dependency', [], [], ['XTA 9.6'], None), index.record(1))
+		self.assertRaises(IndexError, index.record, 2)
+		index.close()
+
+	def test_tags(self):
+		index = PackageIndex.open(self.test_file, 'signature')
+		self.assertEqual(['xta:latest', 'xta:stable'], index.tags())
+		index.close()
+
+	def test_signature_mismatch(self):
+		self.assertEqual(None, PackageIndex.open(self.test_file, 'other'))
+
+	def test_missing_or_corrupt(self):
+		self.assertEqual(None, PackageIndex.open(self.test_file + '.missing', 'signature'))
+		with open(self.test_file, 'wb') as f:
+			f.write('RPI1\0')
+		self.assertEqual(None, PackageIndex.open(self.test_file, 'signature'))
+
+
+if __name__ == '__main__':
+	unittest.main()
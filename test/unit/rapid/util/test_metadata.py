@@ -0,0 +1,99 @@
+# Copyright (C) 2010 Tobi Vollebregt
+
+import os
+import shutil
+import time
+import unittest
+import rapid.util.metadata as metadata
+from rapid.util.metadata import FileLock, MetadataStore
+
+
+class TestMetadataStore(unittest.TestCase):
+	test_dir = os.path.realpath('.test-metadata')
+	test_file = os.path.join(test_dir, 'test.cfg')
+
+	def setUp(self):
+		if os.path.exists(self.test_dir):
+			shutil.rmtree(self.test_dir)
+		os.mkdir(self.test_dir)
+
+	def tearDown(self):
+		shutil.rmtree(self.test_dir)
+
+	def test_get_update(self):
+		store = MetadataStore(self.test_file)
+		self.assertEqual(None, store.get('url', 'etag'))
+		store.update('url', etag = 'hi', last_modified = None)
+		self.assertEqual('hi', store.get('url', 'etag'))
+		self.assertEqual(None, store.get('url', 'last_modified'))
+
+	def test_commit_is_batched(self):
+		store = MetadataStore(self.test_file)
+		store.update('url1', etag = 'a')
+		store.update('url2', etag = 'b')
+		self.assertFalse(os.path.exists(self.test_file))
+		store.commit()
+		store = MetadataStore(self.test_file)
+		self.assertEqual('a', store.get('url1', 'etag'))
+		self.assertEqual('b', store.get('url2', 'etag'))
+
+	def test_concurrent_writers_are_merged(self):
+		store1 = MetadataStore(self.test_file)
+		store2 = MetadataStore(self.test_file)
+		store1.update('url1', etag = 'a')
+		store2.update('url2', etag = 'b')
+		store1.commit()
+		store2.commit()
+		store = MetadataStore(self.test_file)
+		self.assertEqual('a', store.get('url1', 'etag'))
+		self.assertEqual('b', store.get('url2', 'etag'))
+
+	def test_open_shares_store(self):
+		store = MetadataStore.open(self.test_file)
+		store.update('url', etag = 'a')
+		self.assertTrue(store is MetadataStore.open(self.test_file))
+		self.assertEqual('a', MetadataStore.open(self.test_file).get('url', 'etag'))
+
+	def test_open_reloads_changed_file(self):
+		store = MetadataStore.open(self.test_file)
+		store.update('url1', etag = 'a')
+		other = MetadataStore(self.test_file)
+		other.update('url2', etag = 'b')
+		other.commit()
+		store = MetadataStore.open(self.test_file)
+		self.assertEqual('a', store.get('url1', 'etag'))
+		self.assertEqual('b', store.get('url2', 'etag'))
+		store.commit()
+
+
+class TestFileLock(unittest.TestCase):
+	test_file = os.path.realpath('.test-metadata.lock')
+
+	def tearDown(self):
+		if os.path.exists(self.test_file):
+			os.remove(self.test_file)
+
+	def test_lock(self):
+		with FileLock(self.test_file):
+			self.assertTrue(os.path.exists(self.test_file))
+		self.assertFalse(os.path.exists(self.test_file))
+
+	def test_timeout(self):
+		old_timeout = metadata.lock_timeout
+		try:
+			metadata.lock_timeout = 0.1
+			with FileLock(self.test_file):
+				self.assertRaises(IOError, lambda: FileLock(self.test_file).__enter__())
+		finally:
+			metadata.lock_timeout = old_timeout
+
+	def test_stale_lock(self):
+		open(self.test_file, 'w').close()
+		old = time.time() - metadata.lock_stale - 1
+		os.utime(self.test_file, (old, old))
+		with FileLock(self.test_file):
+			pass
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,60 @@
+# Copyright (C) 2010 Tobi Vollebregt
+
+import os
+import re
+import shutil
+import unittest
+from rapid.util.trigram import TrigramIndex, required_literals
+
+
+class TestTrigramIndex(unittest.TestCase):
+	test_dir = os.path.realpath('.test-trigram')
+	test_file = os.path.join(test_dir, 'packages.tri')
+	keys = ['XTA 9.6', 'xta:latest', 'xta:stable', 'BA 7.0', 'ba:latest', 'dependency']
+
+	def setUp(self):
+		if os.path.exists(self.test_dir):
+			shutil.rmtree(self.test_dir)
+		os.mkdir(self.test_dir)
+		self.index = TrigramIndex(self.keys)
+
+	def tearDown(self):
+		shutil.rmtree(self.test_dir)
+
+	def test_search(self):
+		for needle in ['lat', 'XTA', ':latest', 'a', '', 'pen', 'nothing']:
+			self.assertEqual([k for k in self.keys if needle.lower() in k.lower()], self.index.search(needle))
+
+	def test_regex_candidates(self):
+		self.assertEqual(['xta:latest', 'ba:latest'], self.index.regex_candidates('^.*latest$'))
+		self.assertEqual(self.keys, self.index.regex_candidates('(xta|ba):latest'))
+		for pattern in ['lat.st', 'x?ta', 'ta:[ls]', 'XTA \\d\\.\\d', 'a+:s', 'e{2,}', '[^]]latest', 'a[\\]:]lat']:
+			candidates = self.index.regex_candidates(pattern)
+			for key in self.keys:
+				if re.search(pattern, key, re.I):
+					self.assertTrue(key in candidates, '%s should match %s' % (key, pattern))
+
+	def test_required_literals(self):
+		self.assertEqual(['xta:lat', 'st'], required_literals('^xta:lat.st$'))
+		self.assertEqual(['xt', 'late'], required_literals('xta?lates*'))
+		self.assertEqual(['TA 9.6'], required_literals('[xX]TA 9\\.6'))
+		self.assertEqual(None, required_literals('a|b'))
+		self.assertEqual(None, required_literals('(ab)?cde'))
+		self.assertEqual(['abc'], required_literals('[^]]abc'))
+		self.assertEqual(['x', 'abc'], required_literals('x[]]abc'))
+		self.assertEqual(['abc'], required_literals('[\\]x]abc'))
+		self.assertEqual(None, required_literals('[^]abc'))
+
+	def test_write_open(self):
+		self.index.write(self.test_file, 'signature')
+		self.assertEqual(None, TrigramIndex.open(self.test_file, 'other'))
+		index = TrigramIndex.open(self.test_file, 'signature')
+		self.assertEqual(self.keys, index.keys)
+		self.assertEqual(['xta:latest', 'ba:latest'], index.search('latest'))
+
+	def test_open_missing(self):
+		self.assertEqual(None, TrigramIndex.open(self.test_file, 'signature'))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,52 @@
+# Copyright (C) 2010 Tobi Vollebregt
+
+import threading
+import time
+import unittest
+from rapid.util.workers import parallel_map
+
+
+class TestParallelMap(unittest.TestCase):
+
+	def test_order(self):
+		def slow(x):
+			time.sleep(0.01 * (5 - x))
+			return x * x
+		self.assertEqual([0, 1, 4, 9, 16], parallel_map(slow, range(5), 4))
+
+	def test_serial(self):
+		self.assertEqual([1, 2, 3], parallel_map(lambda x: x + 1, [0, 1, 2], 1))
+
+	def test_empty(self):
+		self.assertEqual([], parallel_map(lambda x: x, [], 4))
+
+	def test_first_exception_is_raised(self):
+		done = []
+		def f(x):
+			if x in (1, 3):
+				raise ValueError(x)
+			done.append(x)
+		try:
+			parallel_map(f, range(5), 3)
+			self.fail('ValueError expected')
+		except ValueError as e:
+			self.assertEqual((1,), e.args)
+		self.assertEqual([0, 2, 4], sorted(done))
+
+	def test_per_key_limit(self):
+		lock = threading.Lock()
+		running = {'a': 0, 'b': 0}
+		peak = {'a': 0, 'b': 0}
+		def f(x):
+			with lock:
+				running[x] += 1
+				peak[x] = max(peak[x], running[x])
+			time.sleep(0.01)
+			with lock:
+				running[x] -= 1
+		parallel_map(f, ['a', 'b'] * 6, 6, lambda x: x, 2)
+		self.assertEqual({'a': 2, 'b': 2}, peak)
+
+
+if __name__ == '__main__':
+	unittest.main()
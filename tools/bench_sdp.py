@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Tobi Vollebregt
+
+# Measures how long it takes to read a large .sdp file: using small reads
+# from a GzipFile (as rapid used to), using the one-pass parser, and using
+# the decoded manifest.
+#
+# Usage: python tools/bench_sdp.py [number of files]
+
+from contextlib import closing
+import gzip, os, shutil, struct, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from rapid import rapid
+from rapid.rapid import File, gzip_string, read_sdp
+
+def read_sdp_gzipfile(filename):
+	""" The former .sdp reader, as baseline."""
+	files = []
+	with closing(gzip.open(filename)) as f:
+		while True:
+			namelen = f.read(1)
+			if namelen == '': break
+			namelen = struct.unpack('B', namelen)[0]
+			name  = f.read(namelen)
+			md5   = f.read(16)
+			crc32 = f.read(4)
+			size  = struct.unpack('>L', f.read(4))[0]
+			files.append(File(name, md5, crc32, size))
+	return files
+
+def main(count = 50000):
+	temp_dir = tempfile.mkdtemp()
+	try:
+		rapid.set_spring_dir(temp_dir)
+		sdp = os.path.join(temp_dir, 'test.sdp')
+		manifest = sdp + '.manifest'
+		with open(sdp, 'wb') as f:
+			f.write(gzip_string(''.join(chr(len(name)) + name + struct.pack('>16sLL', '%016x' % i, i, i)
+			                            for i, name in ((i, 'maps/test/file%d.dat' % i) for i in xrange(count)))))
+
+		def measure(description, function, prepare = lambda: None):
+			best = None
+			for i in range(5):
+				prepare()
+				start = time.time()
+				files = function()
+				elapsed = time.time() - start
+				best = min(best, elapsed) if best is not None else elapsed
+			assert len(files) == count
+			print '%-28s %8.1f ms' % (description, best * 1000)
+
+		def remove_manifest():
+			if os.path.exists(manifest):
+				os.remove(manifest)
+
+		print 'Reading .sdp with %d files:' % count
+		measure('GzipFile, small reads', lambda: read_sdp_gzipfile(sdp))
+		measure('one-pass parser', lambda: read_sdp(sdp))
+		measure('parser + write manifest', lambda: read_sdp(sdp, manifest), remove_manifest)
+		measure('load manifest', lambda: read_sdp(sdp, manifest))
+	finally:
+		shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))
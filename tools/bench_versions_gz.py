@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# Copyright (C) 2010 Tobi Vollebregt
+
+# Measures how long it takes to read a large versions.gz, with and without
+# the parsed versions.cache.
+#
+# Usage: python tools/bench_versions_gz.py [number of lines]
+
+import os, shutil, sys, tempfile, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from rapid.rapid import OfflineRepository, gzip_string
+
+def main(lines = 50000):
+	cache_dir = tempfile.mkdtemp()
+	try:
+		repository = OfflineRepository(cache_dir)
+		with open(repository.versions_gz, 'wb') as f:
+			f.write(gzip_string(''.join('test:%d,%032x,dep%d|dep%d,Test %d\n' % (i, i, i - 1, i - 2, i)
+			                            for i in xrange(lines))))
+
+		def measure(description, prepare):
+			best = None
+			for i in range(5):
+				prepare()
+				start = time.time()
+				packages = repository.read_versions_gz()
+				elapsed = time.time() - start
+				best = min(best, elapsed) if best is not None else elapsed
+			assert len(packages) == lines
+			print '%-28s %8.1f ms' % (description, best * 1000)
+
+		def remove_cache():
+			if os.path.exists(repository.versions_cache):
+				os.remove(repository.versions_cache)
+
+		print 'Reading versions.gz with %d lines:' % lines
+		measure('parse versions.gz', remove_cache)
+		measure('load versions.cache', lambda: None)
+	finally:
+		shutil.rmtree(cache_dir)
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))